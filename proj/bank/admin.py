@@ -82,6 +82,17 @@ class ExpenseAdmin(admin.ModelAdmin):
     list_select_related = True
     date_hierarchy = 'date_paid'
 
+class LocationAliasAdmin(admin.ModelAdmin):
+    list_display = ('id','alias','location','created_by','modified')
+    search_fields = ('alias',)
+    raw_id_fields = ('location',)
+    list_select_related = ('location', 'location__seller')
+
+class StatementImportAdmin(admin.ModelAdmin):
+    list_display = ('id','account','filename','status','num_lines','num_created','num_duplicates','num_unmatched','created')
+    list_filter = ('account','status')
+    list_select_related = True
+
 
 # register models
 admin.site.register(Source, SourceAdmin)
@@ -96,3 +107,5 @@ admin.site.register(Tag, TagAdmin)
 admin.site.register(Order, OrderAdmin)
 admin.site.register(Expense, ExpenseAdmin)
 
+admin.site.register(LocationAlias, LocationAliasAdmin)
+admin.site.register(StatementImport, StatementImportAdmin)
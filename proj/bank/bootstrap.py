@@ -0,0 +1,63 @@
+"""All reference data in one response, for the start of a client.
+
+The payload is rendered to JSON once per combination of the generations
+of BOOTSTRAP_MODELS (see bank.refcache.derived) and served as is: a
+request costs the generation query, and nothing more if the client sends
+the current ETag.
+"""
+from collections import OrderedDict
+import hashlib
+import logging
+from .models import *
+from . import refcache
+from .renderers import TimedJSONRenderer
+from .serializers import *
+
+logger = logging.getLogger('gen.bootstrap')
+
+BOOTSTRAP_MODELS = (Source, Institution, Account, Paytype, Category, Tag, Seller, Location, PreferredAccount)
+
+
+def bootstrapVersion():
+    """Returns str version of the reference data: changes with the generation
+    of any of BOOTSTRAP_MODELS.
+    """
+    gens = refcache.currentGenerations()
+    key = ','.join(str(gens.get(refcache.generationName(m), 0)) for m in BOOTSTRAP_MODELS)
+    return hashlib.sha1(key.encode('ascii')).hexdigest()[:16]
+
+
+def _cachedRows(model):
+    return list(refcache.objects(model).values())
+
+
+def bootstrapData(version):
+    """Returns OrderedDict of the representations of all rows of
+    BOOTSTRAP_MODELS, in the format and order of their list endpoints.
+    """
+    return OrderedDict((
+        ('version', version),
+        ('source', SourceSerializer.representMany(_cachedRows(Source))),
+        ('institution', InstitutionSerializer.representMany(_cachedRows(Institution))),
+        ('account', AccountSerializer.representMany(_cachedRows(Account))),
+        ('paytype', PaytypeSerializer.representMany(_cachedRows(Paytype))),
+        ('category', CategorySerializer.representMany(_cachedRows(Category))),
+        ('tag', TagSerializer.representMany(_cachedRows(Tag))),
+        ('seller', ReadSellerSerializer.representMany(Seller.objects.withRelated().order_by('id'))),
+        ('location', LocationSerializer.representMany(_cachedRows(Location))),
+        ('pref_account', PrefAccountSerializer.representMany(PreferredAccount.objects.order_by('seller', 'id'))),
+    ))
+
+
+def bootstrapBlob():
+    """Returns (version, bytes compact JSON of bootstrapData), rebuilt when
+    the version changes.
+    """
+    version = bootstrapVersion()
+
+    def build():
+        blob = TimedJSONRenderer().render(bootstrapData(version))
+        logger.info('bootstrap {0}: {1} bytes'.format(version, len(blob)))
+        return blob
+
+    return version, refcache.derived('bootstrap', BOOTSTRAP_MODELS, build)
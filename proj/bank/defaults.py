@@ -0,0 +1,159 @@
+"""Seller defaults: the auto_catg (weight 1.00) and auto_tags of the seller
+of a location are applied to a new expense for which no categories/tags
+are given, and can be backfilled for existing expenses.
+
+The map {location id: (auto_catg id, auto tag ids)} is cached in
+bank.refcache and rebuilt when a Location or Seller (including its
+auto_tags) changes.
+"""
+from decimal import Decimal
+import logging
+from django.db import connection, transaction
+from .models import *
+from . import refcache
+from .rollups import addExpenseCategories
+
+logger = logging.getLogger('gen.defaults')
+
+AUTO_CATG_WEIGHT = Decimal('1.00')
+
+
+def _buildDefaults():
+    sellers = {}
+    for seller_id, catg_id in Seller.objects.values_list('id', 'auto_catg_id'):
+        sellers[seller_id] = (catg_id, [])
+    for seller_id, tag_id in Seller.auto_tags.through.objects.order_by('tag_id').values_list('seller_id', 'tag_id'):
+        sellers[seller_id][1].append(tag_id)
+    out = {}
+    for loc in refcache.objects(Location).values():
+        catg_id, tag_ids = sellers.get(loc.seller_id, (None, []))
+        if catg_id or tag_ids:
+            out[loc.pk] = (catg_id, tuple(tag_ids))
+    return out
+
+
+def locationDefaults():
+    """Returns dict {location id: (auto_catg id/None, tuple of tag ids)} for
+    the locations whose seller has defaults.
+    """
+    return refcache.derived('seller_defaults', (Location, Seller), _buildDefaults)
+
+
+def sellerDefaults(location_id):
+    """Returns (categories, tags) for a new expense at location_id:
+        categories: list of dicts [{category:Category, weight:Decimal}]
+        tags: list of Tag
+    """
+    catg_id, tag_ids = locationDefaults().get(location_id, (None, ()))
+    categories = []
+    if catg_id:
+        category = refcache.get(Category, catg_id)
+        if category:
+            categories.append({'category': category, 'weight': AUTO_CATG_WEIGHT})
+    tags = [t for t in (refcache.get(Tag, pk) for pk in tag_ids) if t]
+    return categories, tags
+
+
+def withSellerDefaults(data, location_id):
+    """Returns a copy of data (Expense field values with optional tags and
+    categories, as validated by CreateRegularExpenseSerializer) with the
+    seller defaults for the keys that are not given.
+    """
+    if 'categories' in data and 'tags' in data:
+        return data
+    categories, tags = sellerDefaults(location_id)
+    data = dict(data)
+    data.setdefault('categories', categories)
+    data.setdefault('tags', tags)
+    return data
+
+
+def _execute(sql, params=()):
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchone()
+
+# Each statement covers the expenses with id in (%s, %s]. The NOT EXISTS
+# skips the expenses that have categories/tags, and a row entered
+# concurrently for the same expense and category/tag is skipped by the
+# unique index instead of failing the batch.
+BACKFILL_CATEGORIES_SQL = """
+WITH ins AS (
+    INSERT INTO bank_expensecategory (expense_id, category_id, weight)
+    SELECT e.id, s.auto_catg_id, %s
+      FROM bank_expense e
+      JOIN bank_location l ON l.id = e.location_id
+      JOIN bank_seller s ON s.id = l.seller_id
+     WHERE e.id > %s AND e.id <= %s
+       AND s.auto_catg_id IS NOT NULL
+       AND NOT EXISTS (SELECT 1 FROM bank_expensecategory ec WHERE ec.expense_id = e.id)
+    ON CONFLICT (expense_id, category_id) DO NOTHING
+    RETURNING id, expense_id
+), upd AS (
+    UPDATE bank_expense e SET modified = now() FROM ins WHERE e.id = ins.expense_id
+    RETURNING e.id
+)
+SELECT (SELECT array_agg(id) FROM ins), (SELECT count(*) FROM upd)
+"""
+
+BACKFILL_TAGS_SQL = """
+WITH ins AS (
+    INSERT INTO bank_expense_tags (expense_id, tag_id)
+    SELECT e.id, st.tag_id
+      FROM bank_expense e
+      JOIN bank_location l ON l.id = e.location_id
+      JOIN bank_seller_auto_tags st ON st.seller_id = l.seller_id
+     WHERE e.id > %s AND e.id <= %s
+       AND NOT EXISTS (SELECT 1 FROM bank_expense_tags et WHERE et.expense_id = e.id)
+    ON CONFLICT (expense_id, tag_id) DO NOTHING
+    RETURNING expense_id
+), upd AS (
+    UPDATE bank_expense e SET modified = now()
+      FROM (SELECT DISTINCT expense_id FROM ins) i WHERE e.id = i.expense_id
+    RETURNING e.id
+)
+SELECT (SELECT count(*) FROM ins), (SELECT count(*) FROM upd)
+"""
+
+BACKFILL_BATCH_SIZE = 5000 # expenses per statement
+
+
+def _expenseRanges(batch_size):
+    """Yields (low, high) expense id ranges (low, high] of up to batch_size
+    expenses, read with a keyset on the primary key.
+    """
+    low = 0
+    while True:
+        ids = list(Expense.objects.filter(id__gt=low).order_by('id').values_list('id', flat=True)[batch_size-1:batch_size])
+        if not ids:
+            high = Expense.objects.filter(id__gt=low).aggregate(m=models.Max('id'))['m']
+            if high is not None:
+                yield low, high
+            return
+        yield low, ids[0]
+        low = ids[0]
+
+
+def backfillSellerDefaults(categories=True, tags=True, batch_size=BACKFILL_BATCH_SIZE):
+    """Apply the seller defaults to all existing expenses without categories
+    (auto_catg) and without tags (auto_tags), in batches of expense ids each
+    committed in its own transaction, so writers are only held up by the
+    row locks of a batch. The modified time of the changed expenses is
+    updated and the new categories are added to the rollups.
+    Returns: dict {categories: rows inserted, tags: rows inserted, expenses: expenses changed}
+    """
+    out = {'categories': 0, 'tags': 0, 'expenses': 0}
+    for low, high in _expenseRanges(batch_size):
+        with transaction.atomic():
+            if categories:
+                ids, num = _execute(BACKFILL_CATEGORIES_SQL, [AUTO_CATG_WEIGHT, low, high])
+                if ids:
+                    out['categories'] += len(ids)
+                    addExpenseCategories(ExpenseCategory.objects.filter(id__in=ids))
+                out['expenses'] += num
+            if tags:
+                num_tags, num = _execute(BACKFILL_TAGS_SQL, [low, high])
+                out['tags'] += num_tags
+                out['expenses'] += num
+    logger.info('backfillSellerDefaults: {0}'.format(out))
+    return out
@@ -0,0 +1,121 @@
+"""Streaming export of expenses as CSV or NDJSON.
+
+The rows are read through a server-side cursor (QuerySet.iterator() on
+PostgreSQL) and written in chunks of EXPORT_CHUNK_SIZE. For each chunk the
+categories and tags are loaded with one query each; account, paytype,
+category and tag names come from bank.refcache. Memory use depends on the
+chunk size, not on the number of rows exported.
+"""
+import csv
+from itertools import islice
+import json
+from .models import *
+from . import refcache
+
+EXPORT_CHUNK_SIZE = 2000
+FILETYPE_CSV = 'csv'
+FILETYPE_NDJSON = 'ndjson'
+FILETYPES = {
+    FILETYPE_CSV: 'text/csv; charset=utf-8',
+    FILETYPE_NDJSON: 'application/x-ndjson; charset=utf-8',
+}
+EXPORT_COLUMNS = (
+    'id', 'date_paid', 'amount', 'seller', 'location', 'account', 'paytype',
+    'order', 'shipment_no', 'check_no', 'invoiceid', 'memo', 'categories', 'tags'
+)
+_VALUE_FIELDS = (
+    'id', 'date_paid', 'amount', 'location__seller__seller_name', 'location__loc_name',
+    'account_id', 'paytype_id', 'order_id', 'shipment_no', 'check_no', 'invoiceid', 'memo'
+)
+
+
+class Echo(object):
+    """File-like object for csv.writer that returns the written line"""
+    def write(self, value):
+        return value
+
+
+def exportRecords(queryset, chunk_size=EXPORT_CHUNK_SIZE):
+    """Generator of dicts with the keys EXPORT_COLUMNS. categories is a list
+    of (category name, weight) and tags a list of tag names.
+    Args:
+        queryset: filtered and ordered Expense queryset
+        chunk_size: int
+    """
+    # copied once per export (see bank.refcache)
+    accounts = dict(refcache.objects(Account))
+    paytypes = dict(refcache.objects(Paytype))
+    catgs = dict(refcache.objects(Category))
+    tags = dict(refcache.objects(Tag))
+    TagLink = Expense.tags.through
+    rows = queryset.values(*_VALUE_FIELDS).iterator()
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        ids = [d['id'] for d in chunk]
+        ec_map = {}
+        for expense_id, category_id, weight in ExpenseCategory.objects.filter(expense_id__in=ids
+                ).order_by('id').values_list('expense_id', 'category_id', 'weight'):
+            category = catgs.get(category_id)
+            ec_map.setdefault(expense_id, []).append((category.catg if category else None, weight))
+        tag_map = {}
+        for expense_id, tag_id in TagLink.objects.filter(expense_id__in=ids
+                ).order_by('tag_id').values_list('expense_id', 'tag_id'):
+            tag = tags.get(tag_id)
+            tag_map.setdefault(expense_id, []).append(tag.tag if tag else None)
+        for d in chunk:
+            account = accounts.get(d['account_id'])
+            paytype = paytypes.get(d['paytype_id'])
+            yield {
+                'id': d['id'],
+                'date_paid': d['date_paid'],
+                'amount': d['amount'],
+                'seller': d['location__seller__seller_name'],
+                'location': d['location__loc_name'],
+                'account': account.acct_name if account else None,
+                'paytype': paytype.paytype if paytype else None,
+                'order': d['order_id'],
+                'shipment_no': d['shipment_no'],
+                'check_no': d['check_no'],
+                'invoiceid': d['invoiceid'],
+                'memo': d['memo'],
+                'categories': ec_map.get(d['id'], []),
+                'tags': tag_map.get(d['id'], []),
+            }
+
+
+def streamCsv(records):
+    """Generator of CSV lines. categories are written as name:weight separated by ;"""
+    writer = csv.writer(Echo())
+    yield writer.writerow(EXPORT_COLUMNS)
+    for r in records:
+        r = dict(r,
+            date_paid=r['date_paid'].isoformat(),
+            categories=';'.join('{0}:{1}'.format(name, weight) for name, weight in r['categories']),
+            tags=';'.join(t or '' for t in r['tags'])
+        )
+        yield writer.writerow([r[c] for c in EXPORT_COLUMNS])
+
+
+def streamNdjson(records):
+    """Generator of JSON lines"""
+    for r in records:
+        r = dict(r,
+            date_paid=r['date_paid'].isoformat(),
+            amount=str(r['amount']),
+            categories=[{'category': name, 'weight': str(weight)} for name, weight in r['categories']]
+        )
+        yield json.dumps(r) + '\n'
+
+
+def streamExpenses(queryset, filetype, chunk_size=EXPORT_CHUNK_SIZE):
+    """Returns generator of str lines of the export
+    Args:
+        queryset: filtered and ordered Expense queryset
+        filetype: str one of FILETYPES
+    """
+    records = exportRecords(queryset, chunk_size)
+    if filetype == FILETYPE_NDJSON:
+        return streamNdjson(records)
+    return streamCsv(records)
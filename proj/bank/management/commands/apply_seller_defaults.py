@@ -0,0 +1,20 @@
+import logging
+from django.core.management.base import BaseCommand
+from bank.defaults import backfillSellerDefaults
+
+logger = logging.getLogger('mgmt.defaults')
+
+class Command(BaseCommand):
+    help = "Apply the seller auto_catg (weight 1.00) to all expenses without categories and the seller auto_tags to all expenses without tags."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--no-categories', action='store_false', dest='categories', default=True,
+            help='Do not apply auto_catg')
+        parser.add_argument('--no-tags', action='store_false', dest='tags', default=True,
+            help='Do not apply auto_tags')
+
+    def handle(self, *args, **options):
+        counts = backfillSellerDefaults(categories=options['categories'], tags=options['tags'])
+        msg = 'apply_seller_defaults: {categories} categories and {tags} tags added to {expenses} expenses'.format(**counts)
+        logger.info(msg)
+        self.stdout.write(msg)
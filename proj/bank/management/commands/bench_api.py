@@ -0,0 +1,170 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import json
+import logging
+import threading
+import time
+import requests
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from bank.models import *
+
+logger = logging.getLogger('mgmt.bench_api')
+
+SCENARIOS = ('expense-list', 'expense-filter', 'expense-create', 'expense-from-order', 'seller-list')
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of the sorted list values"""
+    if not values:
+        return None
+    k = max(int(round(pct/100.0*len(values) + 0.5)) - 1, 0)
+    return values[min(k, len(values) - 1)]
+
+
+class Command(BaseCommand):
+    help = "Drive the main API endpoints of a running server with concurrent requests and report p50/p95/p99 latency and throughput per scenario as JSON. The ids used in request bodies are read from the local database, which must be the one the server uses (see generate_data)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://localhost:8000/api/v1/', help='API root. Default: http://localhost:8000/api/v1/')
+        parser.add_argument('--token', default='', help='OAuth2 access token')
+        parser.add_argument('--concurrency', type=int, default=8, help='Number of client threads. Default: 8')
+        parser.add_argument('--requests', type=int, default=200, help='Requests per scenario. Default: 200')
+        parser.add_argument('--scenario', action='append', dest='scenarios', choices=SCENARIOS,
+            help='Scenario to run (repeatable). Default: all')
+        parser.add_argument('--output', default='', help='Write the results to this JSON file')
+        parser.add_argument('--label', default='', help='Label stored in the results, e.g. a commit id')
+
+    def handle(self, *args, **options):
+        self.url = options['url'].rstrip('/') + '/'
+        self.headers = {'Accept': 'application/json'}
+        if options['token']:
+            self.headers['Authorization'] = 'Bearer ' + options['token']
+        self.local = threading.local()
+        num = options['requests']
+        concurrency = options['concurrency']
+        self.loadIds()
+        results = {
+            'label': options['label'],
+            'url': self.url,
+            'started': timezone.now().isoformat(),
+            'concurrency': concurrency,
+            'requests': num,
+            'scenarios': {},
+        }
+        for name in options['scenarios'] or SCENARIOS:
+            make = getattr(self, 'request_' + name.replace('-', '_'))
+            reqs = make(num)
+            if not reqs:
+                self.stdout.write('bench_api: {0}: no data, skipped'.format(name))
+                continue
+            stats = self.run(reqs, concurrency)
+            results['scenarios'][name] = stats
+            msg = 'bench_api: {0}: {1} requests, {2} errors, p50 {3}ms, p95 {4}ms, p99 {5}ms, {6} req/s'.format(
+                name, stats['requests'], stats['errors'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms'], stats['throughput_rps'])
+            logger.info(msg)
+            self.stdout.write(msg)
+        out = json.dumps(results, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(out)
+        else:
+            self.stdout.write(out)
+
+    def loadIds(self):
+        self.location_ids = list(Location.objects.order_by('id').values_list('id', flat=True)[:1000])
+        self.account_ids = list(Account.objects.order_by('id').values_list('id', flat=True))
+        self.paytype_ids = list(Paytype.objects.order_by('id').values_list('id', flat=True))
+        self.catg_ids = list(Category.objects.order_by('id').values_list('id', flat=True))
+        self.tag_ids = list(Tag.objects.order_by('id').values_list('id', flat=True))
+        if not (self.location_ids and self.account_ids and self.paytype_ids):
+            raise CommandError('No locations/accounts/paytypes. Run generate_data first.')
+
+    def session(self):
+        s = getattr(self.local, 'session', None)
+        if s is None:
+            s = self.local.session = requests.Session()
+            s.headers.update(self.headers)
+        return s
+
+    def send(self, req):
+        """req: (method, path, json body/None). Returns (seconds, ok)"""
+        method, path, body = req
+        start = time.time()
+        try:
+            r = self.session().request(method, self.url + path, json=body, timeout=60)
+            ok = r.status_code < 400
+            if not ok:
+                logger.debug('bench_api: {0} {1}: {2} {3}'.format(method, path, r.status_code, r.text[:200]))
+        except requests.RequestException as e:
+            logger.warning('bench_api: {0} {1}: {2}'.format(method, path, e))
+            ok = False
+        return time.time() - start, ok
+
+    def run(self, reqs, concurrency):
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            out = list(pool.map(self.send, reqs))
+        elapsed = time.time() - start
+        times = sorted(t*1000 for t, ok in out)
+        ms = lambda v: round(v, 1) if v is not None else None
+        return {
+            'requests': len(out),
+            'errors': sum(1 for t, ok in out if not ok),
+            'elapsed_s': round(elapsed, 3),
+            'throughput_rps': round(len(out)/elapsed, 1) if elapsed else None,
+            'mean_ms': ms(sum(times)/len(times)),
+            'p50_ms': ms(percentile(times, 50)),
+            'p95_ms': ms(percentile(times, 95)),
+            'p99_ms': ms(percentile(times, 99)),
+            'max_ms': ms(times[-1]),
+        }
+
+    #
+    # Scenarios: each returns a list of (method, path, body)
+    #
+    def request_expense_list(self, num):
+        return [('GET', 'expense/', None)]*num
+
+    def request_expense_filter(self, num):
+        end = Expense.objects.order_by('-date_paid').values_list('date_paid', flat=True).first()
+        if end is None:
+            return []
+        reqs = []
+        for i in range(num):
+            start = end - timedelta(days=30*(i % 12 + 1))
+            path = 'expense/?account={0}&date_paid_from={1}&date_paid_to={2}&categories={3}'.format(
+                self.account_ids[i % len(self.account_ids)],
+                start.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                (start + timedelta(days=30)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                self.catg_ids[i % len(self.catg_ids)] if self.catg_ids else '')
+            reqs.append(('GET', path, None))
+        return reqs
+
+    def request_expense_create(self, num):
+        now = timezone.now()
+        reqs = []
+        for i in range(num):
+            body = {
+                'location': self.location_ids[i % len(self.location_ids)],
+                'account': self.account_ids[i % len(self.account_ids)],
+                'paytype': self.paytype_ids[i % len(self.paytype_ids)],
+                'date_paid': (now - timedelta(hours=i)).isoformat(),
+                'amount': '{0}.{1:02d}'.format(1 + i % 200, i % 100),
+                'memo': 'bench_api',
+                'tags': self.tag_ids[i % len(self.tag_ids):][:2] if self.tag_ids else [],
+                'categories': [{'category': self.catg_ids[i % len(self.catg_ids)], 'weight': '1.00'}] if self.catg_ids else [],
+            }
+            reqs.append(('POST', 'expense/', body))
+        return reqs
+
+    def request_expense_from_order(self, num):
+        """Completes up to num open single-shipment orders"""
+        orders = Order.objects.filter(is_complete=False, is_cancelled=False, num_shipments=1
+            ).order_by('id').values_list('id', 'amount')[:num]
+        now = timezone.now().isoformat()
+        return [('POST', 'expense-from-order/', {'order': pk, 'date_paid': now, 'amount': str(amount)})
+            for pk, amount in orders]
+
+    def request_seller_list(self, num):
+        return [('GET', 'seller/', None)]*num
@@ -0,0 +1,195 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+import logging
+import random
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from bank.models import *
+from bank import refcache, reports
+from bank.rollups import rebuildRollups
+
+logger = logging.getLogger('mgmt.generate_data')
+
+CATG_WEIGHTS = (
+    (Decimal('1.00'),),
+    (Decimal('0.50'), Decimal('0.50')),
+    (Decimal('0.60'), Decimal('0.40')),
+    (Decimal('0.50'), Decimal('0.30'), Decimal('0.20')),
+)
+
+class Command(BaseCommand):
+    help = "Generate a deterministic synthetic dataset for load testing: reference rows, sellers with locations, orders (some with multiple shipments), expenses with categories and tags, and incomes. The same --seed and sizes produce the same rows."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--expenses', type=int, default=100000, help='Number of regular expenses. Default: 100000')
+        parser.add_argument('--sellers', type=int, default=1000, help='Number of sellers. Default: 1000')
+        parser.add_argument('--locations', type=int, default=5, help='Locations per seller. Default: 5')
+        parser.add_argument('--orders', type=int, default=10000, help='Number of orders. Default: 10000')
+        parser.add_argument('--incomes', type=int, default=5000, help='Number of incomes. Default: 5000')
+        parser.add_argument('--days', type=int, default=3*365, help='Spread dates over this many days before --end. Default: 1095')
+        parser.add_argument('--end', default='2026-01-01', help='End date YYYY-MM-DD. Default: 2026-01-01')
+        parser.add_argument('--seed', type=int, default=1, help='Random seed. Default: 1')
+        parser.add_argument('--prefix', default='syn', help='Prefix of the generated names, must be unused. Default: syn')
+        parser.add_argument('--username', default='synthetic', help='Owner of the incomes and creator of the rows. Default: synthetic')
+        parser.add_argument('--batch-size', type=int, dest='batch_size', default=BULK_BATCH_SIZE,
+            help='Rows per insert. Default: {0}'.format(BULK_BATCH_SIZE))
+
+    def handle(self, *args, **options):
+        self.rnd = random.Random(options['seed'])
+        self.prefix = options['prefix']
+        self.batch_size = options['batch_size']
+        self.days = options['days']
+        try:
+            end = datetime.strptime(options['end'], '%Y-%m-%d')
+        except ValueError:
+            raise CommandError('Invalid --end date: {0}'.format(options['end']))
+        self.end = timezone.make_aware(end)
+        if Seller.objects.filter(seller_name__startswith=self.prefix + ' ').exists():
+            raise CommandError('Sellers with prefix "{0}" exist. Use another --prefix.'.format(self.prefix))
+        self.user, created = User.objects.get_or_create(username=options['username'])
+        self.created_by = self.user.username[:20]
+
+        with transaction.atomic():
+            self.makeReference()
+            self.makeSellers(options['sellers'], options['locations'])
+            self.makeOrders(options['orders'])
+        self.makeExpenses(options['expenses'])
+        self.makeIncomes(options['incomes'])
+        # the income summaries of the years of the new incomes are stale
+        start = timezone.localtime(self.end - timedelta(days=self.days))
+        reports.invalidateIncomeSummary(range(start.year, timezone.localtime(self.end).year + 1))
+        # bulk_create sends no signals
+        for model in refcache.TRACKED_MODELS:
+            refcache.bumpGeneration(model)
+        counts = rebuildRollups()
+        self.log('rollups: {0}'.format(', '.join('{0}={1}'.format(k, v) for k, v in sorted(counts.items()))))
+
+    def log(self, msg):
+        msg = 'generate_data: ' + msg
+        logger.info(msg)
+        self.stdout.write(msg)
+
+    def randomDate(self):
+        return self.end - timedelta(seconds=self.rnd.randrange(self.days*86400))
+
+    def randomAmount(self, low=1, high=500):
+        return Decimal(self.rnd.randrange(low*100, high*100)) / 100
+
+    def bulkCreate(self, model, objs):
+        return model.objects.bulk_create(objs, batch_size=self.batch_size)
+
+    def makeReference(self):
+        p = self.prefix
+        inst, c = Institution.objects.get_or_create(name='{0} Bank'.format(p), defaults={'abbrev': p.upper()[:20]})
+        self.accounts = [Account.objects.get_or_create(inst=inst, acct_name='{0} Account {1}'.format(p, i),
+            defaults={'acct_number': '{0:08d}'.format(i)})[0] for i in range(1, 7)]
+        self.paytypes = [Paytype.objects.get_or_create(paytype='{0}-pay-{1}'.format(p, i)[:20])[0] for i in range(1, 5)]
+        self.catgs = [Category.objects.get_or_create(catg='{0}-catg-{1:02d}'.format(p, i)[:20])[0] for i in range(1, 21)]
+        self.tags = [Tag.objects.get_or_create(tag='{0}-tag-{1:02d}'.format(p, i)[:20])[0] for i in range(1, 31)]
+        self.sources = [Source.objects.get_or_create(name='{0} Source {1}'.format(p, i),
+            defaults={'abbrev': '{0}-src-{1}'.format(p, i)[:20]})[0] for i in range(1, 4)]
+
+    def makeSellers(self, num_sellers, locs_per_seller):
+        sellers = [Seller(seller_name='{0} Seller {1:07d}'.format(self.prefix, i)) for i in range(num_sellers)]
+        sellers = self.bulkCreate(Seller, sellers)
+        AutoTag = Seller.auto_tags.through
+        links = []
+        for seller in sellers:
+            for tag in self.rnd.sample(self.tags, self.rnd.randint(0, 2)):
+                links.append(AutoTag(seller_id=seller.pk, tag_id=tag.pk))
+        self.bulkCreate(AutoTag, links)
+        locs = []
+        for seller in sellers:
+            for j in range(locs_per_seller):
+                locs.append(Location(seller=seller,
+                    loc_name='{0} #{1}'.format(seller.seller_name, j),
+                    loc_address='{0} Main St'.format(self.rnd.randint(1, 9999))))
+        self.locations = self.bulkCreate(Location, locs)
+        self.log('{0} sellers, {1} locations'.format(len(sellers), len(self.locations)))
+
+    def makeOrders(self, num_orders):
+        """Orders with 1-3 shipments. About 70% are complete, with one
+        expense per shipment. The rest are left for expense-from-order.
+        """
+        orders = []
+        for i in range(num_orders):
+            orders.append(Order(
+                location=self.rnd.choice(self.locations),
+                account=self.rnd.choice(self.accounts),
+                paytype=self.rnd.choice(self.paytypes),
+                order_number='{0}-{1:09d}'.format(self.prefix, i),
+                order_date=self.randomDate(),
+                amount=self.randomAmount(10, 900),
+                num_shipments=self.rnd.choice((1, 1, 1, 2, 3)),
+                is_complete=self.rnd.random() < 0.7
+            ))
+        orders = self.bulkCreate(Order, orders)
+        expenses = []
+        for order in orders:
+            if not order.is_complete:
+                continue
+            n = order.num_shipments
+            share = (order.amount / n).quantize(Decimal('0.01'))
+            for shipment_no in range(1, n + 1):
+                amount = order.amount - share*(n - 1) if shipment_no == n else share
+                expenses.append(Expense(
+                    location_id=order.location_id,
+                    account_id=order.account_id,
+                    paytype_id=order.paytype_id,
+                    order=order,
+                    date_paid=order.order_date + timedelta(days=shipment_no),
+                    amount=amount,
+                    shipment_no=shipment_no if n > 1 else None,
+                    created_by=self.created_by
+                ))
+        self.bulkCreate(Expense, expenses)
+        self.log('{0} orders, {1} order expenses'.format(len(orders), len(expenses)))
+
+    def makeExpenses(self, num):
+        """Regular expenses in transactions of batch_size rows"""
+        TagLink = Expense.tags.through
+        done = 0
+        while done < num:
+            size = min(self.batch_size, num - done)
+            expenses = []
+            for i in range(size):
+                expenses.append(Expense(
+                    location=self.rnd.choice(self.locations),
+                    account=self.rnd.choice(self.accounts),
+                    paytype=self.rnd.choice(self.paytypes),
+                    date_paid=self.randomDate(),
+                    amount=self.randomAmount(),
+                    memo='synthetic {0}'.format(done + i) if self.rnd.random() < 0.2 else '',
+                    created_by=self.created_by
+                ))
+            with transaction.atomic():
+                expenses = self.bulkCreate(Expense, expenses)
+                links = []
+                ecs = []
+                for expense in expenses:
+                    for tag in self.rnd.sample(self.tags, self.rnd.randint(0, 3)):
+                        links.append(TagLink(expense_id=expense.pk, tag_id=tag.pk))
+                    weights = self.rnd.choice(CATG_WEIGHTS)
+                    for catg, weight in zip(self.rnd.sample(self.catgs, len(weights)), weights):
+                        ecs.append(ExpenseCategory(expense_id=expense.pk, category_id=catg.pk, weight=weight))
+                self.bulkCreate(TagLink, links)
+                self.bulkCreate(ExpenseCategory, ecs)
+            done += size
+            if done % (self.batch_size*100) == 0 or done == num:
+                self.log('{0}/{1} expenses'.format(done, num))
+
+    def makeIncomes(self, num):
+        incomes = []
+        for i in range(num):
+            incomes.append(Income(
+                user=self.user,
+                source=self.rnd.choice(self.sources),
+                date_paid=self.randomDate(),
+                amount=self.randomAmount(100, 5000),
+                is_pre_tax=self.rnd.random() < 0.5,
+                created_by=self.created_by
+            ))
+        self.bulkCreate(Income, incomes)
+        self.log('{0} incomes'.format(num))
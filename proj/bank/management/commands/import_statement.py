@@ -0,0 +1,49 @@
+import logging
+import os
+from django.core.management.base import BaseCommand, CommandError
+from bank.models import *
+from bank import statements
+
+logger = logging.getLogger('mgmt.statements')
+
+class Command(BaseCommand):
+    help = "Import a CSV or OFX statement file as expenses of an account. Lines that duplicate existing expenses (same account, date and amount) are skipped. Running the command again for the same file resumes an interrupted import."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Statement file')
+        parser.add_argument('--account', type=int, required=True, help='Account id')
+        parser.add_argument('--paytype', type=int, required=True, help='Paytype id of the created expenses')
+        parser.add_argument('--location', type=int, default=None,
+            help='Location id for lines that cannot be resolved. Default: skip them')
+        parser.add_argument('--filetype', choices=[c[0] for c in StatementImport.FILETYPE_CHOICES], default=None,
+            help='Default: from the file extension')
+        parser.add_argument('--charges-negative', action='store_true', dest='charges_negative', default=False,
+            help='CSV amounts of charges are negative')
+        parser.add_argument('--user', default=ADMIN_USER, help='created_by of the expenses. Default: {0}'.format(ADMIN_USER))
+
+    def handle(self, *args, **options):
+        path = options['path']
+        try:
+            account = Account.objects.get(pk=options['account'])
+            paytype = Paytype.objects.get(pk=options['paytype'])
+            location = Location.objects.get(pk=options['location']) if options['location'] else None
+        except (Account.DoesNotExist, Paytype.DoesNotExist, Location.DoesNotExist) as e:
+            raise CommandError(str(e))
+        filetype = options['filetype']
+        if not filetype:
+            filetype = StatementImport.FILETYPE_OFX if path.lower().endswith(('.ofx', '.qfx')) else StatementImport.FILETYPE_CSV
+        with open(path, 'rb') as f:
+            content = f.read()
+        imp = statements.startImport(account, paytype, content, os.path.basename(path), filetype,
+            options['user'][:20], default_location=location)
+        if imp.num_processed:
+            self.stdout.write('Resuming import {0.pk} after {0.num_processed} lines'.format(imp))
+        try:
+            imp = statements.runImport(imp, content, charges_negative=options['charges_negative'])
+        except statements.StatementError as e:
+            raise CommandError(str(e))
+        msg = 'import_statement: {0.filename}: {0.num_lines} lines, {0.num_created} created, {0.num_duplicates} duplicates, {0.num_unmatched} unmatched'.format(imp)
+        logger.info(msg)
+        self.stdout.write(msg)
+        for description in imp.unmatched:
+            self.stdout.write('  unmatched: {0}'.format(description))
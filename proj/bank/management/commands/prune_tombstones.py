@@ -0,0 +1,22 @@
+import logging
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from bank.sync import pruneTombstones
+
+logger = logging.getLogger('mgmt.sync')
+
+class Command(BaseCommand):
+    help = "Delete the tombstones of deleted rows older than --days. Clients whose last sync is older than that get a full sync (see bank.sync)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.SYNC_TOMBSTONE_DAYS,
+            help='Keep tombstones this many days. Default: SYNC_TOMBSTONE_DAYS ({0})'.format(settings.SYNC_TOMBSTONE_DAYS))
+
+    def handle(self, *args, **options):
+        if options['days'] < settings.SYNC_TOMBSTONE_DAYS:
+            # syncs since the horizon of SYNC_TOMBSTONE_DAYS must see all deletions
+            raise CommandError('--days must be at least SYNC_TOMBSTONE_DAYS ({0})'.format(settings.SYNC_TOMBSTONE_DAYS))
+        num = pruneTombstones(options['days'])
+        msg = 'prune_tombstones: {0} tombstones older than {1} days deleted'.format(num, options['days'])
+        logger.info(msg)
+        self.stdout.write(msg)
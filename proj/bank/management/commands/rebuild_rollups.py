@@ -0,0 +1,32 @@
+import logging
+from django.core.management.base import BaseCommand, CommandError
+from bank.rollups import rebuildRollups, verifyRollups
+
+logger = logging.getLogger('mgmt.rollups')
+
+class Command(BaseCommand):
+    help = "Rebuild the monthly rollup tables from the raw Expense, ExpenseCategory and Income tables, or verify them with --verify."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify',
+            action='store_true',
+            dest='verify',
+            default=False,
+            help='Only compare the rollup tables against the raw tables. Exits with an error if they differ.'
+        )
+
+    def handle(self, *args, **options):
+        if options['verify']:
+            errors = verifyRollups()
+            for msg in errors:
+                logger.warning(msg)
+                self.stdout.write(msg)
+            if errors:
+                raise CommandError('{0} rollup rows differ from the raw tables.'.format(len(errors)))
+            self.stdout.write('Rollups match the raw tables.')
+            return
+        counts = rebuildRollups()
+        for name, num in sorted(counts.items()):
+            msg = 'rebuild_rollups: {0}: {1} rows'.format(name, num)
+            logger.info(msg)
+            self.stdout.write(msg)
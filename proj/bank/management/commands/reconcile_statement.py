@@ -0,0 +1,60 @@
+from decimal import Decimal
+import logging
+from django.core.management.base import BaseCommand, CommandError
+from bank.models import *
+from bank import reconcile, statements
+
+logger = logging.getLogger('mgmt.reconcile')
+
+class Command(BaseCommand):
+    help = "Reconcile a CSV or OFX statement file of an account against its expenses and open orders. Reports the matched, missing and unexpected items, and optionally enters the expenses of the matched orders."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Statement file')
+        parser.add_argument('--account', type=int, required=True, help='Account id')
+        parser.add_argument('--filetype', choices=[c[0] for c in StatementImport.FILETYPE_CHOICES], default=None,
+            help='Default: from the file extension')
+        parser.add_argument('--charges-negative', action='store_true', dest='charges_negative', default=False,
+            help='CSV amounts of charges are negative')
+        parser.add_argument('--date-tolerance', type=int, dest='date_tolerance', default=reconcile.DATE_TOLERANCE_DAYS,
+            help='Days between the statement date and date_paid. Default: {0}'.format(reconcile.DATE_TOLERANCE_DAYS))
+        parser.add_argument('--amount-tolerance', dest='amount_tolerance', default=str(reconcile.AMOUNT_TOLERANCE),
+            help='Default: {0}'.format(reconcile.AMOUNT_TOLERANCE))
+        parser.add_argument('--complete-orders', action='store_true', dest='complete_orders', default=False,
+            help='Enter the expenses of the matched open orders')
+        parser.add_argument('--user', default=ADMIN_USER, help='created_by of the expenses. Default: {0}'.format(ADMIN_USER))
+
+    def handle(self, *args, **options):
+        path = options['path']
+        try:
+            account = Account.objects.get(pk=options['account'])
+        except Account.DoesNotExist as e:
+            raise CommandError(str(e))
+        filetype = options['filetype']
+        if not filetype:
+            filetype = StatementImport.FILETYPE_OFX if path.lower().endswith(('.ofx', '.qfx')) else StatementImport.FILETYPE_CSV
+        with open(path, 'rb') as f:
+            text = f.read().decode('utf-8-sig')
+        try:
+            lines = statements.parseStatement(text, filetype, options['charges_negative'])
+        except statements.StatementError as e:
+            raise CommandError(str(e))
+        result = reconcile.reconcile(account, lines,
+            date_tolerance=options['date_tolerance'], amount_tolerance=Decimal(options['amount_tolerance']))
+        for line, pk in result.matched:
+            self.stdout.write('matched     {0.date} {0.amount:>10} {0.description} -> expense {1}'.format(line, pk))
+        for line, order, shipment_no in result.orders:
+            self.stdout.write('order       {0.date} {0.amount:>10} {0.description} -> order {1} shipment {2}'.format(line, order.pk, shipment_no or 1))
+        for line in result.missing:
+            self.stdout.write('missing     {0.date} {0.amount:>10} {0.description}'.format(line))
+        for pk in result.unexpected:
+            self.stdout.write('unexpected  expense {0}'.format(pk))
+        msg = 'reconcile_statement: {0} lines, {1} matched, {2} orders, {3} missing, {4} unexpected'.format(
+            len(lines), len(result.matched), len(result.orders), len(result.missing), len(result.unexpected))
+        if options['complete_orders']:
+            created, errors = reconcile.completeMatchedOrders(result, options['user'][:20])
+            for line, pk, error in errors:
+                self.stdout.write('order {0}: {1}'.format(pk, error))
+            msg += ', {0} order expenses entered, {1} failed'.format(len(created), len(errors))
+        logger.info(msg)
+        self.stdout.write(msg)
@@ -0,0 +1,254 @@
+"""In-memory index for matching statement descriptors to locations.
+
+Descriptors like "SQ *BLUE BOTTLE 12" or "AMZN MKTP US*2K4AB1" are
+normalized to tokens (processor prefixes, reference numbers and noise
+words removed) and matched against the names of all locations:
+loc_name, seller_name, 'seller_name loc_name' and the LocationAlias rows.
+
+An exact match of the normalized text scores 1. Otherwise the candidates
+are the entries sharing the rarest tokens of the descriptor (or, if no
+token is known, its character trigrams), scored by the idf-weighted
+token overlap combined with the trigram similarity.
+
+The index is process-local. It is refreshed when the generation of
+Location, Seller or LocationAlias changes (see bank.refcache): only the
+rows modified since the last refresh are re-indexed and deleted rows are
+dropped.
+"""
+from collections import defaultdict
+from datetime import timedelta
+import logging
+import math
+import re
+import threading
+from django.db import connection
+from .models import *
+from . import refcache
+
+logger = logging.getLogger('gen.matching')
+
+MIN_SCORE = 0.45 # matches scoring lower are not returned
+ALIAS_BOOST = 0.1 # added to the score of learned aliases
+MAX_CANDIDATES = 500
+TOKEN_WEIGHT = 0.7 # score = TOKEN_WEIGHT*token overlap + (1 - TOKEN_WEIGHT)*trigram similarity
+REFRESH_OVERLAP = timedelta(minutes=5) # re-read rows modified this long before the last refresh
+INDEXED_MODELS = (Location, Seller, LocationAlias)
+
+# payment processor prefixes: "SQ *NAME", "TST* NAME", "PAYPAL *NAME"
+PROCESSOR_PREFIX = re.compile(r'^(SQ|SQU|TST|PAYPAL|PP|SP|IN|PY|BT|DD|GOOGLE|FSP|CKE|POS|ACH)\s*\*\s*')
+NOISE_TOKENS = frozenset((
+    'THE', 'AND', 'INC', 'LLC', 'LTD', 'CO', 'CORP', 'COM', 'WWW', 'US', 'USA',
+    'PURCHASE', 'DEBIT', 'CARD', 'POS', 'RECURRING', 'PAYMENT', 'ONLINE',
+))
+
+
+def normalizeDescriptor(text):
+    """Returns tuple of the significant tokens of a descriptor or name"""
+    text = PROCESSOR_PREFIX.sub('', (text or '').upper().strip())
+    text = text.replace("'", '')
+    tokens = re.split(r'[^0-9A-Z]+', text)
+    # tokens with digits are store numbers, dates and references
+    return tuple(t for t in tokens if t and t not in NOISE_TOKENS and not any(c.isdigit() for c in t))
+
+
+def trigrams(tokens):
+    grams = set()
+    for t in tokens:
+        t = ' {0} '.format(t)
+        grams.update(t[i:i+3] for i in range(len(t) - 2))
+    return grams
+
+
+class Match(object):
+    __slots__ = ('location_id', 'seller_id', 'score', 'name')
+
+    def __init__(self, location_id, seller_id, score, name):
+        self.location_id = location_id
+        self.seller_id = seller_id
+        self.score = score
+        self.name = name
+
+
+class DescriptorIndex(object):
+    """Entries are keyed by (kind, id, variant): ('loc', location id, n) for
+    the names of a location and ('alias', alias id, 0) for an alias.
+    """
+    def __init__(self):
+        self.entries = {} # key: (location_id, seller_id, tokens, grams, boost, rank, name)
+        self.exact = defaultdict(set) # normalized text: set of keys
+        self.token_postings = defaultdict(set) # token: set of keys
+        self.gram_postings = defaultdict(set) # trigram: set of keys
+        self.generations = None
+        self.built = None # database time of the last refresh
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    #
+    # Maintenance
+    #
+    def addEntry(self, key, location_id, seller_id, name, boost, rank):
+        tokens = normalizeDescriptor(name)
+        if not tokens:
+            return
+        grams = trigrams(tokens)
+        self.entries[key] = (location_id, seller_id, frozenset(tokens), grams, boost, rank, name)
+        self.exact[' '.join(tokens)].add(key)
+        for t in set(tokens):
+            self.token_postings[t].add(key)
+        for g in grams:
+            self.gram_postings[g].add(key)
+
+    def removeEntry(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        tokens, grams = entry[2], entry[3]
+        text = ' '.join(normalizeDescriptor(entry[6]))
+        self.exact[text].discard(key)
+        if not self.exact[text]:
+            del self.exact[text]
+        for postings, values in ((self.token_postings, tokens), (self.gram_postings, grams)):
+            for v in values:
+                postings[v].discard(key)
+                if not postings[v]:
+                    del postings[v]
+
+    def indexLocation(self, loc, seller_name):
+        for n in range(3):
+            self.removeEntry(('loc', loc.pk, n))
+        names = (seller_name, loc.loc_name, '{0} {1}'.format(seller_name, loc.loc_name))
+        for n, name in enumerate(names):
+            self.addEntry(('loc', loc.pk, n), loc.pk, loc.seller_id, name, 0, loc.rank)
+
+    def indexAlias(self, alias, loc):
+        self.removeEntry(('alias', alias.pk, 0))
+        if loc is not None:
+            self.addEntry(('alias', alias.pk, 0), loc.pk, loc.seller_id, alias.alias, ALIAS_BOOST, loc.rank)
+
+    def refresh(self, generations):
+        """Re-index the rows modified since the last refresh and drop the
+        deleted rows (all rows on the first call).
+        """
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT CURRENT_TIMESTAMP')
+            now = cursor.fetchone()[0]
+        since = self.built - REFRESH_OVERLAP if self.built else None
+        locations = refcache.objects(Location)
+        # deleted rows
+        alias_ids = set(LocationAlias.objects.values_list('id', flat=True))
+        for key in list(self.entries):
+            kind, pk = key[0], key[1]
+            if (kind == 'loc' and pk not in locations) or (kind == 'alias' and pk not in alias_ids):
+                self.removeEntry(key)
+        # modified rows
+        if since is None:
+            changed = list(locations.values())
+        else:
+            seller_ids = set(Seller.objects.filter(modified__gte=since).values_list('id', flat=True))
+            changed = [m for m in locations.values() if m.modified >= since or m.seller_id in seller_ids]
+        if changed:
+            seller_names = dict(Seller.objects.filter(id__in=set(m.seller_id for m in changed)
+                ).values_list('id', 'seller_name'))
+            for loc in changed:
+                self.indexLocation(loc, seller_names.get(loc.seller_id, ''))
+        aliases = LocationAlias.objects.all()
+        if since is not None:
+            changed_ids = set(m.pk for m in changed)
+            aliases = aliases.filter(models.Q(modified__gte=since) | models.Q(location_id__in=changed_ids))
+        num_aliases = 0
+        for alias in aliases:
+            self.indexAlias(alias, locations.get(alias.location_id))
+            num_aliases += 1
+        if not connection.in_atomic_block:
+            # refresh again outside of a transaction that could be rolled back
+            self.generations = generations
+        self.built = now
+        logger.debug('DescriptorIndex: re-indexed {0} locations, {1} aliases; {2} entries'.format(
+            len(changed), num_aliases, len(self.entries)))
+
+    #
+    # Matching
+    #
+    def idf(self, token):
+        df = len(self.token_postings.get(token, ()))
+        return math.log((len(self.entries) + 1.0)/(df + 1.0)) + 1.0
+
+    def candidates(self, tokens, grams):
+        """Returns set of keys sharing the rarest tokens, or trigrams if
+        no token is indexed.
+        """
+        keys = set()
+        known = sorted((t for t in set(tokens) if t in self.token_postings),
+            key=lambda t: len(self.token_postings[t]))
+        for t in known:
+            if len(keys) >= MAX_CANDIDATES:
+                break
+            keys.update(self.token_postings[t])
+        if keys:
+            return keys
+        counts = defaultdict(int)
+        for g in grams:
+            for key in self.gram_postings.get(g, ()):
+                counts[key] += 1
+        need = max(2, len(grams)//3)
+        ranked = sorted((n, key) for key, n in counts.items() if n >= need)
+        return set(key for n, key in ranked[-MAX_CANDIDATES:])
+
+    def score(self, tokens, grams, entry):
+        e_tokens, e_grams = entry[2], entry[3]
+        union = tokens | e_tokens
+        token_score = sum(self.idf(t) for t in tokens & e_tokens)/sum(self.idf(t) for t in union)
+        gram_score = 2.0*len(grams & e_grams)/(len(grams) + len(e_grams))
+        return TOKEN_WEIGHT*token_score + (1 - TOKEN_WEIGHT)*gram_score + entry[4]
+
+    def match(self, descriptor):
+        """Returns the best Match for descriptor or None"""
+        tokens = normalizeDescriptor(descriptor)
+        if not tokens:
+            return None
+        keys = self.exact.get(' '.join(tokens))
+        if keys:
+            best = min((self.entries[k] for k in keys), key=lambda e: (-e[4], e[5], e[0]))
+            return Match(best[0], best[1], 1.0, best[6])
+        tokens = frozenset(tokens)
+        grams = trigrams(tokens)
+        best = None
+        best_key = None
+        for key in self.candidates(tokens, grams):
+            entry = self.entries[key]
+            s = self.score(tokens, grams, entry)
+            sort_key = (-s, entry[5], entry[0])
+            if best_key is None or sort_key < best_key:
+                best, best_key = (entry, s), sort_key
+        if best is None or best[1] < MIN_SCORE:
+            return None
+        entry, s = best
+        return Match(entry[0], entry[1], round(min(s, 1.0), 3), entry[6])
+
+    def matchMany(self, descriptors):
+        """Returns list of Match/None. Repeated descriptors are matched once."""
+        seen = {}
+        out = []
+        with self.lock:
+            for d in descriptors:
+                if d not in seen:
+                    seen[d] = self.match(d)
+                out.append(seen[d])
+        return out
+
+
+_index = DescriptorIndex()
+
+def getIndex():
+    """Returns the process DescriptorIndex, refreshed if the generation of
+    Location, Seller or LocationAlias has changed.
+    """
+    gens = refcache.currentGenerations()
+    current = tuple(gens.get(refcache.generationName(m), 0) for m in INDEXED_MODELS)
+    if _index.generations != current:
+        with _index.lock:
+            if _index.generations != current:
+                _index.refresh(current)
+    return _index
@@ -0,0 +1,106 @@
+from contextlib import contextmanager
+import logging
+import time
+from django.conf import settings
+from django.db import connection
+from django.db.backends.utils import CursorWrapper
+
+logger = logging.getLogger('api.timing')
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class CountingCursorWrapper(CursorWrapper):
+    """Counts and times the queries run with a cursor, without keeping their
+    SQL. Wraps the cursor Django would have used (a CursorDebugWrapper when
+    queries are logged).
+    """
+    def __init__(self, cursor, db, stats):
+        super(CountingCursorWrapper, self).__init__(cursor, db)
+        self.stats = stats
+
+    def timed(self, method, *args):
+        start = time.time()
+        try:
+            return method(*args)
+        finally:
+            self.stats['queries'] += 1
+            self.stats['db'] += time.time() - start
+
+    def execute(self, sql, params=None):
+        return self.timed(super(CountingCursorWrapper, self).execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        return self.timed(super(CountingCursorWrapper, self).executemany, sql, param_list)
+
+    def callproc(self, procname, params=None):
+        return self.timed(super(CountingCursorWrapper, self).callproc, procname, params)
+
+
+@contextmanager
+def countQueries(stats):
+    """Within the block, the cursors of the default connection of this
+    thread count their queries in stats {'queries': int, 'db': seconds}.
+    """
+    make_cursor = connection.make_cursor
+    make_debug_cursor = connection.make_debug_cursor
+    connection.make_cursor = lambda cursor: CountingCursorWrapper(make_cursor(cursor), connection, stats)
+    connection.make_debug_cursor = lambda cursor: CountingCursorWrapper(make_debug_cursor(cursor), connection, stats)
+    try:
+        yield stats
+    finally:
+        # remove the instance attributes
+        del connection.make_cursor
+        del connection.make_debug_cursor
+
+
+class ServerTimingMiddleware(object):
+    """Records the query count, DB time, serialization time and total time of
+    each API request and returns them in a Server-Timing header:
+        Server-Timing: db;dur=3.1;desc="4 queries", serialize;dur=0.8, app;dur=5.2, total;dur=9.1
+    Requests over API_QUERY_BUDGET queries (or the query_budget attribute of
+    the view class) or over API_LATENCY_BUDGET_MS are logged. If
+    API_QUERY_BUDGET_STRICT is True (for tests), exceeding the query budget
+    raises QueryBudgetExceeded.
+    Queries are counted by wrapping the cursors of the request (see
+    countQueries); their SQL is not kept.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not request.path.startswith(settings.API_PATH_PREFIX):
+            return self.get_response(request)
+        request.server_timing = {}
+        start = time.time()
+        with countQueries({'queries': 0, 'db': 0.0}) as stats:
+            response = self.get_response(request)
+        total = (time.time() - start)*1000
+        num_queries = stats['queries']
+        db = stats['db']*1000
+        serialize = request.server_timing.get('serialize', 0)
+        app = max(total - db - serialize, 0)
+        response['Server-Timing'] = ', '.join([
+            'db;dur={0:.1f};desc="{1} queries"'.format(db, num_queries),
+            'serialize;dur={0:.1f}'.format(serialize),
+            'app;dur={0:.1f}'.format(app),
+            'total;dur={0:.1f}'.format(total),
+        ])
+        budget = self.queryBudget(request)
+        msg = '{0} {1} {2}: {3} queries, db {4:.1f}ms, serialize {5:.1f}ms, total {6:.1f}ms'.format(
+            request.method, request.get_full_path(), response.status_code, num_queries, db, serialize, total)
+        if num_queries > budget:
+            logger.warning('Over query budget of {0}: {1}'.format(budget, msg))
+            if settings.API_QUERY_BUDGET_STRICT:
+                raise QueryBudgetExceeded('Over query budget of {0}: {1}'.format(budget, msg))
+        elif total > settings.API_LATENCY_BUDGET_MS:
+            logger.warning('Over latency budget of {0}ms: {1}'.format(settings.API_LATENCY_BUDGET_MS, msg))
+        return response
+
+    def queryBudget(self, request):
+        """query_budget of the view class, or API_QUERY_BUDGET"""
+        match = getattr(request, 'resolver_match', None)
+        view_class = getattr(match.func, 'view_class', None) if match else None
+        return getattr(view_class, 'query_budget', None) or settings.API_QUERY_BUDGET
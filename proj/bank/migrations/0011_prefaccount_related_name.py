@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-18 09:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bank', '0010_remove_seller_pref_accounts'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='preferredaccount',
+            name='seller',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pref_accounts', to='bank.Seller'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-18 09:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bank', '0011_prefaccount_related_name'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='income',
+            index=models.Index(fields=['-date_paid', '-id'], name='bank_income_paid_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['-modified', '-id'], name='bank_order_modified_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['-created', '-id'], name='bank_expense_created_id_idx'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-18 10:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bank', '0012_cursor_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='expense',
+            name='date_paid',
+            field=models.DateTimeField(db_index=True),
+        ),
+    ]
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-18 11:20
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('bank', '0013_expense_date_paid_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExpenseMonth',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(help_text='First day of the month in TIME_ZONE', unique=True)),
+                ('amount', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('unallocated', models.DecimalField(decimal_places=4, default=0, help_text='Part of amount not covered by category weights', max_digits=14)),
+                ('num', models.IntegerField(default=0, help_text='Number of expenses')),
+            ],
+            options={
+                'ordering': ['-month'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ExpenseAccountMonth',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(help_text='First day of the month in TIME_ZONE')),
+                ('amount', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('num', models.IntegerField(default=0, help_text='Number of expenses')),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='expense_months', to='bank.Account')),
+            ],
+            options={
+                'ordering': ['-month', 'account'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ExpenseLocationMonth',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(help_text='First day of the month in TIME_ZONE')),
+                ('amount', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('num', models.IntegerField(default=0, help_text='Number of expenses')),
+                ('location', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='expense_months', to='bank.Location')),
+            ],
+            options={
+                'ordering': ['-month', 'location'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ExpenseCategoryMonth',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(help_text='First day of the month in TIME_ZONE')),
+                ('amount', models.DecimalField(decimal_places=4, default=0, help_text='Sum of expense amount * category weight', max_digits=14)),
+                ('num', models.IntegerField(default=0, help_text='Number of expense-category rows')),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='expense_months', to='bank.Category')),
+            ],
+            options={
+                'ordering': ['-month', 'category'],
+            },
+        ),
+        migrations.CreateModel(
+            name='IncomeMonth',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(help_text='First day of the month in TIME_ZONE')),
+                ('amount', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('pre_tax_amount', models.DecimalField(decimal_places=2, default=0, help_text='Part of amount that is pre-tax', max_digits=12)),
+                ('num', models.IntegerField(default=0, help_text='Number of incomes')),
+                ('source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='income_months', to='bank.Source')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='income_months', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-month', 'user', 'source'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='expenseaccountmonth',
+            unique_together=set([('account', 'month')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='expenselocationmonth',
+            unique_together=set([('location', 'month')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='expensecategorymonth',
+            unique_together=set([('category', 'month')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='incomemonth',
+            unique_together=set([('user', 'source', 'month')]),
+        ),
+    ]
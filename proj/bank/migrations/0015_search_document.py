@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-18 12:30
+from __future__ import unicode_literals
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import TrigramExtension
+import django.contrib.postgres.search
+from django.db import migrations, models
+
+# The search document (search_text, search_vector) of Seller, Order and
+# Expense is set by BEFORE INSERT/UPDATE triggers from the row and its
+# related seller/location/order. Changes to the related rows reset
+# search_text of the dependent rows, which fires their trigger again.
+#   Seller:  seller_name, location names/addresses (A), memo (C)
+#   Order:   seller name, location name/address (A), order_number (B), memo (C)
+#   Expense: seller name, location name/address (A), invoiceid, order_number (B), memo (C)
+
+SEARCH_TRIGGERS_SQL = """
+CREATE OR REPLACE FUNCTION bank_seller_search_update() RETURNS trigger AS $$
+DECLARE
+    names text;
+BEGIN
+    SELECT string_agg(concat_ws(' ', l.loc_name, l.loc_address), ' ') INTO names
+      FROM bank_location l WHERE l.seller_id = NEW.id;
+    names := concat_ws(' ', NEW.seller_name, names);
+    NEW.search_text := concat_ws(' ', names, NEW.memo);
+    NEW.search_vector :=
+        setweight(to_tsvector('english', coalesce(names, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(NEW.memo, '')), 'C');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION bank_order_search_update() RETURNS trigger AS $$
+DECLARE
+    names text;
+BEGIN
+    SELECT concat_ws(' ', s.seller_name, l.loc_name, l.loc_address) INTO names
+      FROM bank_location l JOIN bank_seller s ON s.id = l.seller_id
+     WHERE l.id = NEW.location_id;
+    NEW.search_text := concat_ws(' ', names, NEW.order_number, NEW.memo);
+    NEW.search_vector :=
+        setweight(to_tsvector('english', coalesce(names, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(NEW.order_number, '')), 'B') ||
+        setweight(to_tsvector('english', coalesce(NEW.memo, '')), 'C');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION bank_expense_search_update() RETURNS trigger AS $$
+DECLARE
+    names text;
+    refs text;
+BEGIN
+    SELECT concat_ws(' ', s.seller_name, l.loc_name, l.loc_address) INTO names
+      FROM bank_location l JOIN bank_seller s ON s.id = l.seller_id
+     WHERE l.id = NEW.location_id;
+    refs := NEW.invoiceid;
+    IF NEW.order_id IS NOT NULL THEN
+        SELECT concat_ws(' ', refs, o.order_number) INTO refs
+          FROM bank_order o WHERE o.id = NEW.order_id;
+    END IF;
+    NEW.search_text := concat_ws(' ', names, refs, NEW.memo);
+    NEW.search_vector :=
+        setweight(to_tsvector('english', coalesce(names, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(refs, '')), 'B') ||
+        setweight(to_tsvector('english', coalesce(NEW.memo, '')), 'C');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER bank_seller_search BEFORE INSERT OR UPDATE OF seller_name, memo, search_text
+    ON bank_seller FOR EACH ROW EXECUTE PROCEDURE bank_seller_search_update();
+CREATE TRIGGER bank_order_search BEFORE INSERT OR UPDATE OF location_id, order_number, memo, search_text
+    ON bank_order FOR EACH ROW EXECUTE PROCEDURE bank_order_search_update();
+CREATE TRIGGER bank_expense_search BEFORE INSERT OR UPDATE OF location_id, order_id, invoiceid, memo, search_text
+    ON bank_expense FOR EACH ROW EXECUTE PROCEDURE bank_expense_search_update();
+
+-- propagate changes of related rows
+CREATE OR REPLACE FUNCTION bank_seller_search_propagate() RETURNS trigger AS $$
+BEGIN
+    UPDATE bank_order SET search_text = ''
+     WHERE location_id IN (SELECT id FROM bank_location WHERE seller_id = NEW.id);
+    UPDATE bank_expense SET search_text = ''
+     WHERE location_id IN (SELECT id FROM bank_location WHERE seller_id = NEW.id);
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION bank_location_search_propagate() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE bank_seller SET search_text = '' WHERE id = NEW.seller_id;
+        RETURN NULL;
+    END IF;
+    IF TG_OP = 'DELETE' THEN
+        UPDATE bank_seller SET search_text = '' WHERE id = OLD.seller_id;
+        RETURN NULL;
+    END IF;
+    IF OLD.loc_name IS DISTINCT FROM NEW.loc_name
+        OR OLD.loc_address IS DISTINCT FROM NEW.loc_address
+        OR OLD.seller_id IS DISTINCT FROM NEW.seller_id THEN
+        UPDATE bank_seller SET search_text = '' WHERE id IN (OLD.seller_id, NEW.seller_id);
+        UPDATE bank_order SET search_text = '' WHERE location_id = NEW.id;
+        UPDATE bank_expense SET search_text = '' WHERE location_id = NEW.id;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION bank_order_search_propagate() RETURNS trigger AS $$
+BEGIN
+    UPDATE bank_expense SET search_text = '' WHERE order_id = NEW.id;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER bank_seller_search_propagate AFTER UPDATE OF seller_name ON bank_seller
+    FOR EACH ROW WHEN (OLD.seller_name IS DISTINCT FROM NEW.seller_name)
+    EXECUTE PROCEDURE bank_seller_search_propagate();
+CREATE TRIGGER bank_location_search_propagate AFTER INSERT OR UPDATE OR DELETE ON bank_location
+    FOR EACH ROW EXECUTE PROCEDURE bank_location_search_propagate();
+CREATE TRIGGER bank_order_search_propagate AFTER UPDATE OF order_number ON bank_order
+    FOR EACH ROW WHEN (OLD.order_number IS DISTINCT FROM NEW.order_number)
+    EXECUTE PROCEDURE bank_order_search_propagate();
+
+-- substring matches (icontains compiles to UPPER(col) LIKE UPPER(%s))
+CREATE INDEX bank_seller_search_trgm ON bank_seller USING gin (UPPER(search_text) gin_trgm_ops);
+CREATE INDEX bank_order_search_trgm ON bank_order USING gin (UPPER(search_text) gin_trgm_ops);
+CREATE INDEX bank_expense_search_trgm ON bank_expense USING gin (UPPER(search_text) gin_trgm_ops);
+
+-- build the documents of the existing rows
+UPDATE bank_seller SET search_text = '';
+UPDATE bank_order SET search_text = '';
+UPDATE bank_expense SET search_text = '';
+"""
+
+DROP_SEARCH_TRIGGERS_SQL = """
+DROP INDEX IF EXISTS bank_seller_search_trgm;
+DROP INDEX IF EXISTS bank_order_search_trgm;
+DROP INDEX IF EXISTS bank_expense_search_trgm;
+DROP TRIGGER IF EXISTS bank_seller_search_propagate ON bank_seller;
+DROP TRIGGER IF EXISTS bank_location_search_propagate ON bank_location;
+DROP TRIGGER IF EXISTS bank_order_search_propagate ON bank_order;
+DROP TRIGGER IF EXISTS bank_seller_search ON bank_seller;
+DROP TRIGGER IF EXISTS bank_order_search ON bank_order;
+DROP TRIGGER IF EXISTS bank_expense_search ON bank_expense;
+DROP FUNCTION IF EXISTS bank_seller_search_propagate();
+DROP FUNCTION IF EXISTS bank_location_search_propagate();
+DROP FUNCTION IF EXISTS bank_order_search_propagate();
+DROP FUNCTION IF EXISTS bank_seller_search_update();
+DROP FUNCTION IF EXISTS bank_order_search_update();
+DROP FUNCTION IF EXISTS bank_expense_search_update();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bank', '0014_monthly_rollups'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddField(
+            model_name='seller',
+            name='search_text',
+            field=models.TextField(blank=True, default='', editable=False, help_text='Search document. Set by a database trigger (see migration 0015).'),
+        ),
+        migrations.AddField(
+            model_name='seller',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='search_text',
+            field=models.TextField(blank=True, default='', editable=False, help_text='Search document. Set by a database trigger (see migration 0015).'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='expense',
+            name='search_text',
+            field=models.TextField(blank=True, default='', editable=False, help_text='Search document. Set by a database trigger (see migration 0015).'),
+        ),
+        migrations.AddField(
+            model_name='expense',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='seller',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='bank_seller_search_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='bank_order_search_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='expense',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='bank_expense_search_idx'),
+        ),
+        migrations.RunSQL(SEARCH_TRIGGERS_SQL, DROP_SEARCH_TRIGGERS_SQL),
+    ]
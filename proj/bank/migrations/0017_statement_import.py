@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-18 14:05
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bank', '0016_generation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatementImport',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('filename', models.CharField(blank=True, default='', max_length=200)),
+                ('filetype', models.CharField(choices=[('csv', 'CSV'), ('ofx', 'OFX')], default='csv', max_length=10)),
+                ('sha256', models.CharField(max_length=64)),
+                ('status', models.CharField(choices=[('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='running', max_length=10)),
+                ('error', models.TextField(blank=True, default='')),
+                ('num_lines', models.IntegerField(default=0, help_text='Number of charges in the file')),
+                ('num_processed', models.IntegerField(default=0)),
+                ('num_created', models.IntegerField(default=0)),
+                ('num_duplicates', models.IntegerField(default=0)),
+                ('num_unmatched', models.IntegerField(default=0)),
+                ('unmatched', django.contrib.postgres.fields.ArrayField(base_field=models.TextField(), blank=True, default=list, help_text='Sample of the descriptions that could not be resolved to a location', size=None)),
+                ('created_by', models.CharField(max_length=20)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='statement_imports', to='bank.Account')),
+                ('default_location', models.ForeignKey(blank=True, help_text='Location of the lines that cannot be resolved. If null, they are skipped.', null=True, on_delete=django.db.models.deletion.SET_NULL, to='bank.Location')),
+                ('paytype', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='bank.Paytype')),
+            ],
+            options={
+                'ordering': ['-created'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='statementimport',
+            unique_together=set([('account', 'sha256')]),
+        ),
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['account', 'date_paid', 'amount'], name='bank_expense_acct_paid_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-18 14:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bank', '0017_statement_import'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LocationAlias',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('alias', models.CharField(help_text='Statement descriptor, e.g. AMZN MKTP US', max_length=100, unique=True)),
+                ('created_by', models.CharField(blank=True, default='', max_length=20)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('location', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='aliases', to='bank.Location')),
+            ],
+            options={
+                'verbose_name_plural': 'LocationAliases',
+                'ordering': ['alias'],
+            },
+        ),
+    ]
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-18 15:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+# Clean up the existing rows, count the shipments, then enforce in the database:
+#  - at most one expense per order and shipment (a single-shipment order
+#    has shipment_no NULL, counted as shipment 1)
+#  - shipment numbers start at 1
+#  - an order has 1 or more shipments and no more received than it has
+# The expenses of an order with duplicate or invalid shipment numbers are
+# renumbered 1..n by (date_paid, id), and an order with more expenses than
+# num_shipments gets num_shipments raised to their number.
+SHIPMENT_CONSTRAINTS_SQL = """
+UPDATE bank_expense e SET shipment_no = r.no
+    FROM (SELECT id, row_number() OVER (PARTITION BY order_id ORDER BY date_paid, id) AS no
+        FROM bank_expense
+        WHERE order_id IN (SELECT order_id FROM bank_expense WHERE order_id IS NOT NULL
+            GROUP BY order_id
+            HAVING count(*) > count(DISTINCT COALESCE(shipment_no, 1)) OR min(COALESCE(shipment_no, 1)) < 1)
+    ) r
+    WHERE e.id = r.id;
+UPDATE bank_order o SET shipments_received =
+    (SELECT count(*) FROM bank_expense e WHERE e.order_id = o.id);
+UPDATE bank_order SET num_shipments = GREATEST(shipments_received, 1)
+    WHERE num_shipments < GREATEST(shipments_received, 1);
+CREATE UNIQUE INDEX bank_expense_order_shipment_uniq
+    ON bank_expense (order_id, COALESCE(shipment_no, 1)) WHERE order_id IS NOT NULL;
+ALTER TABLE bank_expense ADD CONSTRAINT bank_expense_shipment_no_check
+    CHECK (shipment_no IS NULL OR shipment_no >= 1);
+ALTER TABLE bank_order ADD CONSTRAINT bank_order_shipments_check
+    CHECK (num_shipments >= 1 AND shipments_received <= num_shipments);
+"""
+
+DROP_SHIPMENT_CONSTRAINTS_SQL = """
+ALTER TABLE bank_order DROP CONSTRAINT IF EXISTS bank_order_shipments_check;
+ALTER TABLE bank_expense DROP CONSTRAINT IF EXISTS bank_expense_shipment_no_check;
+DROP INDEX IF EXISTS bank_expense_order_shipment_uniq;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bank', '0018_location_alias'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='shipments_received',
+            field=models.PositiveSmallIntegerField(default=0, editable=False, help_text='Number of shipments with an expense. Maintained by ExpenseManager.'),
+        ),
+        migrations.RunSQL(SHIPMENT_CONSTRAINTS_SQL, DROP_SHIPMENT_CONSTRAINTS_SQL),
+    ]
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-18 17:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bank', '0019_order_shipments_received'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Tombstone',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(help_text='model_name', max_length=40)),
+                ('object_id', models.IntegerField()),
+                ('deleted', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='tombstone',
+            index=models.Index(fields=['deleted', 'id'], name='bank_tombstone_deleted_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='income',
+            index=models.Index(fields=['modified', 'id'], name='bank_income_modified_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='seller',
+            index=models.Index(fields=['modified', 'id'], name='bank_seller_modified_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='location',
+            index=models.Index(fields=['modified', 'id'], name='bank_location_modified_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['modified', 'id'], name='bank_expense_modified_id_idx'),
+        ),
+    ]
@@ -0,0 +1,279 @@
+from calendar import timegm
+import hashlib
+import logging
+from django.db.models import F, prefetch_related_objects
+from django.http import HttpResponseNotModified
+from django.utils.http import http_date, parse_http_date_safe
+from rest_framework import permissions
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+from . import refcache
+from .serializers import EXPAND_SERIALIZERS, CompiledSerializerMixin
+
+logger = logging.getLogger('api.mixins')
+
+class ConditionalGetMixin(object):
+    """Strong ETag for the list and retrieve actions, and Last-Modified for
+    retrieve. If-None-Match/If-Modified-Since are answered with 304 before
+    anything is serialized. The validators are:
+        list: pk and modified_field of the rows of the page (and whether
+            there is a next/previous page). They are computed from the rows
+            loaded for the page, without another query; the prefetches of
+            the queryset run only when the page is serialized. A deletion does not
+            change max(modified), so If-Modified-Since is ignored for lists.
+        retrieve: pk and modified of the row (all field values for a model
+            without a modified field)
+    Writes to ExpenseCategory/Expense.tags and PreferredAccount/Seller.auto_tags
+    touch the modified field of the expense/seller (see bank.signals).
+    """
+    modified_field = 'modified' # None if the model has no modified timestamp
+
+    def makeEtag(self, tag):
+        """Strong ETag for the validator string tag, varying with the URL and the renderer"""
+        request = self.request
+        renderer = getattr(request, 'accepted_renderer', None)
+        key = '|'.join((request.get_full_path(), getattr(renderer, 'format', ''), tag))
+        return '"{0}"'.format(hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def isNotModified(self, etag, last_modified):
+        """Args:
+            etag: str quoted etag
+            last_modified: int timestamp/None
+        Returns: True if the conditional request headers match
+        """
+        meta = self.request.META
+        if_none_match = meta.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            etags = [t.strip() for t in if_none_match.split(',')]
+            etags = [t[2:] if t.startswith('W/') else t for t in etags]
+            return '*' in etags or etag in etags
+        if_modified_since = parse_http_date_safe(meta.get('HTTP_IF_MODIFIED_SINCE', ''))
+        if if_modified_since is not None and last_modified is not None:
+            return last_modified <= if_modified_since
+        return False
+
+    def conditionalResponse(self, tag, last_modified, build):
+        """Returns 304 if the request validators match, else the response of build()
+        Args:
+            tag: str validator
+            last_modified: datetime/None
+            build: callable returning the full response
+        """
+        etag = self.makeEtag(tag)
+        timestamp = timegm(last_modified.utctimetuple()) if last_modified else None
+        if self.isNotModified(etag, timestamp):
+            response = HttpResponseNotModified()
+        else:
+            response = build()
+            if response.status_code != 200:
+                return response
+        response['ETag'] = etag
+        if timestamp is not None:
+            response['Last-Modified'] = http_date(timestamp)
+        return response
+
+    def listValidators(self, rows):
+        """Returns tag:str for the rows of a page (or of the whole list if
+        it is not paginated). A modified_field of a related model is read
+        from the validator_modified annotation (see list).
+        """
+        attr = self.modified_field
+        if attr and '__' in attr:
+            attr = 'validator_modified'
+        keys = []
+        for m in rows:
+            last = getattr(m, attr) if attr else None
+            keys.append('{0}:{1}'.format(m.pk, last.isoformat() if last else ''))
+        paginator = self.paginator
+        pages = '{0}:{1}'.format(getattr(paginator, 'has_next', ''), getattr(paginator, 'has_previous', ''))
+        return '{0}|{1}'.format(pages, ','.join(keys))
+
+    def objectValidators(self, instance):
+        """Returns (tag:str, last_modified:datetime/None) for the instance"""
+        last = getattr(instance, 'modified', None)
+        if last is not None:
+            return '{0}:{1}'.format(instance.pk, last.isoformat()), last
+        fields = instance._meta.concrete_fields
+        return ':'.join(str(getattr(instance, f.attname)) for f in fields), None
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        if self.modified_field and '__' in self.modified_field:
+            queryset = queryset.annotate(validator_modified=F(self.modified_field))
+        # prefetched in build(), not for a 304
+        lookups = queryset._prefetch_related_lookups
+        queryset = queryset.prefetch_related(None)
+        page = self.paginate_queryset(queryset)
+        rows = page if page is not None else list(queryset)
+        tag = self.listValidators(rows)
+
+        def build():
+            if lookups:
+                prefetch_related_objects(rows, *lookups)
+            serializer = self.get_serializer(rows, many=True)
+            if page is not None:
+                return self.get_paginated_response(serializer.data)
+            return Response(serializer.data)
+
+        return self.conditionalResponse(tag, None, build)
+
+    def retrieve(self, request, *args, **kwargs):
+        instance = self.get_object()
+        tag, last = self.objectValidators(instance)
+        build = lambda: Response(self.get_serializer(instance).data)
+        return self.conditionalResponse(tag, last, build)
+
+
+class CachedListMixin(ConditionalGetMixin):
+    """List action of a reference table that is served from bank.refcache
+    (the rows ordered by id). For list views without filters or pagination.
+    The ETag is derived from the cached rows, so a 304 costs no query
+    beyond the per-request generation check.
+    """
+    def list(self, request, *args, **kwargs):
+        model = self.get_queryset().model
+        objs = list(refcache.objects(model).values())
+        generation = refcache.currentGenerations().get(refcache.generationName(model), 0)
+        last = max([m.modified for m in objs]) if objs else None
+        tag = 'gen:{0}:{1}:{2}'.format(generation, len(objs), last.isoformat() if last else '')
+        build = lambda: Response(self.get_serializer(objs, many=True).data)
+        # no Last-Modified: a deletion does not change max(modified)
+        return self.conditionalResponse(tag, None, build)
+
+
+class SparseFieldsMixin(object):
+    """Sparse fieldsets for the list and retrieve actions:
+        ?fields=id,date_paid,amount returns only these fields
+        ?omit=categories,tags returns all fields except these
+    With a CompiledSerializerMixin serializer, the queryset loads only the
+    columns of the fields returned (plus pk, ordering and modified) and the
+    prefetches of the relations not returned are dropped.
+    """
+    fields_param = 'fields'
+    omit_param = 'omit'
+
+    def paramNames(self, param):
+        value = self.request.query_params.get(param, '')
+        return [n.strip() for n in value.split(',') if n.strip()]
+
+    def sparseFields(self):
+        """Returns frozenset of the field names to return, or None for all
+        fields. Raises ValidationError for unknown field names.
+        """
+        request = getattr(self, 'request', None)
+        if request is None or request.method not in permissions.SAFE_METHODS:
+            return None
+        if not hasattr(self, '_sparse_fields'):
+            self._sparse_fields = None
+            serializer_class = self.get_serializer_class()
+            fields = self.paramNames(self.fields_param)
+            omit = self.paramNames(self.omit_param)
+            if (fields or omit) and issubclass(serializer_class, CompiledSerializerMixin):
+                readable = serializer_class.readableFields()
+                errors = {}
+                for param, names in ((self.fields_param, fields), (self.omit_param, omit)):
+                    unknown = [n for n in names if n not in readable]
+                    if unknown:
+                        errors[param] = ['Unknown field(s): {0}'.format(', '.join(unknown))]
+                if errors:
+                    raise ValidationError(errors)
+                names = set(fields or readable) - set(omit)
+                self._sparse_fields = frozenset(names)
+        return self._sparse_fields
+
+    def requiredColumns(self, queryset):
+        """Returns set of the columns loaded in any case: the ordering of the
+        queryset and of the cursor pagination, and the modified field used by
+        the ConditionalGetMixin validators. None if all columns are needed.
+        """
+        if (self.lookup_url_kwarg or self.lookup_field) in self.kwargs:
+            # objectValidators reads all fields of a model without modified
+            if not hasattr(queryset.model, 'modified'):
+                return None
+        columns = set(['modified']) if hasattr(queryset.model, 'modified') else set()
+        ordering = list(queryset.query.order_by)
+        ordering.extend(getattr(self.pagination_class, 'ordering', None) or ())
+        columns.update(f.lstrip('-') for f in ordering if isinstance(f, str) and '__' not in f)
+        columns.discard('id')
+        columns.discard('pk')
+        return columns
+
+    def get_queryset(self):
+        queryset = super(SparseFieldsMixin, self).get_queryset()
+        names = self.sparseFields()
+        if names is None:
+            return queryset
+        columns, relations = self.get_serializer_class().sparseQuery(names)
+        required = self.requiredColumns(queryset)
+        if columns is not None and required is not None:
+            queryset = queryset.only(*(columns | required))
+        if relations is not None:
+            lookups = [m for m in queryset._prefetch_related_lookups
+                if getattr(m, 'prefetch_to', m).split('__')[0] in relations]
+            queryset = queryset.prefetch_related(None).prefetch_related(*lookups)
+        return queryset
+
+    def get_serializer(self, *args, **kwargs):
+        names = self.sparseFields()
+        if names is not None:
+            kwargs['only_fields'] = names
+        return super(SparseFieldsMixin, self).get_serializer(*args, **kwargs)
+
+
+class ExpandMixin(object):
+    """?expand=location.seller,account.inst,order embeds the related objects
+    of the pk fields in the list and retrieve actions, with one query per
+    relation and page (see bank.serializers.expandRepresentations). Paths
+    have at most max_expand_depth levels. The embedded objects are not part
+    of the ETag validators, so expanded responses are not conditional.
+    """
+    expand_param = 'expand'
+    max_expand_depth = 2
+
+    def expandTree(self):
+        """Returns dict {field name: subtree} of the expanded paths, or None.
+        Raises ValidationError for invalid paths.
+        """
+        request = getattr(self, 'request', None)
+        if request is None or request.method not in permissions.SAFE_METHODS:
+            return None
+        if not hasattr(self, '_expand_tree'):
+            self._expand_tree = None
+            paths = [n.strip() for n in request.query_params.get(self.expand_param, '').split(',') if n.strip()]
+            serializer_class = self.get_serializer_class()
+            if paths and issubclass(serializer_class, CompiledSerializerMixin):
+                sparse = self.sparseFields() if hasattr(self, 'sparseFields') else None
+                tree = {}
+                errors = []
+                for path in paths:
+                    names = path.split('.')
+                    if len(names) > self.max_expand_depth:
+                        errors.append('{0}: at most {1} levels can be expanded'.format(path, self.max_expand_depth))
+                        continue
+                    if sparse is not None and names[0] not in sparse:
+                        errors.append('{0}: {1} is not a returned field'.format(path, names[0]))
+                        continue
+                    node = tree
+                    cls = serializer_class
+                    for name in names:
+                        expandable = cls.expandableFields()
+                        if name not in expandable:
+                            errors.append('{0}: {1} cannot be expanded'.format(path, name))
+                            break
+                        node = node.setdefault(name, {})
+                        cls = EXPAND_SERIALIZERS[expandable[name][0]][0]
+                if errors:
+                    raise ValidationError({self.expand_param: errors})
+                self._expand_tree = tree
+        return self._expand_tree
+
+    def conditionalResponse(self, tag, last_modified, build):
+        if self.expandTree():
+            return build()
+        return super(ExpandMixin, self).conditionalResponse(tag, last_modified, build)
+
+    def get_serializer(self, *args, **kwargs):
+        tree = self.expandTree()
+        if tree:
+            kwargs['expand'] = tree
+        return super(ExpandMixin, self).get_serializer(*args, **kwargs)
@@ -5,14 +5,29 @@ from decimal import Decimal
 import pytz
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import transaction
-from django.db.models import Prefetch, Count, Sum
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
+from django.db import connection, transaction, IntegrityError
+from django.db.models import F, Prefetch, Count, Sum
 from django.utils import timezone
 
 logger = logging.getLogger('gen.models')
 
 TAX_ADJUSTED_PCT = 0.7
 ADMIN_USER= 'admin'
+BULK_BATCH_SIZE = 1000 # max rows per INSERT statement for bulk_create
+SEARCH_FIELDS = ('search_text', 'search_vector') # search document of Seller, Order, Expense
+
+
+# Change counter of a table, bumped on every save/delete of its rows.
+# Used to invalidate the process-local caches (see bank.refcache).
+class Generation(models.Model):
+    name = models.CharField(max_length=60, unique=True, help_text='app_label.model_name')
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return '{0.name}:{0.value}'.format(self)
 
 
 class Source(models.Model):
@@ -58,6 +73,10 @@ class Income(models.Model):
     class Meta:
         unique_together = ('user', 'source', 'date_paid')
         ordering = ['-date_paid',]
+        indexes = [
+            models.Index(fields=['-date_paid', '-id'], name='bank_income_paid_id_idx'),
+            models.Index(fields=['modified', 'id'], name='bank_income_modified_id_idx'),
+        ]
 
 class Institution(models.Model):
     name = models.CharField(max_length=100, unique=True)
@@ -128,6 +147,18 @@ class Tag(models.Model):
         ordering = ['tag',]
 
 
+class SellerManager(models.Manager):
+
+    def withRelated(self):
+        """Queryset that batch-loads the preferred accounts (ordered by id)
+        and auto_tags of the sellers for use by ReadSellerSerializer.
+        """
+        return self.get_queryset().defer(*SEARCH_FIELDS).prefetch_related(
+            Prefetch('pref_accounts', queryset=PreferredAccount.objects.order_by('id')),
+            'auto_tags'
+        )
+
+
 class Seller(models.Model):
     seller_name = models.CharField(max_length=60, unique=True)
     website = models.URLField(max_length=1000, blank=True, help_text='Link to website of seller')
@@ -148,8 +179,12 @@ class Seller(models.Model):
         related_name='sellers',
         help_text='Automatic tags to apply to an expense'
     )
+    search_text = models.TextField(blank=True, default='', editable=False,
+            help_text='Search document. Set by a database trigger (see migration 0015).')
+    search_vector = SearchVectorField(null=True, editable=False)
     created = models.DateTimeField(auto_now_add=True)
     modified = models.DateTimeField(auto_now=True)
+    objects = SellerManager()
 
     def __str__(self):
         return self.seller_name
@@ -160,10 +195,14 @@ class Seller(models.Model):
 
     class Meta:
         ordering = ['seller_name',]
+        indexes = [
+            GinIndex(fields=['search_vector'], name='bank_seller_search_idx'),
+            models.Index(fields=['modified', 'id'], name='bank_seller_modified_id_idx'),
+        ]
 
 # This is used to pre-populate the account/paytype fields in an expense form for a given seller and logged-in user.
 class PreferredAccount(models.Model):
-    seller = models.ForeignKey(Seller, db_index=True, on_delete=models.CASCADE)
+    seller = models.ForeignKey(Seller, db_index=True, related_name='pref_accounts', on_delete=models.CASCADE)
     account = models.ForeignKey(Account, db_index=True, on_delete=models.CASCADE)
     paytype = models.ForeignKey(Paytype, db_index=True, on_delete=models.CASCADE)
     user = models.ForeignKey(User, db_index=True, on_delete=models.CASCADE)
@@ -195,6 +234,30 @@ class Location(models.Model):
     class Meta:
         unique_together = ('seller','loc_name')
         ordering = ['rank','seller','loc_name']
+        indexes = [
+            models.Index(fields=['modified', 'id'], name='bank_location_modified_id_idx'),
+        ]
+
+# Learned statement descriptor of a location (see bank.matching)
+class LocationAlias(models.Model):
+    location = models.ForeignKey(
+        Location,
+        db_index=True,
+        related_name='aliases',
+        on_delete=models.CASCADE
+    )
+    alias = models.CharField(max_length=100, unique=True,
+            help_text='Statement descriptor, e.g. AMZN MKTP US')
+    created_by = models.CharField(max_length=20, blank=True, default='')
+    created = models.DateTimeField(auto_now_add=True)
+    modified = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return '{0.alias} -> {0.location}'.format(self)
+
+    class Meta:
+        verbose_name_plural = 'LocationAliases'
+        ordering = ['alias',]
 
 class Order(models.Model):
     location = models.ForeignKey(
@@ -221,7 +284,12 @@ class Order(models.Model):
     is_complete = models.BooleanField(default=False)
     is_cancelled = models.BooleanField(default=False)
     num_shipments = models.PositiveSmallIntegerField(default=1, blank=True)
+    shipments_received = models.PositiveSmallIntegerField(default=0, editable=False,
+            help_text='Number of shipments with an expense. Maintained by ExpenseManager.')
     memo = models.TextField(blank=True, default='')
+    search_text = models.TextField(blank=True, default='', editable=False,
+            help_text='Search document. Set by a database trigger (see migration 0015).')
+    search_vector = SearchVectorField(null=True, editable=False)
     created = models.DateTimeField(auto_now_add=True)
     modified = models.DateTimeField(auto_now=True)
 
@@ -231,12 +299,95 @@ class Order(models.Model):
     class Meta:
         unique_together = ('location', 'order_number')
         ordering = ['-modified',]
-
+        indexes = [
+            models.Index(fields=['-modified', '-id'], name='bank_order_modified_id_idx'),
+            GinIndex(fields=['search_vector'], name='bank_order_search_idx'),
+        ]
+
+
+# Count a shipment of an incomplete order with multiple shipments and complete
+# the order with its last shipment, in one statement (see completeShipment).
+COMPLETE_SHIPMENT_SQL = """
+UPDATE bank_order
+   SET shipments_received = shipments_received + 1,
+       is_complete = (shipments_received + 1 >= num_shipments),
+       modified = now()
+ WHERE id = %s
+   AND NOT is_complete AND NOT is_cancelled
+   AND num_shipments >= 2 AND %s >= 1 AND %s <= num_shipments
+RETURNING shipments_received, num_shipments, is_complete, modified
+"""
+
+SHIPMENT_UNIQ = 'bank_expense_order_shipment_uniq'
+
+def isShipmentConflict(e):
+    """True if the IntegrityError e is a violation of the unique index of
+    the expenses of an order (one per shipment_no, see migration 0019), not
+    of another constraint.
+    """
+    diag = getattr(e.__cause__, 'diag', None)
+    return getattr(diag, 'constraint_name', None) == SHIPMENT_UNIQ
 
 class ExpenseManager(models.Manager):
 
+    def withRelated(self):
+        """Queryset that batch-loads the categories and tags of the expenses
+        (one query each per evaluation) for use by ReadExpenseSerializer.
+        """
+        return self.get_queryset().defer(*SEARCH_FIELDS).prefetch_related(
+            Prefetch('expensecategory_set', queryset=ExpenseCategory.objects.order_by('id')),
+            'tags'
+        )
+
+    def createBatch(self, items, created_by):
+        """Create many regular expenses with their tags and category weights
+        using batched inserts in a single transaction.
+        Args:
+            items: list of dicts of Expense field values (as validated by
+                CreateRegularExpenseSerializer), with optional keys:
+                tags: list of Tag
+                categories: list of dicts [{category:Category, weight:Decimal}]
+            created_by: str
+        The seller defaults are applied to items without tags/categories
+        (see bank.defaults).
+        Returns: list of Expense instances (in the order of items)
+        """
+        from .defaults import withSellerDefaults
+        expenses = []
+        tag_lists = []
+        catg_lists = []
+        for d in items:
+            location_id = d['location'].pk if 'location' in d else d['location_id']
+            d = dict(withSellerDefaults(d, location_id))
+            tag_lists.append(d.pop('tags', []))
+            catg_lists.append(d.pop('categories', []))
+            expenses.append(self.model(created_by=created_by, **d))
+        TagLink = self.model.tags.through
+        ExpenseCatg = self.model.categories.through
+        with transaction.atomic():
+            # On PostgreSQL bulk_create sets the primary keys of the instances
+            expenses = self.bulk_create(expenses, batch_size=BULK_BATCH_SIZE)
+            links = []
+            ecs = []
+            for expense, tags, catgs in zip(expenses, tag_lists, catg_lists):
+                tag_ids = set()
+                for tag in tags:
+                    if tag.pk not in tag_ids:
+                        tag_ids.add(tag.pk)
+                        links.append(TagLink(expense_id=expense.pk, tag_id=tag.pk))
+                for d in catgs:
+                    ecs.append(ExpenseCatg(expense=expense, category=d['category'], weight=d['weight']))
+            TagLink.objects.bulk_create(links, batch_size=BULK_BATCH_SIZE)
+            ExpenseCatg.objects.bulk_create(ecs, batch_size=BULK_BATCH_SIZE)
+            # bulk_create does not send the signals that maintain the rollups
+            from .rollups import addExpenses
+            addExpenses(expenses, ecs)
+        return expenses
+
     def completeOrder(self, order, date_paid, created_by, amount=None, memo=None):
-        """Create an expense from an order and complete the order in a transaction
+        """Create an expense from an order and complete the order in a transaction.
+        The order is completed with a conditional update, so of concurrent
+        calls for the same order only one succeeds.
         Args:
             order: incomplete Order instance (single shipment)
             date_paid: Datetime
@@ -244,69 +395,98 @@ class ExpenseManager(models.Manager):
             amount: Decimal/None. If None, use order.amount
             memo: str/None. If None use order.memo
         Returns: Expense instance
+        Raises ValueError if the order is complete or cancelled
         """
-        if not order.is_complete:
-            if not amount:
-                amount = order.amount
-            if not memo:
-                memo = order.memo
+        if not amount:
+            amount = order.amount
+        if not memo:
+            memo = order.memo
+        now = timezone.now()
+        try:
             with transaction.atomic():
+                num = Order.objects.filter(pk=order.pk, is_complete=False, is_cancelled=False).update(
+                    is_complete=True, shipments_received=F('num_shipments'), modified=now)
+                if not num:
+                    raise ValueError('Order is already complete')
                 expense = self.model.objects.create(
-                    location=order.location,
-                    account=order.account,
-                    paytype=order.paytype,
+                    location_id=order.location_id,
+                    account_id=order.account_id,
+                    paytype_id=order.paytype_id,
                     order=order,
                     date_paid=date_paid,
                     amount=amount,
                     memo=memo,
                     created_by=created_by
                 )
-                order.is_complete = True
-                order.save()
-            return expense
-        else:
-            raise ValueError('Order is already complete')
+        except IntegrityError as e:
+            if not isShipmentConflict(e):
+                raise
+            raise ValueError('The order already has an expense.')
+        order.is_complete = True
+        order.shipments_received = order.num_shipments
+        order.modified = now
+        return expense
 
 
     def completeShipment(self, order, date_paid, created_by, amount, memo, shipment_no):
-        """Create an expense with a shipment_no for an order with multiple shipments
+        """Create an expense with a shipment_no for an order with multiple shipments.
+        Order.shipments_received is incremented (and the order completed with
+        the last shipment) by one UPDATE that locks the order row, so
+        concurrent shipments of an order are counted exactly once.
         Args:
-            order: incomplete Order instance (multiple shipments)
+            order: Order instance (multiple shipments)
             date_paid: Datetime
             created_by: str
             amount: Decimal - amount for this shipment
             memo: str
+            shipment_no: int >= 1
+        Returns: Expense instance
+        Raises ValueError if the shipment cannot be entered
         """
-        if order.is_complete:
-            raise ValueError('Order is already complete')
-            return
-        if order.num_shipments < 2:
-            raise ValueError('Order does not have multiple shipments.')
-            return
-        if shipment_no > order.num_shipments:
-            raise ValueError('Shipment_no must be less than or equal to order.num_shipments.')
-            return
+        if shipment_no is None or shipment_no < 1:
+            raise ValueError('Shipment_no must be 1 or more.')
         if amount > order.amount:
             raise ValueError('Expense amount for shipment cannot be greater than order.amount.')
-            return
-        with transaction.atomic():
-            expense = self.model.objects.create(
-                location=order.location,
-                account=order.account,
-                paytype=order.paytype,
-                order=order,
-                date_paid=date_paid,
-                amount=amount,
-                shipment_no=shipment_no,
-                memo=memo,
-                created_by=created_by
-            )
-            if order.expenses.all().count() == order.num_shipments:
-                print('completeShipment: order is complete')
-                order.is_complete = True
-                order.save()
+        try:
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    cursor.execute(COMPLETE_SHIPMENT_SQL, [order.pk, shipment_no, shipment_no])
+                    row = cursor.fetchone()
+                if row is None:
+                    raise ValueError(self._shipmentError(order.pk, shipment_no))
+                expense = self.model.objects.create(
+                    location_id=order.location_id,
+                    account_id=order.account_id,
+                    paytype_id=order.paytype_id,
+                    order=order,
+                    date_paid=date_paid,
+                    amount=amount,
+                    shipment_no=shipment_no,
+                    memo=memo,
+                    created_by=created_by
+                )
+        except IntegrityError as e:
+            if not isShipmentConflict(e):
+                raise
+            raise ValueError('Shipment {0} of the order already has an expense.'.format(shipment_no))
+        order.shipments_received, order.num_shipments, order.is_complete, order.modified = row
+        if order.is_complete:
+            logger.info('completeShipment: order {0} is complete'.format(order.pk))
         return expense
 
+    def _shipmentError(self, order_id, shipment_no):
+        """Reason why COMPLETE_SHIPMENT_SQL did not update the order"""
+        d = Order.objects.filter(pk=order_id).values('is_complete', 'is_cancelled', 'num_shipments').first()
+        if d is None:
+            return 'Order does not exist.'
+        if d['is_complete']:
+            return 'Order is already complete'
+        if d['is_cancelled']:
+            return 'Order is cancelled.'
+        if d['num_shipments'] < 2:
+            return 'Order does not have multiple shipments.'
+        return 'Shipment_no must be less than or equal to order.num_shipments.'
+
 
 class Expense(models.Model):
     location = models.ForeignKey(
@@ -335,7 +515,7 @@ class Expense(models.Model):
         related_name='expenses',
         on_delete=models.CASCADE
     )
-    date_paid = models.DateTimeField()
+    date_paid = models.DateTimeField(db_index=True)
     amount = models.DecimalField(max_digits=7, decimal_places=2)
     memo = models.TextField(blank=True, default='')
     categories = models.ManyToManyField(
@@ -351,6 +531,9 @@ class Expense(models.Model):
             help_text='Shipment number if order has multiple shipments.')
     invoiceid = models.CharField(max_length=32, blank=True, default='',
             help_text='Used to track OrderId for expenses without creating an order')
+    search_text = models.TextField(blank=True, default='', editable=False,
+            help_text='Search document. Set by a database trigger (see migration 0015).')
+    search_vector = SearchVectorField(null=True, editable=False)
     created_by = models.CharField(max_length=20)
     created = models.DateTimeField(auto_now_add=True)
     modified = models.DateTimeField(auto_now=True)
@@ -370,6 +553,12 @@ class Expense(models.Model):
 
     class Meta:
         ordering = ['-created',]
+        indexes = [
+            models.Index(fields=['-created', '-id'], name='bank_expense_created_id_idx'),
+            GinIndex(fields=['search_vector'], name='bank_expense_search_idx'),
+            models.Index(fields=['account', 'date_paid', 'amount'], name='bank_expense_acct_paid_idx'),
+            models.Index(fields=['modified', 'id'], name='bank_expense_modified_id_idx'),
+        ]
 
 
 # Expense-Category association
@@ -404,3 +593,179 @@ class ExpenseCategory(models.Model):
         verbose_name_plural = 'ExpenseCategories'
         unique_together = ('expense', 'category')
         ordering = ['expense','weight']
+
+
+# Import of a statement file (see bank.statements). One per account and file
+# content; num_processed is the number of lines committed, from which an
+# interrupted import resumes.
+class StatementImport(models.Model):
+    FILETYPE_CSV = 'csv'
+    FILETYPE_OFX = 'ofx'
+    FILETYPE_CHOICES = (
+        (FILETYPE_CSV, 'CSV'),
+        (FILETYPE_OFX, 'OFX'),
+    )
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = (
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    )
+    account = models.ForeignKey(
+        Account,
+        db_index=True,
+        related_name='statement_imports',
+        on_delete=models.CASCADE
+    )
+    paytype = models.ForeignKey(Paytype, on_delete=models.CASCADE)
+    default_location = models.ForeignKey(
+        Location,
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        help_text='Location of the lines that cannot be resolved. If null, they are skipped.'
+    )
+    filename = models.CharField(max_length=200, blank=True, default='')
+    filetype = models.CharField(max_length=10, choices=FILETYPE_CHOICES, default=FILETYPE_CSV)
+    sha256 = models.CharField(max_length=64)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_RUNNING)
+    error = models.TextField(blank=True, default='')
+    num_lines = models.IntegerField(default=0, help_text='Number of charges in the file')
+    num_processed = models.IntegerField(default=0)
+    num_created = models.IntegerField(default=0)
+    num_duplicates = models.IntegerField(default=0)
+    num_unmatched = models.IntegerField(default=0)
+    unmatched = ArrayField(models.TextField(), default=list, blank=True,
+            help_text='Sample of the descriptions that could not be resolved to a location')
+    created_by = models.CharField(max_length=20)
+    created = models.DateTimeField(auto_now_add=True)
+    modified = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return '{0.account}|{0.filename}|{0.status}'.format(self)
+
+    class Meta:
+        unique_together = ('account', 'sha256')
+        ordering = ['-created',]
+
+
+# Deleted row of a synced model (see bank.sync). Created by bank.signals;
+# rows older than SYNC_TOMBSTONE_DAYS are removed by manage.py prune_tombstones.
+class Tombstone(models.Model):
+    model = models.CharField(max_length=40, help_text='model_name')
+    object_id = models.IntegerField()
+    deleted = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return '{0.model}:{0.object_id}'.format(self)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['deleted', 'id'], name='bank_tombstone_deleted_id_idx'),
+        ]
+
+
+#
+# Monthly rollups. These are kept current by the signal handlers in
+# bank.signals (see bank.rollups) and can be rebuilt and verified against
+# the raw tables with: manage.py rebuild_rollups
+#
+class ExpenseMonth(models.Model):
+    month = models.DateField(unique=True, help_text='First day of the month in TIME_ZONE')
+    amount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    unallocated = models.DecimalField(max_digits=14, decimal_places=4, default=0,
+            help_text='Part of amount not covered by category weights')
+    num = models.IntegerField(default=0, help_text='Number of expenses')
+
+    def __str__(self):
+        return '{0.month:%Y-%m}'.format(self)
+
+    class Meta:
+        ordering = ['-month',]
+
+
+class ExpenseAccountMonth(models.Model):
+    account = models.ForeignKey(
+        Account,
+        db_index=True,
+        related_name='expense_months',
+        on_delete=models.CASCADE
+    )
+    month = models.DateField(help_text='First day of the month in TIME_ZONE')
+    amount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    num = models.IntegerField(default=0, help_text='Number of expenses')
+
+    def __str__(self):
+        return '{0.account_id}|{0.month:%Y-%m}'.format(self)
+
+    class Meta:
+        unique_together = ('account', 'month')
+        ordering = ['-month', 'account']
+
+
+class ExpenseLocationMonth(models.Model):
+    location = models.ForeignKey(
+        Location,
+        db_index=True,
+        related_name='expense_months',
+        on_delete=models.CASCADE
+    )
+    month = models.DateField(help_text='First day of the month in TIME_ZONE')
+    amount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    num = models.IntegerField(default=0, help_text='Number of expenses')
+
+    def __str__(self):
+        return '{0.location_id}|{0.month:%Y-%m}'.format(self)
+
+    class Meta:
+        unique_together = ('location', 'month')
+        ordering = ['-month', 'location']
+
+
+class ExpenseCategoryMonth(models.Model):
+    category = models.ForeignKey(
+        Category,
+        db_index=True,
+        related_name='expense_months',
+        on_delete=models.CASCADE
+    )
+    month = models.DateField(help_text='First day of the month in TIME_ZONE')
+    amount = models.DecimalField(max_digits=14, decimal_places=4, default=0,
+            help_text='Sum of expense amount * category weight')
+    num = models.IntegerField(default=0, help_text='Number of expense-category rows')
+
+    def __str__(self):
+        return '{0.category_id}|{0.month:%Y-%m}'.format(self)
+
+    class Meta:
+        unique_together = ('category', 'month')
+        ordering = ['-month', 'category']
+
+
+class IncomeMonth(models.Model):
+    user = models.ForeignKey(
+        User,
+        db_index=True,
+        related_name='income_months',
+        on_delete=models.CASCADE
+    )
+    source = models.ForeignKey(
+        Source,
+        db_index=True,
+        related_name='income_months',
+        on_delete=models.CASCADE
+    )
+    month = models.DateField(help_text='First day of the month in TIME_ZONE')
+    amount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    pre_tax_amount = models.DecimalField(max_digits=12, decimal_places=2, default=0,
+            help_text='Part of amount that is pre-tax')
+    num = models.IntegerField(default=0, help_text='Number of incomes')
+
+    def __str__(self):
+        return '{0.user_id}|{0.source_id}|{0.month:%Y-%m}'.format(self)
+
+    class Meta:
+        unique_together = ('user', 'source', 'month')
+        ordering = ['-month', 'user', 'source']
@@ -0,0 +1,141 @@
+"""OAuth2 validator with a process-local cache of validated access tokens.
+
+Tokens are keyed by their sha256 hash. An entry lives until the earlier of
+TOKEN_CACHE_SECONDS and the token expiry, and expiry and scopes are checked
+on every request. A change of an AccessToken (e.g. revoke) or of the
+is_active/password of its user calls invalidateTokens (see bank.signals),
+which marks the changed tokens in the shared cache and bumps the
+AccessToken generation. A process that sees a new generation reads the
+marks of its cached tokens with one cache query and drops only the marked
+ones.
+"""
+from collections import OrderedDict
+import hashlib
+import logging
+import threading
+import time
+from django.conf import settings
+from django.core.cache import cache
+from oauth2_provider.models import AccessToken
+from oauth2_provider.oauth2_validators import OAuth2Validator
+from . import refcache
+
+logger = logging.getLogger('api.oauth')
+
+TOKEN_CHANGED_CACHE_KEY = 'bank:token-changed:{0}'
+
+
+def tokenKey(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def changedKey(key):
+    return TOKEN_CHANGED_CACHE_KEY.format(key)
+
+
+class TokenCache(object):
+    """Bounded LRU cache of AccessToken objects with a TTL"""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = OrderedDict() # key: (expires_at, generation, access_token)
+        self._generation_seen = None
+
+    def _generation(self):
+        return refcache.currentGenerations().get(refcache.generationName(AccessToken), 0)
+
+    def _sync(self, generation):
+        """Drop the entries of the tokens marked as changed and stamp the
+        others with generation.
+        """
+        with self._lock:
+            keys = [k for k, entry in self._data.items() if entry[1] != generation]
+        changed = cache.get_many([changedKey(k) for k in keys]) if keys else {}
+        with self._lock:
+            for key in keys:
+                entry = self._data.get(key)
+                if entry is None:
+                    continue
+                if changedKey(key) in changed:
+                    del self._data[key]
+                else:
+                    self._data[key] = (entry[0], generation, entry[2])
+            self._generation_seen = generation
+        if changed:
+            logger.debug('TokenCache: dropped {0} changed tokens'.format(len(changed)))
+
+    def get(self, token):
+        key = tokenKey(token)
+        generation = self._generation()
+        if generation != self._generation_seen:
+            self._sync(generation)
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return None
+            expires_at, entry_generation, access_token = entry
+            if entry_generation != generation or expires_at <= time.time():
+                return None
+            self._data[key] = entry # most recently used
+            return access_token
+
+    def set(self, token, access_token):
+        expires_at = min(time.time() + self.ttl, access_token.expires.timestamp())
+        entry = (expires_at, self._generation(), access_token)
+        key = tokenKey(token)
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = entry
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, token):
+        with self._lock:
+            self._data.pop(tokenKey(token), None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+tokenCache = TokenCache(settings.TOKEN_CACHE_MAX_SIZE, settings.TOKEN_CACHE_SECONDS)
+
+
+def invalidateTokens(tokens):
+    """Drop the cached entries of the given token strings in every process.
+    The marks live as long as a cache entry can.
+    """
+    tokens = list(tokens)
+    if not tokens:
+        return
+    for token in tokens:
+        tokenCache.delete(token)
+    cache.set_many({changedKey(tokenKey(t)): True for t in tokens}, settings.TOKEN_CACHE_SECONDS)
+    refcache.bumpGeneration(AccessToken)
+
+
+class CachedOAuth2Validator(OAuth2Validator):
+
+    def validate_bearer_token(self, token, scopes, request):
+        """Same as OAuth2Validator.validate_bearer_token, with the AccessToken
+        (and its application and user) read from tokenCache.
+        """
+        if not token:
+            return False
+        access_token = tokenCache.get(token)
+        if access_token is None:
+            try:
+                access_token = AccessToken.objects.select_related('application', 'user').get(token=token)
+            except AccessToken.DoesNotExist:
+                return False
+            tokenCache.set(token, access_token)
+        if not access_token.is_valid(scopes):
+            return False
+        request.client = access_token.application
+        request.user = access_token.user
+        request.scopes = scopes
+        # this is needed by django rest framework
+        request.access_token = access_token
+        return True
@@ -0,0 +1,22 @@
+from rest_framework.pagination import CursorPagination
+
+# Keyset pagination: each page is fetched with a WHERE on the ordering
+# column (no OFFSET and no COUNT(*)), so deep pages cost the same as the first.
+# The id tiebreaker makes the ordering deterministic, and each ordering is
+# backed by a matching composite index (see Meta.indexes of the models).
+
+class BaseCursorPagination(CursorPagination):
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+
+class ExpenseCursorPagination(BaseCursorPagination):
+    ordering = ('-created', '-id')
+
+
+class OrderCursorPagination(BaseCursorPagination):
+    ordering = ('-modified', '-id')
+
+
+class IncomeCursorPagination(BaseCursorPagination):
+    ordering = ('-date_paid', '-id')
@@ -0,0 +1,220 @@
+"""Reconciliation of a statement of an account against its expenses and
+open orders.
+
+Both sides are sorted by (date, amount) and merged in one pass: a window
+holds the not yet matched expenses dated within date_tolerance days of the
+current statement line, ordered by amount, and each line takes the
+closest expense in the window (by amount, then date) whose amount is
+within amount_tolerance. Expenses leaving the window unmatched are
+unexpected. The lines left over are merged the same way against the open
+orders of the account, whose charge can follow the order date by up to
+ORDER_WINDOW_DAYS: a single-shipment order matches its amount, an order
+with shipments left matches a charge of its remaining amount or, before
+its last shipment, of its share per shipment (amount / num_shipments).
+
+Result:
+    matched: (line, expense id) pairs
+    orders: (line, Order, shipment_no) for charges of open orders
+    missing: lines without an expense or order
+    unexpected: expense ids within the statement dates without a line
+"""
+from bisect import bisect_left, insort
+from collections import namedtuple
+from datetime import timedelta
+from decimal import Decimal
+import logging
+from django.db import transaction
+from django.db.models import Sum
+from .models import *
+from .statements import localDate, statementDatetime
+
+logger = logging.getLogger('gen.reconcile')
+
+DATE_TOLERANCE_DAYS = 3
+AMOUNT_TOLERANCE = Decimal('0.00')
+ORDER_WINDOW_DAYS = 30
+SHARE_ROUNDING = Decimal('0.01') # a share per shipment is split in cents
+
+Reconciliation = namedtuple('Reconciliation', ('matched', 'orders', 'missing', 'unexpected'))
+
+
+class _Window(object):
+    """Candidates ordered by amount: list of (amount, date, id)"""
+    def __init__(self):
+        self.items = []
+
+    def add(self, amount, date, pk):
+        insort(self.items, (amount, date, pk))
+
+    def remove(self, item):
+        self.items.pop(bisect_left(self.items, item))
+
+    def closest(self, amount, date, low, high):
+        """Returns the item with amount in [low, high] closest to (amount,
+        date), or None.
+        """
+        best = None
+        best_key = None
+        for i in range(bisect_left(self.items, (low,)), len(self.items)):
+            item = self.items[i]
+            if item[0] > high:
+                break
+            key = (abs(item[0] - amount), abs((item[1] - date).days), item[2])
+            if best_key is None or key < best_key:
+                best, best_key = item, key
+        return best
+
+
+def _mergeExpenses(lines, expenses, date_tol, amount_tol):
+    """Returns (matched, missing lines, unmatched expense (date, id) list)
+    Args:
+        lines: StatementLines sorted by (date, amount)
+        expenses: list of (date, amount, id) sorted
+    """
+    matched = []
+    missing = []
+    unmatched = []
+    window = _Window()
+    dates = {}
+    j = 0
+    for line in lines:
+        # add the expenses up to date + tolerance
+        while j < len(expenses) and expenses[j][0] <= line.date + date_tol:
+            date, amount, pk = expenses[j]
+            window.add(amount, date, pk)
+            dates[pk] = date
+            j += 1
+        # evict the expenses before date - tolerance
+        for item in [m for m in window.items if m[1] < line.date - date_tol]:
+            window.remove(item)
+            unmatched.append((item[1], item[2]))
+        item = window.closest(line.amount, line.date, line.amount - amount_tol, line.amount + amount_tol)
+        if item is None:
+            missing.append(line)
+        else:
+            window.remove(item)
+            matched.append((line, item[2]))
+    unmatched.extend((m[1], m[2]) for m in window.items)
+    unmatched.extend((d, pk) for d, a, pk in expenses[j:])
+    return matched, missing, unmatched
+
+
+def _mergeOrders(lines, orders, date_tol, amount_tol):
+    """Returns (list of (line, Order, shipment_no), missing lines)
+    Args:
+        lines: StatementLines sorted by (date, amount)
+        orders: list of Order annotated with received_amount, sorted by order_date
+    """
+    matches = []
+    missing = []
+    window = [] # open orders with shipments left
+    remaining = {} # order id: [amount left, next shipment_no]
+    order_window = timedelta(days=ORDER_WINDOW_DAYS)
+    j = 0
+    for line in lines:
+        while j < len(orders) and localDate(orders[j].order_date) <= line.date + date_tol:
+            order = orders[j]
+            window.append(order)
+            remaining[order.pk] = [order.amount - (order.received_amount or 0), order.shipments_received + 1]
+            j += 1
+        window = [m for m in window if localDate(m.order_date) >= line.date - order_window - date_tol
+            and remaining[m.pk][1] <= m.num_shipments]
+        best = None
+        best_key = None
+        for order in window:
+            left, shipment_no = remaining[order.pk]
+            diff = None
+            if abs(left - line.amount) <= amount_tol:
+                diff = abs(left - line.amount)
+            elif order.num_shipments > 1 and shipment_no < order.num_shipments and line.amount < left:
+                share_diff = abs(order.amount / order.num_shipments - line.amount)
+                if share_diff <= amount_tol + SHARE_ROUNDING:
+                    diff = share_diff
+            if diff is not None:
+                key = (diff, abs((localDate(order.order_date) - line.date).days), order.pk)
+                if best_key is None or key < best_key:
+                    best, best_key = order, key
+        if best is None:
+            missing.append(line)
+            continue
+        left, shipment_no = remaining[best.pk]
+        matches.append((line, best, shipment_no if best.num_shipments > 1 else None))
+        remaining[best.pk] = [left - line.amount, shipment_no + 1]
+    return matches, missing
+
+
+def reconcile(account, lines, date_tolerance=DATE_TOLERANCE_DAYS, amount_tolerance=AMOUNT_TOLERANCE):
+    """Reconcile the charges of a statement of account with its expenses
+    and open orders (one query each).
+    Args:
+        account: Account
+        lines: list of StatementLine
+        date_tolerance: int days
+        amount_tolerance: Decimal
+    Returns: Reconciliation
+    """
+    if not lines:
+        return Reconciliation([], [], [], [])
+    lines = sorted(lines, key=lambda m: (m.date, m.amount))
+    date_tol = timedelta(days=date_tolerance)
+    first, last = lines[0].date, lines[-1].date
+    start = statementDatetime(first - date_tol)
+    end = statementDatetime(last + date_tol) + timedelta(days=1)
+    qset = Expense.objects.filter(account=account, date_paid__gte=start, date_paid__lt=end
+        ).values_list('date_paid', 'amount', 'id')
+    expenses = sorted((localDate(dt), amount, pk) for dt, amount, pk in qset)
+    matched, leftover, unmatched = _mergeExpenses(lines, expenses, date_tol, amount_tolerance)
+    # expenses outside of the statement dates are not expected on it
+    unexpected = [pk for d, pk in sorted(unmatched) if first <= d <= last]
+    orders = []
+    if leftover:
+        orders = list(Order.objects.filter(
+            account=account,
+            is_complete=False,
+            is_cancelled=False,
+            order_date__gte=statementDatetime(first - date_tol) - timedelta(days=ORDER_WINDOW_DAYS),
+            order_date__lt=end
+        ).defer(*SEARCH_FIELDS).annotate(received_amount=Sum('expenses__amount')).order_by('order_date', 'id'))
+    order_matches, missing = _mergeOrders(leftover, orders, date_tol, amount_tolerance)
+    logger.info('reconcile {0}: {1} lines, {2} matched, {3} orders, {4} missing, {5} unexpected'.format(
+        account.pk, len(lines), len(matched), len(order_matches), len(missing), len(unexpected)))
+    return Reconciliation(matched, order_matches, missing, unexpected)
+
+
+def completeMatchedOrders(result, created_by):
+    """Enter the expenses of the order charges of a Reconciliation with
+    completeOrder/completeShipment, each in its own savepoint.
+    Returns: (list of Expense, list of (line, order id, error str))
+    """
+    created = []
+    errors = []
+    for line, order, shipment_no in result.orders:
+        date_paid = statementDatetime(line.date)
+        try:
+            with transaction.atomic():
+                if shipment_no is None:
+                    expense = Expense.objects.completeOrder(order, date_paid, created_by,
+                        amount=line.amount, memo=line.description)
+                else:
+                    expense = Expense.objects.completeShipment(order, date_paid, created_by,
+                        line.amount, line.description, shipment_no)
+        except ValueError as e:
+            errors.append((line, order.pk, str(e)))
+            continue
+        created.append(expense)
+    return created, errors
+
+
+def lineData(line):
+    return {'date': line.date, 'description': line.description, 'amount': line.amount}
+
+
+def reconciliationData(result):
+    """Returns dict representation of a Reconciliation for the API"""
+    return {
+        'matched': [dict(lineData(line), expense=pk) for line, pk in result.matched],
+        'orders': [dict(lineData(line), order=order.pk, shipment_no=shipment_no)
+            for line, order, shipment_no in result.orders],
+        'missing': [lineData(line) for line in result.missing],
+        'unexpected': result.unexpected,
+    }
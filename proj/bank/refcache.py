@@ -0,0 +1,149 @@
+"""Process-local cache of the small reference tables.
+
+Each cached table has a Generation row that is bumped on every save/delete
+(see bank.signals). The generations are read from the database once per
+request; a table is reloaded when its generation differs from the one it
+was loaded with, so a write is seen by every process from its next request.
+Changes made with queryset.update()/delete() send no signals and must call
+bumpGeneration() themselves.
+
+The cached instances are shared by the threads of the process and never
+leave this module: objects() and get() return copies, so caching of
+related objects or other changes made by the caller stay in its copy.
+"""
+from collections import OrderedDict
+from collections.abc import Mapping
+import logging
+import threading
+from django.db import connection, transaction, IntegrityError
+from django.db.models import F
+from django.db.models.base import ModelState
+from .models import *
+
+logger = logging.getLogger('gen.refcache')
+
+CACHED_MODELS = (Source, Institution, Account, Paytype, Category, Tag, Location)
+# models with a generation whose rows are not cached here (see bank.matching, bank.bootstrap)
+TRACKED_MODELS = CACHED_MODELS + (Seller, LocationAlias, PreferredAccount)
+
+_lock = threading.Lock()
+_local = threading.local()
+_entries = {} # name: (generation, OrderedDict {pk: obj})
+
+
+def generationName(model):
+    return model._meta.label_lower
+
+
+def startRequest(**kwargs):
+    _local.in_request = True
+    _local.generations = None
+
+def finishRequest(**kwargs):
+    _local.in_request = False
+    _local.generations = None
+
+
+def currentGenerations():
+    """Returns dict {name: value} of all generations. Within a request this is
+    read from the database once.
+    """
+    gens = getattr(_local, 'generations', None)
+    if gens is None:
+        gens = dict(Generation.objects.values_list('name', 'value'))
+        if getattr(_local, 'in_request', False):
+            _local.generations = gens
+    return gens
+
+
+def bumpGeneration(model):
+    """Increment the generation of the table of model"""
+    name = generationName(model)
+    if not Generation.objects.filter(name=name).update(value=F('value') + 1):
+        try:
+            with transaction.atomic():
+                Generation.objects.create(name=name, value=1)
+        except IntegrityError:
+            Generation.objects.filter(name=name).update(value=F('value') + 1)
+    with _lock:
+        _entries.pop(name, None)
+    _local.generations = None
+
+
+def copyObject(obj):
+    """Returns a copy of the model instance obj with its own attributes and
+    state, without the related objects cached on obj.
+    """
+    new = obj.__class__.__new__(obj.__class__)
+    new.__dict__ = {k: v for k, v in obj.__dict__.items() if not (k.startswith('_') and k.endswith('_cache'))}
+    new._state = ModelState()
+    new._state.db = obj._state.db
+    new._state.adding = False
+    return new
+
+
+class CachedRows(Mapping):
+    """Read-only mapping {pk: obj} over the shared cached objects of a table.
+    Each lookup returns a copy (see copyObject).
+    """
+    def __init__(self, data):
+        self._data = data
+
+    def __getitem__(self, pk):
+        return copyObject(self._data[pk])
+
+    def __contains__(self, pk):
+        return pk in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+
+def isCached(queryset):
+    """True if the objects of queryset can be served from the cache"""
+    return queryset.model in CACHED_MODELS and not queryset.query.has_filters()
+
+
+def objects(model):
+    """Returns CachedRows {pk: obj} of all rows of model, ordered by pk.
+    Each object read from it is a copy owned by the caller.
+    """
+    name = generationName(model)
+    generation = currentGenerations().get(name, 0)
+    entry = _entries.get(name)
+    if entry is not None and entry[0] == generation:
+        return CachedRows(entry[1])
+    data = OrderedDict((m.pk, m) for m in model.objects.order_by('pk'))
+    if not connection.in_atomic_block:
+        # do not keep rows that could still be rolled back
+        with _lock:
+            _entries[name] = (generation, data)
+    return CachedRows(data)
+
+
+def get(model, pk):
+    """Returns the cached object of model with pk, or None"""
+    return objects(model).get(pk)
+
+
+def derived(name, models, build):
+    """Returns the value of build(), cached until the generation of one of
+    models changes. The value is shared and must not be modified.
+    Args:
+        name: str unique name of the value
+        models: tuple of models in TRACKED_MODELS the value is built from
+        build: callable
+    """
+    gens = currentGenerations()
+    generation = tuple(gens.get(generationName(m), 0) for m in models)
+    entry = _entries.get(name)
+    if entry is not None and entry[0] == generation:
+        return entry[1]
+    data = build()
+    if not connection.in_atomic_block:
+        with _lock:
+            _entries[name] = (generation, data)
+    return data
@@ -0,0 +1,16 @@
+import time
+from rest_framework.renderers import JSONRenderer
+
+
+class TimedJSONRenderer(JSONRenderer):
+    """JSONRenderer that records its time in request.server_timing['serialize']
+    (see bank.middleware.ServerTimingMiddleware).
+    """
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        start = time.time()
+        ret = super(TimedJSONRenderer, self).render(data, accepted_media_type, renderer_context)
+        request = (renderer_context or {}).get('request')
+        timing = getattr(request, 'server_timing', None)
+        if timing is not None:
+            timing['serialize'] = timing.get('serialize', 0) + (time.time() - start)*1000
+        return ret
@@ -0,0 +1,237 @@
+from collections import OrderedDict
+from datetime import date
+from decimal import Decimal
+import logging
+from django.core.cache import cache
+from django.db import models
+from django.db.models import F, Max, Min, Sum, ExpressionWrapper
+from django.db.models.functions import Trunc
+from django.utils import timezone
+from .models import *
+
+logger = logging.getLogger('gen.reports')
+
+PERIOD_MONTH = 'month'
+PERIOD_QUARTER = 'quarter'
+PERIOD_YEAR = 'year'
+PERIODS = (PERIOD_MONTH, PERIOD_QUARTER, PERIOD_YEAR)
+
+CENTS = Decimal('0.01')
+
+def truncPeriod(field_name, period):
+    """Truncate a datetime field to the start of its month/quarter/year in TIME_ZONE"""
+    return Trunc(field_name, period,
+        output_field=models.DateTimeField(),
+        tzinfo=timezone.get_default_timezone())
+
+
+def weightedAmount():
+    """ExpenseCategory expression: expense amount * category weight"""
+    return ExpressionWrapper(F('weight') * F('expense__amount'),
+        output_field=models.DecimalField(max_digits=12, decimal_places=4))
+
+
+def periodOf(month, period):
+    """First day of the period containing the date month"""
+    if period == PERIOD_YEAR:
+        return month.replace(month=1, day=1)
+    if period == PERIOD_QUARTER:
+        return month.replace(month=3*((month.month - 1)//3) + 1, day=1)
+    return month.replace(day=1)
+
+
+def categorySpend(expenses, period):
+    """Spend per category and period with the category weights applied in SQL.
+    Args:
+        expenses: Expense queryset (filtered)
+        period: str one of PERIODS
+    Returns: list of dicts ordered by period:
+        {period:date, total:Decimal, unallocated:Decimal,
+         categories:[{category:int, amount:Decimal}]}
+        where unallocated is the part of total not covered by the category
+        weights (weights summing to less than 1, or no categories).
+    """
+    totals = (expenses
+        .annotate(period=truncPeriod('date_paid', period))
+        .values('period')
+        .annotate(total=Sum('amount'))
+        .order_by('period')
+    )
+    allocs = (ExpenseCategory.objects
+        .filter(expense__in=expenses.values('pk'))
+        .annotate(period=truncPeriod('expense__date_paid', period))
+        .values('period', 'category')
+        .annotate(amount=Sum(weightedAmount()))
+        .order_by('period', 'category')
+    )
+    data = OrderedDict()
+    for row in totals:
+        data[row['period']] = {
+            'period': timezone.localtime(row['period']).date(),
+            'total': row['total'],
+            'unallocated': row['total'],
+            'categories': []
+        }
+    for row in allocs:
+        d = data[row['period']]
+        d['unallocated'] -= row['amount']
+        d['categories'].append({
+            'category': row['category'],
+            'amount': row['amount'].quantize(CENTS)
+        })
+    for d in data.values():
+        d['unallocated'] = d['unallocated'].quantize(CENTS)
+    return list(data.values())
+
+
+def categorySpendFromRollups(period, account=None, location=None):
+    """Same result as categorySpend for all expenses, or for the expenses of
+    an account or of a location, read from the monthly rollup tables:
+    the totals from ExpenseMonth, ExpenseAccountMonth or ExpenseLocationMonth,
+    and the category amounts of all expenses from ExpenseCategoryMonth. The
+    category amounts of an account/location are not rolled up; they are
+    summed with one aggregate of its ExpenseCategory rows.
+    Args:
+        period: str one of PERIODS
+        account: int/None. Account id.
+        location: int/None. Location id (used if account is None).
+    Returns: list of dicts (see categorySpend)
+    """
+    if account is not None:
+        months = ExpenseAccountMonth.objects.filter(account_id=account)
+        allocs = ExpenseCategory.objects.filter(expense__account_id=account)
+    elif location is not None:
+        months = ExpenseLocationMonth.objects.filter(location_id=location)
+        allocs = ExpenseCategory.objects.filter(expense__location_id=location)
+    else:
+        months = ExpenseMonth.objects.all()
+        allocs = None
+    data = OrderedDict()
+    for m in months.filter(num__gt=0).order_by('month'):
+        key = periodOf(m.month, period)
+        d = data.setdefault(key, {
+            'period': key,
+            'total': Decimal('0'),
+            'unallocated': Decimal('0'),
+            'categories': OrderedDict()
+        })
+        d['total'] += m.amount
+        d['unallocated'] += m.amount if allocs is not None else m.unallocated
+    if allocs is None:
+        rows = ((m.month, m.category_id, m.amount)
+            for m in ExpenseCategoryMonth.objects.filter(num__gt=0).order_by('month', 'category'))
+    else:
+        rows = ((timezone.localtime(row['period']).date(), row['category'], row['amount'])
+            for row in allocs.annotate(period=truncPeriod('expense__date_paid', PERIOD_MONTH))
+                .values('period', 'category').annotate(amount=Sum(weightedAmount())).order_by('period', 'category'))
+    for month, category_id, amount in rows:
+        d = data.get(periodOf(month, period))
+        if d is not None:
+            catgs = d['categories']
+            catgs[category_id] = catgs.get(category_id, Decimal('0')) + amount
+            if allocs is not None:
+                d['unallocated'] -= amount
+    for d in data.values():
+        d['unallocated'] = d['unallocated'].quantize(CENTS)
+        d['categories'] = [{'category': catg, 'amount': amount.quantize(CENTS)}
+            for catg, amount in sorted(d['categories'].items())]
+    return list(data.values())
+
+
+#
+# Income summary
+#
+INCOME_SUMMARY_CACHE_KEY = 'bank:income-summary:{0}'
+
+def incomeYearKey(year):
+    return INCOME_SUMMARY_CACHE_KEY.format(year)
+
+
+def invalidateIncomeSummary(years):
+    """Drop the cached income summaries of the given years"""
+    cache.delete_many([incomeYearKey(y) for y in set(years)])
+
+
+def _incomeMonths(year_from, year_to):
+    """Gross, pre-tax and tax-adjusted totals per month, user and source for
+    the years year_from..year_to, read from the monthly rollup IncomeMonth.
+    Returns: dict {year: list of dicts}
+    """
+    pct = Decimal(str(TAX_ADJUSTED_PCT))
+    qset = (IncomeMonth.objects
+        .filter(month__gte=date(year_from, 1, 1), month__lt=date(year_to + 1, 1, 1), num__gt=0)
+        .order_by('month', 'user', 'source')
+    )
+    data = {y: [] for y in range(year_from, year_to + 1)}
+    for m in qset:
+        data[m.month.year].append({
+            'month': m.month,
+            'user': m.user_id,
+            'source': m.source_id,
+            'gross': m.amount,
+            'pre_tax': m.pre_tax_amount,
+            'adjusted': m.amount - m.pre_tax_amount + m.pre_tax_amount*pct,
+        })
+    return data
+
+
+def incomeSummary(period, year_from=None, year_to=None, user=None, source=None):
+    """Gross, pre-tax and tax-adjusted (TAX_ADJUSTED_PCT applied to pre-tax
+    amounts) income per period, user and source from the monthly rollups.
+    The monthly totals of closed past years are cached until an income in
+    that year changes.
+    Args:
+        period: str one of PERIODS
+        year_from, year_to: int/None. Defaults to the range of the data.
+        user, source: int/None. Restrict to this user/source id.
+    Returns: list of dicts {period:date, user:int, source:int, gross:Decimal,
+        pre_tax:Decimal, adjusted:Decimal} ordered by period, user, source
+    """
+    if year_from is None or year_to is None:
+        agg = IncomeMonth.objects.filter(num__gt=0).aggregate(first=Min('month'), last=Max('month'))
+        if agg['first'] is None:
+            return []
+        year_from = year_from or agg['first'].year
+        year_to = year_to or agg['last'].year
+    this_year = timezone.localtime(timezone.now()).year
+    years = list(range(year_from, year_to + 1))
+    cached = cache.get_many([incomeYearKey(y) for y in years if y < this_year])
+    months = {}
+    missing = []
+    for y in years:
+        key = incomeYearKey(y)
+        if key in cached:
+            months[y] = cached[key]
+        else:
+            missing.append(y)
+    if missing:
+        data = _incomeMonths(min(missing), max(missing))
+        closed = {}
+        for y in missing:
+            months[y] = data[y]
+            if y < this_year:
+                closed[incomeYearKey(y)] = data[y]
+        if closed:
+            cache.set_many(closed, None)
+    totals = OrderedDict()
+    for y in years:
+        for row in months[y]:
+            if user is not None and row['user'] != user:
+                continue
+            if source is not None and row['source'] != source:
+                continue
+            key = (periodOf(row['month'], period), row['user'], row['source'])
+            d = totals.setdefault(key, {
+                'period': key[0],
+                'user': key[1],
+                'source': key[2],
+                'gross': Decimal('0'),
+                'pre_tax': Decimal('0'),
+                'adjusted': Decimal('0')
+            })
+            for f in ('gross', 'pre_tax', 'adjusted'):
+                d[f] += row[f]
+    for d in totals.values():
+        for f in ('gross', 'pre_tax', 'adjusted'):
+            d[f] = d[f].quantize(CENTS)
+    return sorted(totals.values(), key=lambda d: (d['period'], d['user'], d['source']))
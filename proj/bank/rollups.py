@@ -0,0 +1,233 @@
+"""Incremental maintenance of the monthly rollup tables.
+
+Each Expense contributes its amount to ExpenseMonth (all of it as
+unallocated), ExpenseAccountMonth and ExpenseLocationMonth. Each
+ExpenseCategory contributes amount*weight to ExpenseCategoryMonth and moves
+the same amount out of ExpenseMonth.unallocated. Each Income contributes to
+IncomeMonth. A write is applied as the difference between the old and new
+contributions of the object (see bank.signals).
+"""
+from collections import defaultdict
+from decimal import Decimal
+import logging
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Case, Count, F, Sum, Value, When
+from django.utils import timezone
+from .models import *
+from .reports import truncPeriod, weightedAmount
+
+logger = logging.getLogger('gen.rollups')
+
+ROLLUP_MODELS = (ExpenseMonth, ExpenseAccountMonth, ExpenseLocationMonth, ExpenseCategoryMonth, IncomeMonth)
+ZERO = Decimal('0')
+
+
+def monthOf(dt):
+    """First day of the month of datetime dt in TIME_ZONE"""
+    return timezone.localtime(dt).date().replace(day=1)
+
+
+class RollupDelta(object):
+    """Accumulates increments to rollup rows: {(model, key): {field: increment}}
+    where key is a tuple of (field, value) pairs identifying the row.
+    """
+    def __init__(self):
+        self.rows = defaultdict(lambda: defaultdict(lambda: ZERO))
+
+    def add(self, model, key, **incs):
+        row = self.rows[(model, tuple(sorted(key.items())))]
+        for f, v in incs.items():
+            row[f] += v
+
+    def addExpense(self, expense, sign=1):
+        """expense: Expense instance or dict with account_id, location_id, date_paid, amount"""
+        d = _values(expense, ('account_id', 'location_id', 'date_paid', 'amount'))
+        month = monthOf(d['date_paid'])
+        amount = sign*Decimal(d['amount'])
+        self.add(ExpenseMonth, {'month': month}, amount=amount, unallocated=amount, num=sign)
+        self.add(ExpenseAccountMonth, {'account_id': d['account_id'], 'month': month}, amount=amount, num=sign)
+        self.add(ExpenseLocationMonth, {'location_id': d['location_id'], 'month': month}, amount=amount, num=sign)
+
+    def addExpenseCatg(self, ec, expense, sign=1):
+        """ec: ExpenseCategory instance or dict with category_id, weight
+        expense: Expense instance or dict with date_paid, amount
+        """
+        c = _values(ec, ('category_id', 'weight'))
+        d = _values(expense, ('date_paid', 'amount'))
+        month = monthOf(d['date_paid'])
+        amount = sign*Decimal(d['amount'])*Decimal(c['weight'])
+        self.add(ExpenseCategoryMonth, {'category_id': c['category_id'], 'month': month}, amount=amount, num=sign)
+        self.add(ExpenseMonth, {'month': month}, unallocated=-amount)
+
+    def addIncome(self, income, sign=1):
+        """income: Income instance or dict with user_id, source_id, date_paid, amount, is_pre_tax"""
+        d = _values(income, ('user_id', 'source_id', 'date_paid', 'amount', 'is_pre_tax'))
+        amount = sign*Decimal(d['amount'])
+        key = {'user_id': d['user_id'], 'source_id': d['source_id'], 'month': monthOf(d['date_paid'])}
+        self.add(IncomeMonth, key, amount=amount, pre_tax_amount=amount if d['is_pre_tax'] else ZERO, num=sign)
+
+    def apply(self):
+        """Write the increments. A missing row is only created by an increment
+        that adds rows (num > 0). Decrements of a missing row are dropped: the
+        row was removed by a cascade delete or the rollups have not been built.
+        """
+        for (model, key), incs in self.rows.items():
+            incs = {f: v for f, v in incs.items() if v}
+            if not incs:
+                continue
+            key = dict(key)
+            if 'num' in incs:
+                incs['num'] = int(incs['num'])
+            updates = {f: F(f) + v for f, v in incs.items()}
+            if model.objects.filter(**key).update(**updates):
+                continue
+            if incs.get('num', 0) <= 0:
+                logger.debug('RollupDelta: no {0} row for {1}'.format(model.__name__, key))
+                continue
+            try:
+                with transaction.atomic():
+                    model.objects.create(**dict(key, **incs))
+            except IntegrityError:
+                # created concurrently
+                model.objects.filter(**key).update(**updates)
+        self.rows.clear()
+
+
+def _values(obj, fields):
+    if isinstance(obj, dict):
+        return obj
+    return {f: getattr(obj, f) for f in fields}
+
+
+def addExpenses(expenses, ecs):
+    """Add the contributions of newly bulk-created expenses and their categories
+    (bulk_create does not send the signals that maintain the rollups).
+    Args:
+        expenses: list of Expense
+        ecs: list of ExpenseCategory (with expense set)
+    """
+    delta = RollupDelta()
+    for expense in expenses:
+        delta.addExpense(expense)
+    for ec in ecs:
+        delta.addExpenseCatg(ec, ec.expense)
+    delta.apply()
+
+
+def addExpenseCategories(ecs):
+    """Add the contributions of ExpenseCategory rows written without signals
+    (e.g. by raw SQL), aggregated per category and month in the database.
+    Args:
+        ecs: ExpenseCategory queryset
+    """
+    delta = RollupDelta()
+    qset = ecs.annotate(period=truncPeriod('expense__date_paid', 'month')).values('period', 'category_id'
+        ).annotate(amount=Sum(weightedAmount()), num=Count('id')).order_by()
+    for row in qset:
+        month = timezone.localtime(row['period']).date()
+        delta.add(ExpenseCategoryMonth, {'category_id': row['category_id'], 'month': month},
+            amount=row['amount'], num=row['num'])
+        delta.add(ExpenseMonth, {'month': month}, unallocated=-row['amount'])
+    delta.apply()
+
+
+#
+# Rebuild and verify
+#
+def computeRollups():
+    """Compute the rollups from the raw tables with aggregate queries.
+    Returns: dict {model: {key: {field: value}}} where key is a tuple of
+        (field, value) pairs as used by RollupDelta.
+    """
+    out = {model: {} for model in ROLLUP_MODELS}
+
+    def collect(model, qset, key_fields, value_fields):
+        for row in qset:
+            key = {f: row[f] for f in key_fields}
+            key['month'] = timezone.localtime(row['period']).date()
+            out[model][tuple(sorted(key.items()))] = {f: row[f] for f in value_fields}
+
+    expenses = Expense.objects.annotate(period=truncPeriod('date_paid', 'month'))
+    ecs = ExpenseCategory.objects.annotate(period=truncPeriod('expense__date_paid', 'month'))
+    incomes = Income.objects.annotate(period=truncPeriod('date_paid', 'month'))
+    collect(ExpenseMonth,
+        expenses.values('period').annotate(amount=Sum('amount'), num=Count('id')).order_by(),
+        (), ('amount', 'num'))
+    collect(ExpenseAccountMonth,
+        expenses.values('period', 'account_id').annotate(amount=Sum('amount'), num=Count('id')).order_by(),
+        ('account_id',), ('amount', 'num'))
+    collect(ExpenseLocationMonth,
+        expenses.values('period', 'location_id').annotate(amount=Sum('amount'), num=Count('id')).order_by(),
+        ('location_id',), ('amount', 'num'))
+    collect(ExpenseCategoryMonth,
+        ecs.values('period', 'category_id').annotate(amount=Sum(weightedAmount()), num=Count('id')).order_by(),
+        ('category_id',), ('amount', 'num'))
+    pre_tax = Case(When(is_pre_tax=True, then=F('amount')), default=Value(ZERO),
+        output_field=models.DecimalField(max_digits=12, decimal_places=2))
+    collect(IncomeMonth,
+        incomes.values('period', 'user_id', 'source_id').annotate(
+            amount=Sum('amount'), pre_tax_amount=Sum(pre_tax), num=Count('id')).order_by(),
+        ('user_id', 'source_id'), ('amount', 'pre_tax_amount', 'num'))
+    # unallocated = amount - sum of the weighted amounts in the month
+    months = out[ExpenseMonth]
+    for d in months.values():
+        d['unallocated'] = d['amount']
+    for row in ecs.values('period').annotate(amount=Sum(weightedAmount())).order_by():
+        key = (('month', timezone.localtime(row['period']).date()),)
+        months[key]['unallocated'] -= row['amount']
+    return out
+
+
+def _lockRawTables():
+    """Block writers to the raw tables until the end of the transaction"""
+    if connection.vendor == 'postgresql':
+        tables = ', '.join(m._meta.db_table for m in (Expense, ExpenseCategory, Income))
+        with connection.cursor() as cursor:
+            cursor.execute('LOCK TABLE {0} IN SHARE MODE'.format(tables))
+
+
+def rebuildRollups():
+    """Replace the contents of the rollup tables with computeRollups()
+    Returns: dict {model name: number of rows}
+    """
+    counts = {}
+    with transaction.atomic():
+        _lockRawTables()
+        data = computeRollups()
+        for model in ROLLUP_MODELS:
+            model.objects.all().delete()
+            objs = [model(**dict(dict(key), **values)) for key, values in data[model].items()]
+            model.objects.bulk_create(objs, batch_size=BULK_BATCH_SIZE)
+            counts[model.__name__] = len(objs)
+    return counts
+
+
+def verifyRollups():
+    """Compare the rollup tables with computeRollups()
+    Returns: list of str describing each mismatched row
+    """
+    errors = []
+    with transaction.atomic():
+        _lockRawTables()
+        data = computeRollups()
+        for model in ROLLUP_MODELS:
+            expected = data[model]
+            key_fields = None
+            value_fields = [f.name for f in model._meta.concrete_fields if f.name in ('amount', 'unallocated', 'pre_tax_amount', 'num')]
+            for obj in model.objects.all():
+                key_fields = key_fields or [f.attname for f in model._meta.concrete_fields
+                    if f.attname not in value_fields and f.attname != 'id']
+                key = tuple(sorted((f, getattr(obj, f)) for f in key_fields))
+                values = expected.pop(key, None)
+                actual = {f: getattr(obj, f) for f in value_fields}
+                if values is None:
+                    if any(actual.values()):
+                        errors.append('{0} {1}: unexpected row {2}'.format(model.__name__, dict(key), actual))
+                    continue
+                for f in value_fields:
+                    if Decimal(actual[f]) != Decimal(values[f]):
+                        errors.append('{0} {1}: {2} is {3}, expected {4}'.format(
+                            model.__name__, dict(key), f, actual[f], values[f]))
+            for key, values in expected.items():
+                errors.append('{0} {1}: missing row {2}'.format(model.__name__, dict(key), values))
+    return errors
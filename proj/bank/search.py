@@ -0,0 +1,27 @@
+import logging
+from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramSimilarity
+from django.db.models import F, Q
+from .models import *
+
+logger = logging.getLogger('gen.search')
+
+# text search configuration used by the search triggers (migration 0015)
+SEARCH_CONFIG = 'english'
+
+def searchQueryset(qset, q):
+    """Filter a queryset of Seller, Order or Expense to the rows whose search
+    document matches q, either as a text search (GIN index on search_vector)
+    or as a substring (trigram GIN index on search_text), ranked by text
+    rank plus trigram similarity.
+    Args:
+        qset: queryset of a model with search_text and search_vector fields
+        q: str
+    Returns: queryset annotated with rank, ordered by -rank
+    """
+    query = SearchQuery(q, config=SEARCH_CONFIG)
+    return (qset
+        .filter(Q(search_vector=query) | Q(search_text__icontains=q))
+        .annotate(rank=SearchRank(F('search_vector'), query) + TrigramSimilarity('search_text', q))
+        .defer(*SEARCH_FIELDS)
+        .order_by('-rank', '-id')
+    )
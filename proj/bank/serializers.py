@@ -1,45 +1,371 @@
+from collections import OrderedDict
 from datetime import timedelta
 from decimal import Decimal
 import logging
-from django.db import transaction
+import operator
+from django.core.exceptions import FieldDoesNotExist
+from django.db import models, transaction
 from django.utils import timezone
 from rest_framework import serializers
+from rest_framework.fields import SkipField
+from rest_framework.relations import PKOnlyObject
 from .models import *
+from . import refcache
+from .defaults import withSellerDefaults
 
 
 logger = logging.getLogger('gen.srl')
 
-class SourceSerializer(serializers.ModelSerializer):
+class BatchPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """PrimaryKeyRelatedField that looks up the pk in the objects preloaded
+    by the view in context['related_objects'] ({Model: {pk: obj}}), or in
+    bank.refcache for the cached reference tables, before falling back to
+    a query. Used to validate many items together.
+    """
+    def to_internal_value(self, data):
+        queryset = self.get_queryset()
+        preloaded = self.context.get('related_objects', {}).get(queryset.model)
+        if preloaded is None and refcache.isCached(queryset):
+            preloaded = refcache.objects(queryset.model)
+        if preloaded is None:
+            return super(BatchPrimaryKeyRelatedField, self).to_internal_value(data)
+        try:
+            obj = preloaded.get(int(data))
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        if obj is None:
+            self.fail('does_not_exist', pk_value=data)
+        return obj
+
+
+# Kinds of the steps of a field plan
+_ATTR = 0 # value = get(obj); None or rep(value) (value as is if rep is None)
+_METHOD = 1 # SerializerMethodField: get(serializer, obj)
+_FIELD = 2 # any other field: as Serializer.to_representation
+
+def _manyPks(name):
+    return lambda obj: [m.pk for m in getattr(obj, name).all()]
+
+def _modelField(model, name):
+    """Returns the model field or relation with name or accessor name, or None"""
+    try:
+        return model._meta.get_field(name)
+    except FieldDoesNotExist:
+        pass
+    for rel in model._meta.related_objects:
+        if rel.get_accessor_name() == name:
+            return rel
+    return None
+
+def _compileField(serializer_class, model, field):
+    """Returns the plan step (field_name, kind, get, rep) of a bound field"""
+    name = field.field_name
+    attrs = field.source_attrs
+    simple = len(attrs) == 1 and model is not None
+    if isinstance(field, serializers.SerializerMethodField):
+        return (name, _METHOD, getattr(serializer_class, field.method_name), None)
+    if (simple and isinstance(field, serializers.ManyRelatedField)
+            and isinstance(field.child_relation, serializers.PrimaryKeyRelatedField)
+            and type(field.child_relation).to_representation is serializers.PrimaryKeyRelatedField.to_representation
+            and field.child_relation.pk_field is None):
+        return (name, _ATTR, _manyPks(attrs[0]), None)
+    if (simple and isinstance(field, serializers.PrimaryKeyRelatedField)
+            and type(field).to_representation is serializers.PrimaryKeyRelatedField.to_representation
+            and field.pk_field is None):
+        model_field = _modelField(model, attrs[0])
+        if model_field is not None and (model_field.many_to_one or model_field.one_to_one) and model_field.concrete:
+            # the value of the FK column, as PKOnlyObject
+            return (name, _ATTR, operator.attrgetter(model_field.attname), None)
+    if isinstance(field, serializers.ListSerializer) and len(attrs) == 1:
+        # nested list: the related manager
+        return (name, _ATTR, operator.attrgetter(attrs[0]), field.to_representation)
+    if (simple and not isinstance(field, (serializers.RelatedField, serializers.ManyRelatedField, serializers.BaseSerializer))
+            and getattr(_modelField(model, attrs[0]), 'is_relation', True) is False):
+        return (name, _ATTR, operator.attrgetter(attrs[0]), field.to_representation)
+    return (name, _FIELD, field, None)
+
+
+class CompiledListSerializer(serializers.ListSerializer):
+    """ListSerializer that applies the field plan of its
+    CompiledSerializerMixin child to the rows in one loop.
+    """
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, models.Manager) else data
+        out = self.child.representRows(iterable)
+        if self.child.expand:
+            expandRepresentations(type(self.child), out, self.child.expand)
+        return out
+
+
+class CompiledSerializerMixin(object):
+    """Serializer with the representation of its readable fields compiled
+    once per class into a plan of (field_name, kind, get, rep) steps:
+    model fields are read with attrgetter and converted by the to_representation
+    of the field, related pks are read from the FK column, and the other fields
+    use the code of Serializer.to_representation. The output is the same as
+    without the mixin. Set Meta.list_serializer_class = CompiledListSerializer.
+
+    The fields of the plan are bound to a prototype instance: the plan does not
+    use the context of the serializer, except in SerializerMethodFields.
+
+    only_fields=<names> limits the output to these fields (sparse fieldsets,
+    see bank.mixins.SparseFieldsMixin). method_sources maps the
+    SerializerMethodFields to the model fields/relations they read.
+    expand=<tree> embeds related objects (see expandRepresentations).
+    """
+    method_sources = {}
+
+    def __init__(self, *args, **kwargs):
+        self.only_fields = kwargs.pop('only_fields', None)
+        self.expand = kwargs.pop('expand', None)
+        super(CompiledSerializerMixin, self).__init__(*args, **kwargs)
+
+    @classmethod
+    def compile(cls):
+        """Returns (prototype instance, plan), computed on first use"""
+        compiled = cls.__dict__.get('_compiled')
+        if compiled is None:
+            proto = cls()
+            model = getattr(getattr(cls, 'Meta', None), 'model', None)
+            plan = tuple(_compileField(cls, model, f) for f in proto.fields.values() if not f.write_only)
+            compiled = (proto, plan)
+            # set on this class only: subclasses have their own fields
+            cls._compiled = compiled
+        return compiled
+
+    @classmethod
+    def fieldPlan(cls):
+        return cls.compile()[1]
+
+    @classmethod
+    def readableFields(cls):
+        return tuple(step[0] for step in cls.fieldPlan())
+
+    @classmethod
+    def expandableFields(cls):
+        """Returns dict {field name: (related model, many)} of the pk fields
+        whose related objects can be embedded (models in EXPAND_SERIALIZERS).
+        """
+        expandable = cls.__dict__.get('_expandable')
+        if expandable is None:
+            proto = cls.compile()[0]
+            expandable = {}
+            for name in cls.readableFields():
+                field = proto.fields[name]
+                many = isinstance(field, serializers.ManyRelatedField)
+                if not (many or isinstance(field, serializers.PrimaryKeyRelatedField)):
+                    continue
+                if len(field.source_attrs) != 1:
+                    continue
+                model_field = _modelField(cls.Meta.model, field.source_attrs[0])
+                if model_field is not None and model_field.related_model in EXPAND_SERIALIZERS:
+                    expandable[name] = (model_field.related_model, many)
+            cls._expandable = expandable
+        return expandable
+
+    @classmethod
+    def sparsePlan(cls, names):
+        """Returns the steps of the plan for the field names (a frozenset)"""
+        plans = cls.__dict__.get('_sparse_plans')
+        if plans is None:
+            plans = cls._sparse_plans = {}
+        plan = plans.get(names)
+        if plan is None:
+            plan = plans[names] = tuple(step for step in cls.fieldPlan() if step[0] in names)
+        return plan
+
+    @classmethod
+    def sparseQuery(cls, names):
+        """Returns (columns, relations) read by the fields names: the names
+        of the concrete model fields and of the m2m/reverse relations. Either
+        is None if it cannot be determined (all are needed).
+        """
+        proto, plan = cls.compile()
+        model = cls.Meta.model
+        columns = set()
+        relations = set()
+        for name in names:
+            field = proto.fields[name]
+            if isinstance(field, serializers.SerializerMethodField):
+                if name not in cls.method_sources:
+                    return None, None
+                sources = cls.method_sources[name]
+            elif len(field.source_attrs) == 1:
+                sources = field.source_attrs
+            else:
+                return None, None
+            for source in sources:
+                model_field = _modelField(model, source)
+                if model_field is None:
+                    return None, None
+                if model_field.concrete and not model_field.many_to_many:
+                    columns.add(source)
+                else:
+                    relations.add(source)
+        return columns, relations
+
+    @classmethod
+    def representMany(cls, rows):
+        """Returns list of the representations of rows (model instances)
+        using the prototype instance, without creating a serializer.
+        """
+        return cls.compile()[0].representRows(rows)
+
+    def representRows(self, rows):
+        if self.only_fields is None:
+            plan = self.fieldPlan()
+        else:
+            plan = self.sparsePlan(frozenset(self.only_fields))
+        out = []
+        append = out.append
+        for obj in rows:
+            ret = OrderedDict()
+            for name, kind, get, rep in plan:
+                if kind == _ATTR:
+                    value = get(obj)
+                    ret[name] = value if value is None or rep is None else rep(value)
+                elif kind == _METHOD:
+                    ret[name] = get(self, obj)
+                else:
+                    try:
+                        attribute = get.get_attribute(obj)
+                    except SkipField:
+                        continue
+                    check_for_none = attribute.pk if isinstance(attribute, PKOnlyObject) else attribute
+                    ret[name] = None if check_for_none is None else get.to_representation(attribute)
+            append(ret)
+        return out
+
+    def to_representation(self, instance):
+        out = self.representRows((instance,))
+        if self.expand:
+            expandRepresentations(type(self), out, self.expand)
+        return out[0]
+
+
+def expandRepresentations(serializer_class, rows, tree):
+    """Replace the pks of the relations in tree by the representations of
+    the related objects (see EXPAND_SERIALIZERS), loaded with one query
+    per relation (none for the models in bank.refcache).
+    Args:
+        serializer_class: CompiledSerializerMixin subclass of rows
+        rows: list of representation dicts, updated in place
+        tree: dict {field name: subtree} e.g. {'location': {'seller': {}}}
+    """
+    expandable = serializer_class.expandableFields()
+    for name, subtree in tree.items():
+        model, many = expandable[name]
+        related_class, queryset = EXPAND_SERIALIZERS[model]
+        pks = set()
+        for row in rows:
+            value = row.get(name)
+            if value is None:
+                continue
+            if many:
+                pks.update(value)
+            else:
+                pks.add(value)
+        if not pks:
+            continue
+        if refcache.isCached(queryset):
+            cached = refcache.objects(model)
+            objs = [cached[pk] for pk in pks if pk in cached]
+        else:
+            objs = list(queryset.in_bulk(list(pks)).values())
+        related = dict(zip([m.pk for m in objs], related_class.representMany(objs)))
+        if subtree:
+            expandRepresentations(related_class, list(related.values()), subtree)
+        for row in rows:
+            value = row.get(name)
+            if value is None:
+                continue
+            if many:
+                row[name] = [related[pk] for pk in value if pk in related]
+            else:
+                row[name] = related.get(value)
+
+
+def preloadRelatedObjects(serializer, items):
+    """Load the objects referenced by a list of input items for the
+    BatchPrimaryKeyRelatedFields of serializer (including nested list
+    serializers) with one query per related model.
+    Args:
+        serializer: Serializer instance (not bound to data)
+        items: list of input dicts
+    Returns: dict {Model: {pk: obj}} for use as context['related_objects']
+    """
+    querysets = {}
+    pks = {}
+
+    def collect(fields, data):
+        if not isinstance(data, dict):
+            return
+        for name, field in fields.items():
+            if field.read_only or name not in data:
+                continue
+            value = data[name]
+            if isinstance(field, serializers.ListSerializer):
+                if isinstance(value, list):
+                    for d in value:
+                        collect(field.child.fields, d)
+                continue
+            if isinstance(field, serializers.ManyRelatedField):
+                field = field.child_relation
+                values = value if isinstance(value, list) else []
+            else:
+                values = [value]
+            if not isinstance(field, BatchPrimaryKeyRelatedField):
+                continue
+            queryset = field.get_queryset()
+            querysets[queryset.model] = queryset
+            model_pks = pks.setdefault(queryset.model, set())
+            for v in values:
+                try:
+                    model_pks.add(int(v))
+                except (TypeError, ValueError):
+                    pass
+
+    for data in items:
+        collect(serializer.fields, data)
+    return {model: qset.in_bulk(list(pks[model])) for model, qset in querysets.items()}
+
+
+class SourceSerializer(CompiledSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Source
+        list_serializer_class = CompiledListSerializer
         fields = ('id', 'abbrev', 'name', 'is_active', 'created', 'modified')
 
 
-class InstitutionSerializer(serializers.ModelSerializer):
+class InstitutionSerializer(CompiledSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Institution
+        list_serializer_class = CompiledListSerializer
         fields = ('id', 'abbrev', 'name', 'created', 'modified')
 
 
-class AccountSerializer(serializers.ModelSerializer):
-    inst = serializers.PrimaryKeyRelatedField(queryset=Institution.objects.all())
+class AccountSerializer(CompiledSerializerMixin, serializers.ModelSerializer):
+    inst = BatchPrimaryKeyRelatedField(queryset=Institution.objects.all())
     class Meta:
         model = Account
+        list_serializer_class = CompiledListSerializer
         fields = ('id', 'inst', 'acct_name', 'acct_number', 'is_active', 'memo', 'created', 'modified')
 
 
-class PaytypeSerializer(serializers.ModelSerializer):
+class PaytypeSerializer(CompiledSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Paytype
+        list_serializer_class = CompiledListSerializer
         fields = ('id', 'paytype', 'created', 'modified')
 
 
-class IncomeSerializer(serializers.ModelSerializer):
+class IncomeSerializer(CompiledSerializerMixin, serializers.ModelSerializer):
     user = serializers.PrimaryKeyRelatedField(queryset=User.objects.exclude(username=ADMIN_USER))
-    source = serializers.PrimaryKeyRelatedField(queryset=Source.objects.all())
+    source = BatchPrimaryKeyRelatedField(queryset=Source.objects.all())
 
     class Meta:
         model = Income
+        list_serializer_class = CompiledListSerializer
         fields = ('id', 'user', 'source', 'date_paid', 'amount', 'is_pre_tax', 'memo', 'created', 'modified')
 
     def create(self, validated_data):
@@ -51,15 +377,17 @@ class IncomeSerializer(serializers.ModelSerializer):
         return instance
 
 
-class CategorySerializer(serializers.ModelSerializer):
+class CategorySerializer(CompiledSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Category
+        list_serializer_class = CompiledListSerializer
         fields = ('id', 'catg', 'description', 'created', 'modified')
 
 
-class TagSerializer(serializers.ModelSerializer):
+class TagSerializer(CompiledSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Tag
+        list_serializer_class = CompiledListSerializer
         fields = ('id', 'tag', 'created', 'modified')
 
 
@@ -73,26 +401,26 @@ class InlineLocationSerializer(serializers.ModelSerializer):
 # Seller
 #
 # Used by ReadSellerSerializer
-class ReadPrefAccountSerializer(serializers.ModelSerializer):
+class ReadPrefAccountSerializer(CompiledSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = PreferredAccount
+        list_serializer_class = CompiledListSerializer
         fields = ('id', 'account', 'paytype', 'user')
         read_only_fields = fields
 
-class ReadSellerSerializer(serializers.ModelSerializer):
-    pref_accounts = serializers.SerializerMethodField()
-
-    def get_pref_accounts(self, obj):
-        qset = PreferredAccount.objects.filter(seller=obj).order_by('id')
-        return [ReadPrefAccountSerializer(m).data for m in qset]
+# Use with Seller.objects.withRelated() to load pref_accounts and auto_tags in bulk
+class ReadSellerSerializer(CompiledSerializerMixin, serializers.ModelSerializer):
+    pref_accounts = ReadPrefAccountSerializer(many=True, read_only=True)
 
     class Meta:
         model = Seller
+        list_serializer_class = CompiledListSerializer
         fields = ('id','seller_name','website','is_active','memo','auto_catg','auto_tags','pref_accounts','created','modified')
         read_only_fields = fields
 
 # Used by CreateSellerSerializer
 class InlinePrefAccountSerializer(serializers.ModelSerializer):
+    serializer_related_field = BatchPrimaryKeyRelatedField
     user = serializers.PrimaryKeyRelatedField(
             queryset=User.objects.exclude(username=ADMIN_USER))
 
@@ -101,10 +429,10 @@ class InlinePrefAccountSerializer(serializers.ModelSerializer):
         fields = ('id', 'account', 'paytype', 'user')
 
 class CreateSellerSerializer(serializers.ModelSerializer):
-    auto_catg = serializers.PrimaryKeyRelatedField(
+    auto_catg = BatchPrimaryKeyRelatedField(
             queryset=Category.objects.all(),
             required=False)
-    auto_tags = serializers.PrimaryKeyRelatedField(
+    auto_tags = BatchPrimaryKeyRelatedField(
             queryset=Tag.objects.all(),
             required=False,
             many=True)
@@ -156,10 +484,10 @@ class CreateSellerSerializer(serializers.ModelSerializer):
 # This does not allow updating child locations or pref_accounts (Use their own UpdateSerializers for that).
 # If tags are given, they should be all the tags, as this will do a wholesale update.
 class UpdateSellerSerializer(serializers.ModelSerializer):
-    auto_catg = serializers.PrimaryKeyRelatedField(
+    auto_catg = BatchPrimaryKeyRelatedField(
             queryset=Category.objects.all(),
             required=False)
-    auto_tags = serializers.PrimaryKeyRelatedField(
+    auto_tags = BatchPrimaryKeyRelatedField(
             queryset=Tag.objects.all(),
             required=False,
             many=True)
@@ -169,56 +497,86 @@ class UpdateSellerSerializer(serializers.ModelSerializer):
 
 
 # Add new or update existing Location (seller is read_only)
-class LocationSerializer(serializers.ModelSerializer):
+class LocationSerializer(CompiledSerializerMixin, serializers.ModelSerializer):
     seller = serializers.PrimaryKeyRelatedField(read_only=True)
     class Meta:
         model = Location
+        list_serializer_class = CompiledListSerializer
         fields = ('id', 'seller', 'loc_name', 'loc_address', 'rank', 'created', 'modified')
 
 
 # Add new or update existing pref_account (seller is read_only)
-class PrefAccountSerializer(serializers.ModelSerializer):
+class LocationAliasSerializer(CompiledSerializerMixin, serializers.ModelSerializer):
+    serializer_related_field = BatchPrimaryKeyRelatedField
+    class Meta:
+        model = LocationAlias
+        list_serializer_class = CompiledListSerializer
+        fields = ('id', 'location', 'alias', 'created_by', 'created', 'modified')
+        read_only_fields = ('created_by',)
+
+class DescriptorMatchSerializer(serializers.Serializer):
+    max_descriptors = 10000
+    descriptors = serializers.ListField(child=serializers.CharField(allow_blank=True, max_length=200))
+
+    def validate_descriptors(self, value):
+        if len(value) > self.max_descriptors:
+            raise serializers.ValidationError('At most {0} descriptors can be matched per request.'.format(self.max_descriptors))
+        return value
+
+class PrefAccountSerializer(CompiledSerializerMixin, serializers.ModelSerializer):
+    serializer_related_field = BatchPrimaryKeyRelatedField
     seller = serializers.PrimaryKeyRelatedField(read_only=True)
     user = serializers.PrimaryKeyRelatedField(
             queryset=User.objects.exclude(username=ADMIN_USER))
     class Meta:
         model = PreferredAccount
+        list_serializer_class = CompiledListSerializer
         fields = ('id', 'seller', 'account', 'paytype', 'user')
 
 
-class OrderSerializer(serializers.ModelSerializer):
-    location = serializers.PrimaryKeyRelatedField(
+class OrderSerializer(CompiledSerializerMixin, serializers.ModelSerializer):
+    location = BatchPrimaryKeyRelatedField(
             queryset=Location.objects.all())
-    account = serializers.PrimaryKeyRelatedField(
+    account = BatchPrimaryKeyRelatedField(
             queryset=Account.objects.all())
-    paytype= serializers.PrimaryKeyRelatedField(
+    paytype= BatchPrimaryKeyRelatedField(
             queryset=Paytype.objects.all())
     amount = serializers.DecimalField(max_digits=7, decimal_places=2, coerce_to_string=False)
     class Meta:
         model = Order
-        fields = '__all__'
+        list_serializer_class = CompiledListSerializer
+        exclude = SEARCH_FIELDS
+
+    def validate_num_shipments(self, value):
+        if self.instance is not None and value < self.instance.shipments_received:
+            raise serializers.ValidationError('{0} shipments have already been received.'.format(self.instance.shipments_received))
+        return value
 
 #
 # Expense
 #
 
-class ReadExpenseCatgSerializer(serializers.ModelSerializer):
+class ReadExpenseCatgSerializer(CompiledSerializerMixin, serializers.ModelSerializer):
     weight = serializers.DecimalField(max_digits=3, decimal_places=2, coerce_to_string=False)
     class Meta:
         model = ExpenseCategory
+        list_serializer_class = CompiledListSerializer
         fields = ('id', 'category', 'weight')
         read_only_fields = fields
 
-class ReadExpenseSerializer(serializers.ModelSerializer):
+class ReadExpenseSerializer(CompiledSerializerMixin, serializers.ModelSerializer):
     categories = serializers.SerializerMethodField()
     amount = serializers.DecimalField(max_digits=7, decimal_places=2, coerce_to_string=False)
+    method_sources = {'categories': ('expensecategory_set',)}
 
     def get_categories(self, obj):
-        qset = ExpenseCategory.objects.filter(expense=obj).order_by('id')
-        return [ReadExpenseCatgSerializer(m).data for m in qset]
+        # Uses the rows prefetched by Expense.objects.withRelated() if present
+        qset = sorted(obj.expensecategory_set.all(), key=lambda m: m.pk)
+        return ReadExpenseCatgSerializer.representMany(qset)
 
     class Meta:
         model = Expense
+        list_serializer_class = CompiledListSerializer
         fields = ('id',
             'location',
             'account',
@@ -239,7 +597,7 @@ class ReadExpenseSerializer(serializers.ModelSerializer):
         read_only_fields = fields
 
 class InlineExpenseCatgSerializer(serializers.ModelSerializer):
-    category = serializers.PrimaryKeyRelatedField(
+    category = BatchPrimaryKeyRelatedField(
             queryset=Category.objects.all())
     weight = serializers.DecimalField(max_digits=3, decimal_places=2, coerce_to_string=False)
     class Meta:
@@ -248,9 +606,9 @@ class InlineExpenseCatgSerializer(serializers.ModelSerializer):
 
 # Complete an order and enter an expense
 class ExpenseCompleteOrderSerializer(serializers.ModelSerializer):
-    order = serializers.PrimaryKeyRelatedField(
+    order = BatchPrimaryKeyRelatedField(
         queryset=Order.objects.filter(is_complete=False, is_cancelled=False))
-    tags = serializers.PrimaryKeyRelatedField(
+    tags = BatchPrimaryKeyRelatedField(
         queryset=Tag.objects.all(),
         many=True,
         required=False
@@ -266,25 +624,31 @@ class ExpenseCompleteOrderSerializer(serializers.ModelSerializer):
         1. Call Expense Manager method to complete the order and create the expense.
         2. Assign tags to expense if given.
         3. Call ExpenseCategory Manager method to populate the categories and weights if given.
+        The seller defaults are used for tags/categories not given.
         """
+        validated_data = withSellerDefaults(validated_data, validated_data['order'].location_id)
         tags = None
         if 'tags' in validated_data:
             tags = validated_data.pop('tags')
         ec = []
         if 'categories' in validated_data:
             ec = validated_data.pop('categories')
-        instance = Expense.objects.completeOrder(**validated_data)
-        if tags:
-            instance.tags.set(tags)
-        if ec:
-            ExpenseCategory.objects.enterForExpense(instance, ec)
+        try:
+            with transaction.atomic():
+                instance = Expense.objects.completeOrder(**validated_data)
+                if tags:
+                    instance.tags.set(tags)
+                if ec:
+                    ExpenseCategory.objects.enterForExpense(instance, ec)
+        except ValueError as e:
+            raise serializers.ValidationError(str(e))
         return instance
 
 # Complete an order shipment and enter an expense
 class ExpenseCompleteShipmentSerializer(serializers.ModelSerializer):
-    order = serializers.PrimaryKeyRelatedField(
+    order = BatchPrimaryKeyRelatedField(
         queryset=Order.objects.filter(is_complete=False, is_cancelled=False))
-    tags = serializers.PrimaryKeyRelatedField(
+    tags = BatchPrimaryKeyRelatedField(
         queryset=Tag.objects.all(),
         many=True,
         required=False
@@ -293,6 +657,12 @@ class ExpenseCompleteShipmentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Expense
         fields = ('id', 'order', 'date_paid', 'amount', 'memo', 'shipment_no', 'tags', 'categories')
+        extra_kwargs = {'shipment_no': {'required': True, 'allow_null': False}}
+
+    def validate_shipment_no(self, value):
+        if value is None or value < 1:
+            raise serializers.ValidationError('shipment_no must be 1 or more.')
+        return value
 
     def create(self, validated_data):
         """This expects the following keys in validated_data:
@@ -302,29 +672,35 @@ class ExpenseCompleteShipmentSerializer(serializers.ModelSerializer):
             the order is also marked as complete.
         2. Assign tags to expense if given.
         3. Call ExpenseCategory Manager method to populate the categories and weights if given.
+        The seller defaults are used for tags/categories not given.
         """
+        validated_data = withSellerDefaults(validated_data, validated_data['order'].location_id)
         tags = None
         if 'tags' in validated_data:
             tags = validated_data.pop('tags')
         ec = []
         if 'categories' in validated_data:
             ec = validated_data.pop('categories')
-        instance = Expense.objects.completeShipment(**validated_data)
-        if tags:
-            instance.tags.set(tags)
-        if ec:
-            ExpenseCategory.objects.enterForExpense(instance, ec)
+        try:
+            with transaction.atomic():
+                instance = Expense.objects.completeShipment(**validated_data)
+                if tags:
+                    instance.tags.set(tags)
+                if ec:
+                    ExpenseCategory.objects.enterForExpense(instance, ec)
+        except ValueError as e:
+            raise serializers.ValidationError(str(e))
         return instance
 
-# For all non-Order expenses
+# For all non-Order expenses (also validates the items of BulkCreateExpense)
 class CreateRegularExpenseSerializer(serializers.ModelSerializer):
-    location = serializers.PrimaryKeyRelatedField(
+    location = BatchPrimaryKeyRelatedField(
             queryset=Location.objects.all())
-    account = serializers.PrimaryKeyRelatedField(
+    account = BatchPrimaryKeyRelatedField(
             queryset=Account.objects.all())
-    paytype= serializers.PrimaryKeyRelatedField(
+    paytype= BatchPrimaryKeyRelatedField(
             queryset=Paytype.objects.all())
-    tags = serializers.PrimaryKeyRelatedField(
+    tags = BatchPrimaryKeyRelatedField(
         queryset=Tag.objects.all(),
         many=True,
         required=False
@@ -333,12 +709,23 @@ class CreateRegularExpenseSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Expense
-        exclude = ('order', 'created_by')
+        exclude = ('order', 'created_by') + SEARCH_FIELDS
+
+    def validate_categories(self, value):
+        """Check the weights can be entered by ExpenseCategory.objects.enterForExpense"""
+        if sum([d['weight'] for d in value]) > 1:
+            raise serializers.ValidationError('Sum of category weights cannot exceed 1.0')
+        catg_ids = [d['category'].pk for d in value]
+        if len(set(catg_ids)) != len(catg_ids):
+            raise serializers.ValidationError('A category can only be given once per expense.')
+        return value
 
     def create(self, validated_data):
         """This expects the following keys in validated_data:
             created_by:str
+        The seller defaults are used for tags/categories not given.
         """
+        validated_data = withSellerDefaults(validated_data, validated_data['location'].pk)
         tags = None
         if 'tags' in validated_data:
             tags = validated_data.pop('tags')
@@ -356,20 +743,21 @@ class CreateRegularExpenseSerializer(serializers.ModelSerializer):
 # If given, tags are replaced wholesale
 # Categories must be inserted/updated/deleted separately
 class UpdateRegularExpenseSerializer(serializers.ModelSerializer):
-    tags = serializers.PrimaryKeyRelatedField(
+    serializer_related_field = BatchPrimaryKeyRelatedField
+    tags = BatchPrimaryKeyRelatedField(
         queryset=Tag.objects.all(),
         many=True,
         required=False
     )
     class Meta:
         model = Expense
-        exclude = ('order', 'categories', 'shipment_no')
+        exclude = ('order', 'categories', 'shipment_no') + SEARCH_FIELDS
 
 # If given, tags are replaced wholesale
 # Categories must be inserted/updated/deleted separately
 class UpdateOrderExpenseSerializer(serializers.ModelSerializer):
     order = serializers.PrimaryKeyRelatedField(read_only=True)
-    tags = serializers.PrimaryKeyRelatedField(
+    tags = BatchPrimaryKeyRelatedField(
         queryset=Tag.objects.all(),
         many=True,
         required=False
@@ -378,11 +766,77 @@ class UpdateOrderExpenseSerializer(serializers.ModelSerializer):
         model = Expense
         fields = ('id', 'order', 'date_paid', 'amount', 'memo', 'shipment_no', 'check_no', 'tags')
 
+    def validate_shipment_no(self, value):
+        if value is not None and value < 1:
+            raise serializers.ValidationError('shipment_no must be 1 or more.')
+        return value
+
 
 # Add new or update existing EC (expense is read_only)
-class ExpenseCatgSerializer(serializers.ModelSerializer):
+class ExpenseCatgSerializer(CompiledSerializerMixin, serializers.ModelSerializer):
+    serializer_related_field = BatchPrimaryKeyRelatedField
     expense = serializers.PrimaryKeyRelatedField(read_only=True)
     weight = serializers.DecimalField(max_digits=3, decimal_places=2, coerce_to_string=False)
     class Meta:
         model = ExpenseCategory
+        list_serializer_class = CompiledListSerializer
         fields = ('id','expense', 'category', 'weight')
+
+
+# Statement import (see bank.statements)
+class StatementImportSerializer(CompiledSerializerMixin, serializers.ModelSerializer):
+    class Meta:
+        model = StatementImport
+        list_serializer_class = CompiledListSerializer
+        exclude = ('sha256',)
+
+class StatementUploadSerializer(serializers.Serializer):
+    file = serializers.FileField()
+    account = BatchPrimaryKeyRelatedField(queryset=Account.objects.all())
+    paytype = BatchPrimaryKeyRelatedField(queryset=Paytype.objects.all())
+    default_location = BatchPrimaryKeyRelatedField(queryset=Location.objects.all(), required=False, allow_null=True)
+    filetype = serializers.ChoiceField(choices=StatementImport.FILETYPE_CHOICES, required=False,
+        help_text='Default: from the file extension')
+    charges_negative = serializers.BooleanField(required=False, default=False,
+        help_text='CSV amounts of charges are negative')
+
+    def validate(self, data):
+        if 'filetype' not in data:
+            name = data['file'].name.lower()
+            data['filetype'] = StatementImport.FILETYPE_OFX if name.endswith(('.ofx', '.qfx')) else StatementImport.FILETYPE_CSV
+        return data
+
+class ReconcileSerializer(serializers.Serializer):
+    file = serializers.FileField()
+    account = BatchPrimaryKeyRelatedField(queryset=Account.objects.all())
+    filetype = serializers.ChoiceField(choices=StatementImport.FILETYPE_CHOICES, required=False,
+        help_text='Default: from the file extension')
+    charges_negative = serializers.BooleanField(required=False, default=False,
+        help_text='CSV amounts of charges are negative')
+    date_tolerance = serializers.IntegerField(required=False, default=3, min_value=0, max_value=31,
+        help_text='Days between the statement date and date_paid')
+    amount_tolerance = serializers.DecimalField(max_digits=7, decimal_places=2, required=False,
+        default=Decimal('0.00'), min_value=Decimal('0.00'))
+    complete_orders = serializers.BooleanField(required=False, default=False,
+        help_text='Enter the expenses of the matched open orders')
+
+    def validate(self, data):
+        if 'filetype' not in data:
+            name = data['file'].name.lower()
+            data['filetype'] = StatementImport.FILETYPE_OFX if name.endswith(('.ofx', '.qfx')) else StatementImport.FILETYPE_CSV
+        return data
+
+
+# Serializers and querysets of the related objects embedded with ?expand=
+# (see expandRepresentations and bank.mixins.ExpandMixin)
+EXPAND_SERIALIZERS = {
+    Source: (SourceSerializer, Source.objects.all()),
+    Institution: (InstitutionSerializer, Institution.objects.all()),
+    Account: (AccountSerializer, Account.objects.all()),
+    Paytype: (PaytypeSerializer, Paytype.objects.all()),
+    Category: (CategorySerializer, Category.objects.all()),
+    Tag: (TagSerializer, Tag.objects.all()),
+    Location: (LocationSerializer, Location.objects.all()),
+    Seller: (ReadSellerSerializer, Seller.objects.withRelated()),
+    Order: (OrderSerializer, Order.objects.defer(*SEARCH_FIELDS)),
+}
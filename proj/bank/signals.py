@@ -0,0 +1,221 @@
+import logging
+from django.core.signals import request_started, request_finished
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete, m2m_changed
+from django.db.models import F
+from django.dispatch import receiver
+from django.utils import timezone
+from oauth2_provider.models import AccessToken
+from .models import *
+from . import refcache
+from .oauth import invalidateTokens
+from .reports import invalidateIncomeSummary
+from .rollups import RollupDelta
+from .sync import SYNC_MODELS, recordDeletion
+
+logger = logging.getLogger('gen.signals')
+
+EXPENSE_FIELDS = ('account_id', 'location_id', 'date_paid', 'amount')
+INCOME_FIELDS = ('user_id', 'source_id', 'date_paid', 'amount', 'is_pre_tax')
+
+#
+# Monthly rollups (see bank.rollups). Fixture loading (raw=True) is skipped;
+# run manage.py rebuild_rollups afterwards.
+#
+
+@receiver(pre_save, sender=Expense)
+def expense_pre_save(sender, instance, raw, **kwargs):
+    instance._rollup_old = None
+    if instance.pk and not raw:
+        instance._rollup_old = Expense.objects.filter(pk=instance.pk).values(*EXPENSE_FIELDS).first()
+
+@receiver(post_save, sender=Expense)
+def expense_post_save(sender, instance, created, raw, **kwargs):
+    if raw:
+        return
+    delta = RollupDelta()
+    old = getattr(instance, '_rollup_old', None)
+    if old:
+        delta.addExpense(old, sign=-1)
+    delta.addExpense(instance)
+    if old and (old['amount'] != instance.amount or old['date_paid'] != instance.date_paid):
+        # the weighted amounts of the categories change with the expense
+        for ec in ExpenseCategory.objects.filter(expense=instance).values('category_id', 'weight'):
+            delta.addExpenseCatg(ec, old, sign=-1)
+            delta.addExpenseCatg(ec, instance)
+    delta.apply()
+
+@receiver(post_delete, sender=Expense)
+def expense_post_delete(sender, instance, **kwargs):
+    # the ExpenseCategory rows of the expense are deleted (and subtracted) first
+    delta = RollupDelta()
+    delta.addExpense(instance, sign=-1)
+    delta.apply()
+
+@receiver(post_delete, sender=Expense)
+def expense_order_post_delete(sender, instance, **kwargs):
+    # keep Order.shipments_received equal to the number of its expenses
+    if instance.order_id:
+        Order.objects.filter(pk=instance.order_id, shipments_received__gt=0).update(
+            shipments_received=F('shipments_received') - 1, modified=timezone.now())
+
+
+@receiver(pre_save, sender=ExpenseCategory)
+def expensecatg_pre_save(sender, instance, raw, **kwargs):
+    instance._rollup_old = None
+    if instance.pk and not raw:
+        instance._rollup_old = ExpenseCategory.objects.filter(pk=instance.pk).values('expense_id', 'category_id', 'weight').first()
+
+@receiver(post_save, sender=ExpenseCategory)
+def expensecatg_post_save(sender, instance, created, raw, **kwargs):
+    if raw:
+        return
+    delta = RollupDelta()
+    old = getattr(instance, '_rollup_old', None)
+    if old:
+        expense = Expense.objects.filter(pk=old['expense_id']).values(*EXPENSE_FIELDS).first()
+        if expense:
+            delta.addExpenseCatg(old, expense, sign=-1)
+    delta.addExpenseCatg(instance, instance.expense)
+    delta.apply()
+
+@receiver(post_delete, sender=ExpenseCategory)
+def expensecatg_post_delete(sender, instance, **kwargs):
+    # In a cascade delete of the expense, its row still exists at this point
+    expense = Expense.objects.filter(pk=instance.expense_id).values(*EXPENSE_FIELDS).first()
+    if expense:
+        delta = RollupDelta()
+        delta.addExpenseCatg(instance, expense, sign=-1)
+        delta.apply()
+
+
+@receiver(pre_save, sender=Income)
+def income_pre_save(sender, instance, raw, **kwargs):
+    instance._rollup_old = None
+    if instance.pk and not raw:
+        instance._rollup_old = Income.objects.filter(pk=instance.pk).values(*INCOME_FIELDS).first()
+
+@receiver(post_save, sender=Income)
+def income_post_save(sender, instance, created, raw, **kwargs):
+    if raw:
+        return
+    delta = RollupDelta()
+    old = getattr(instance, '_rollup_old', None)
+    if old:
+        delta.addIncome(old, sign=-1)
+    delta.addIncome(instance)
+    delta.apply()
+    dates = [instance.date_paid, old['date_paid']] if old else [instance.date_paid]
+    income_changed(dates)
+
+@receiver(post_delete, sender=Income)
+def income_post_delete(sender, instance, **kwargs):
+    delta = RollupDelta()
+    delta.addIncome(instance, sign=-1)
+    delta.apply()
+    income_changed([instance.date_paid])
+
+def income_changed(dates):
+    """Invalidate the cached income summaries of the years of dates, now and
+    again after commit so that a summary computed before the commit is dropped.
+    """
+    years = [timezone.localtime(d).year for d in dates]
+    invalidateIncomeSummary(years)
+    transaction.on_commit(lambda: invalidateIncomeSummary(years))
+
+
+#
+# Reference data cache (see bank.refcache)
+#
+request_started.connect(refcache.startRequest)
+request_finished.connect(refcache.finishRequest)
+
+def reference_changed(sender, **kwargs):
+    refcache.bumpGeneration(sender)
+
+for model in refcache.TRACKED_MODELS:
+    post_save.connect(reference_changed, sender=model, dispatch_uid='refcache_save_' + model.__name__)
+    post_delete.connect(reference_changed, sender=model, dispatch_uid='refcache_delete_' + model.__name__)
+
+@receiver(m2m_changed, sender=Seller.auto_tags.through)
+def seller_tags_changed(sender, action, **kwargs):
+    # part of the seller defaults (see bank.defaults)
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        refcache.bumpGeneration(Seller)
+
+
+#
+# Delta sync (see bank.sync): deletions of the synced models leave a tombstone
+#
+def synced_post_delete(sender, instance, **kwargs):
+    recordDeletion(instance)
+
+for model, qset, srl in SYNC_MODELS:
+    post_delete.connect(synced_post_delete, sender=model, dispatch_uid='sync_delete_' + model.__name__)
+
+
+
+#
+# Access token cache (see bank.oauth)
+#
+@receiver(post_save, sender=AccessToken)
+def accesstoken_saved(sender, instance, created, **kwargs):
+    # a new token cannot be cached yet
+    if not created:
+        invalidateTokens([instance.token])
+
+@receiver(post_delete, sender=AccessToken)
+def accesstoken_deleted(sender, instance, **kwargs):
+    invalidateTokens([instance.token])
+
+USER_TOKEN_FIELDS = ('is_active', 'password')
+
+@receiver(pre_save, sender=User)
+def user_pre_save(sender, instance, raw, update_fields=None, **kwargs):
+    # cached tokens hold their user: only is_active and password matter
+    # (e.g. not the last_login saved on each login)
+    instance._token_old = None
+    if instance.pk and not raw and (update_fields is None or set(update_fields) & set(USER_TOKEN_FIELDS)):
+        instance._token_old = User.objects.filter(pk=instance.pk).values(*USER_TOKEN_FIELDS).first()
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, **kwargs):
+    old = getattr(instance, '_token_old', None)
+    if old and any(old[f] != getattr(instance, f) for f in USER_TOKEN_FIELDS):
+        invalidateTokens(AccessToken.objects.filter(user=instance).values_list('token', flat=True))
+
+
+
+#
+# Conditional GET (see bank.mixins.ConditionalGetMixin): changes to the
+# categories/tags of an expense and to the preferred accounts/auto_tags of a
+# seller are part of its representation, so they update its modified time.
+#
+def touch(model, pks):
+    model.objects.filter(pk__in=pks).update(modified=timezone.now())
+
+@receiver([post_save, post_delete], sender=ExpenseCategory)
+def expensecatg_touch(sender, instance, **kwargs):
+    if not kwargs.get('raw'):
+        touch(Expense, [instance.expense_id])
+
+@receiver([post_save, post_delete], sender=PreferredAccount)
+def prefaccount_touch(sender, instance, **kwargs):
+    if not kwargs.get('raw'):
+        touch(Seller, [instance.seller_id])
+
+@receiver(m2m_changed, sender=Expense.tags.through)
+def expense_tags_touch(sender, instance, action, reverse, model, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        if not reverse:
+            touch(Expense, [instance.pk])
+        elif pk_set:
+            touch(Expense, pk_set)
+
+@receiver(m2m_changed, sender=Seller.auto_tags.through)
+def seller_tags_touch(sender, instance, action, reverse, model, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        if not reverse:
+            touch(Seller, [instance.pk])
+        elif pk_set:
+            touch(Seller, pk_set)
@@ -0,0 +1,291 @@
+"""Import of bank/card statement files (CSV or OFX) as expenses of an account.
+
+A file is parsed into StatementLines (charges only), each line is resolved
+to a Location from its description (bank.matching), and lines that match an existing
+expense of the account by (local date, amount) are skipped as duplicates.
+The existing expenses of the date range of the file are read with one
+query (index bank_expense_acct_paid_idx) into a multiset, so a statement
+with two equal charges on a day against one existing expense creates one.
+
+New expenses are inserted with Expense.objects.createBatch in chunks of
+BULK_BATCH_SIZE lines. Each chunk commits together with the progress of its
+StatementImport, so an interrupted import of the same file (same account
+and sha256) resumes after the last committed chunk. Each chunk is claimed
+by locking the StatementImport row (select_for_update) and checking that
+its progress is the one the chunk starts from, so two concurrent runs of
+the same file never insert the same lines: the run that finds the chunk
+already processed stops.
+"""
+from collections import Counter, namedtuple
+import csv
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+import hashlib
+import io
+import logging
+import re
+from django.db import transaction
+from django.utils import timezone
+from .models import *
+from . import matching
+
+logger = logging.getLogger('gen.statements')
+
+StatementLine = namedtuple('StatementLine', ('date', 'description', 'amount'))
+
+CSV_DATE_COLUMNS = ('date', 'transaction date', 'trans. date', 'posted date', 'post date', 'posting date')
+CSV_DESCRIPTION_COLUMNS = ('description', 'payee', 'name', 'merchant', 'memo')
+CSV_AMOUNT_COLUMNS = ('amount', 'debit')
+CSV_DATE_FORMATS = ('%Y-%m-%d', '%m/%d/%Y', '%m/%d/%y', '%d.%m.%Y', '%Y%m%d')
+MAX_UNMATCHED = 100 # descriptions kept in StatementImport.unmatched
+CENTS = Decimal('0.01')
+_amount_field = Expense._meta.get_field('amount')
+MAX_AMOUNT = Decimal(10)**(_amount_field.max_digits - _amount_field.decimal_places) - CENTS
+
+
+class StatementError(ValueError):
+    pass
+
+
+def parseDate(value, formats=CSV_DATE_FORMATS):
+    value = value.strip()
+    for fmt in formats:
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            continue
+    raise StatementError('Unrecognized date: {0}'.format(value))
+
+
+def parseAmount(value):
+    value = value.strip().replace('$', '').replace(',', '')
+    if value.startswith('(') and value.endswith(')'):
+        value = '-' + value[1:-1]
+    try:
+        amount = Decimal(value)
+    except InvalidOperation:
+        raise StatementError('Unrecognized amount: {0}'.format(value))
+    if not amount.is_finite():
+        raise StatementError('Unrecognized amount: {0}'.format(value))
+    if abs(amount) > MAX_AMOUNT or amount != amount.quantize(CENTS):
+        raise StatementError('Amount out of range: {0}'.format(value))
+    return amount
+
+
+def _findColumn(header, names):
+    for name in names:
+        if name in header:
+            return header.index(name)
+    return None
+
+
+def parseCsv(text, charges_negative=False):
+    """Parse a CSV statement with a header row. The columns are found by
+    name (see CSV_*_COLUMNS). Charges are positive amounts (negative if
+    charges_negative) or the values of a debit column; other rows are skipped.
+    Returns: list of StatementLine
+    """
+    rows = csv.reader(io.StringIO(text))
+    header = [h.strip().lower() for h in next(rows, [])]
+    i_date = _findColumn(header, CSV_DATE_COLUMNS)
+    i_desc = _findColumn(header, CSV_DESCRIPTION_COLUMNS)
+    i_amount = _findColumn(header, CSV_AMOUNT_COLUMNS)
+    if i_date is None or i_desc is None or i_amount is None:
+        raise StatementError('CSV header must have date, description and amount columns: {0}'.format(header))
+    is_debit = header[i_amount] == 'debit'
+    lines = []
+    for lineno, row in enumerate(rows, 2):
+        if not any(row):
+            continue
+        try:
+            if not row[i_amount].strip():
+                continue # credit row of a debit/credit file
+            amount = parseAmount(row[i_amount])
+            date = parseDate(row[i_date])
+        except (IndexError, StatementError) as e:
+            raise StatementError('Line {0}: {1}'.format(lineno, e))
+        if charges_negative and not is_debit:
+            amount = -amount
+        if amount <= 0:
+            continue
+        lines.append(StatementLine(date, row[i_desc].strip(), amount))
+    return lines
+
+
+OFX_TRANSACTION = re.compile(r'<STMTTRN>(.*?)(?:</STMTTRN>|(?=<STMTTRN>)|(?=</BANKTRANLIST>))', re.S | re.I)
+OFX_FIELD = re.compile(r'<(\w+)>([^<\r\n]*)')
+
+def parseOfx(text):
+    """Parse the STMTTRN records of an OFX (1.x SGML or 2.x XML) statement.
+    Charges are the records with a negative TRNAMT.
+    Returns: list of StatementLine
+    """
+    lines = []
+    for m in OFX_TRANSACTION.finditer(text):
+        fields = {k.upper(): v.strip() for k, v in OFX_FIELD.findall(m.group(1))}
+        try:
+            amount = parseAmount(fields['TRNAMT'])
+            date = parseDate(fields['DTPOSTED'][:8], ('%Y%m%d',))
+        except KeyError as e:
+            raise StatementError('OFX transaction without {0}'.format(e))
+        if amount >= 0:
+            continue
+        description = ' '.join(v for v in (fields.get('NAME'), fields.get('MEMO')) if v)
+        lines.append(StatementLine(date, description, -amount))
+    return lines
+
+
+def parseStatement(text, filetype, charges_negative=False):
+    if filetype == StatementImport.FILETYPE_OFX:
+        return parseOfx(text)
+    return parseCsv(text, charges_negative)
+
+
+class LocationResolver(object):
+    """Resolves a statement description to a Location id with the
+    descriptor index (see bank.matching), or default_location_id.
+    Matches are cached per description.
+    """
+    def __init__(self, default_location_id=None):
+        self.default_location_id = default_location_id
+        self.index = matching.getIndex()
+        self.resolved = {}
+
+    def resolve(self, description):
+        """Returns Location id or default_location_id"""
+        if description not in self.resolved:
+            with self.index.lock:
+                m = self.index.match(description)
+            self.resolved[description] = m.location_id if m else self.default_location_id
+        return self.resolved[description]
+
+
+def localDate(dt):
+    return timezone.localtime(dt).date()
+
+
+def statementDatetime(date):
+    """date_paid of a statement line: midnight of date in TIME_ZONE"""
+    return timezone.make_aware(datetime(date.year, date.month, date.day))
+
+
+def existingCharges(account, lines, before):
+    """Returns Counter {(date, amount): number of expenses} of the expenses
+    of account in the date range of lines created before datetime before.
+    """
+    dates = [line.date for line in lines]
+    qset = Expense.objects.filter(
+        account=account,
+        date_paid__gte=statementDatetime(min(dates)),
+        date_paid__lt=statementDatetime(max(dates)) + timedelta(days=1),
+        created__lt=before
+    )
+    return Counter((localDate(dt), amount) for dt, amount in qset.values_list('date_paid', 'amount'))
+
+
+def startImport(account, paytype, content, filename, filetype, created_by, default_location=None):
+    """Returns the StatementImport of the file (sha256 of content) for the
+    account, creating it if it does not exist.
+    """
+    digest = hashlib.sha256(content).hexdigest()
+    imp, created = StatementImport.objects.get_or_create(
+        account=account,
+        sha256=digest,
+        defaults={
+            'paytype': paytype,
+            'filename': filename[:200],
+            'filetype': filetype,
+            'default_location': default_location,
+            'created_by': created_by,
+        }
+    )
+    return imp
+
+
+def _lockImport(imp):
+    """Returns the StatementImport row of imp locked until the end of the
+    transaction.
+    """
+    return StatementImport.objects.select_for_update().get(pk=imp.pk)
+
+
+def runImport(imp, content, charges_negative=False, resolver=None):
+    """Parse content and create the expenses of the lines after
+    num_processed. If another run of the same import processes a chunk
+    first, this run stops and returns the import as left by the other run.
+    Args:
+        imp: StatementImport
+        content: bytes of the file
+        charges_negative: bool. CSV amounts of charges are negative.
+        resolver: object with resolve(description) -> location id/None
+    Returns: StatementImport
+    """
+    if imp.status == StatementImport.STATUS_DONE:
+        return imp
+    try:
+        lines = parseStatement(content.decode('utf-8-sig'), imp.filetype, charges_negative)
+    except (StatementError, UnicodeDecodeError) as e:
+        StatementImport.objects.filter(pk=imp.pk).exclude(status=StatementImport.STATUS_DONE).update(
+            status=StatementImport.STATUS_FAILED, error=str(e), modified=timezone.now())
+        raise StatementError(str(e))
+    with transaction.atomic():
+        imp = _lockImport(imp)
+        if imp.status == StatementImport.STATUS_DONE:
+            return imp
+        imp.num_lines = len(lines)
+        imp.status = StatementImport.STATUS_RUNNING
+        imp.error = ''
+        imp.save()
+    remaining = lines[imp.num_processed:]
+    if remaining:
+        if resolver is None:
+            resolver = LocationResolver(imp.default_location_id)
+        existing = existingCharges(imp.account, remaining, imp.created)
+        unmatched = list(imp.unmatched)
+        for start in range(0, len(remaining), BULK_BATCH_SIZE):
+            chunk = remaining[start:start + BULK_BATCH_SIZE]
+            items = []
+            num_duplicates = 0
+            num_unmatched = 0
+            for line in chunk:
+                key = (line.date, line.amount)
+                if existing[key] > 0:
+                    existing[key] -= 1
+                    num_duplicates += 1
+                    continue
+                location_id = resolver.resolve(line.description)
+                if location_id is None:
+                    num_unmatched += 1
+                    if len(unmatched) < MAX_UNMATCHED and line.description not in unmatched:
+                        unmatched.append(line.description)
+                    continue
+                items.append({
+                    'location_id': location_id,
+                    'account_id': imp.account_id,
+                    'paytype_id': imp.paytype_id,
+                    'date_paid': statementDatetime(line.date),
+                    'amount': line.amount,
+                    'memo': line.description,
+                })
+            with transaction.atomic():
+                current = _lockImport(imp)
+                if current.num_processed != imp.num_processed:
+                    # claimed by another run of the same file
+                    logger.info('Import {0.pk}: chunk at {1} processed by another run'.format(imp, imp.num_processed))
+                    return current
+                if items:
+                    Expense.objects.createBatch(items, created_by=imp.created_by)
+                imp.num_processed += len(chunk)
+                imp.num_created += len(items)
+                imp.num_duplicates += num_duplicates
+                imp.num_unmatched += num_unmatched
+                imp.unmatched = unmatched
+                imp.save()
+    with transaction.atomic():
+        imp = _lockImport(imp)
+        if imp.num_processed >= len(lines):
+            imp.status = StatementImport.STATUS_DONE
+            imp.save()
+    logger.info('Import {0.pk} {0.filename}: {0.num_lines} lines, {0.num_created} created, '
+        '{0.num_duplicates} duplicates, {0.num_unmatched} unmatched'.format(imp))
+    return imp
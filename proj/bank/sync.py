@@ -0,0 +1,192 @@
+"""Delta sync for offline clients.
+
+A sync round returns the rows of SYNC_MODELS with modified in
+[since - SYNC_OVERLAP, until) and the tombstones of the rows deleted in
+the same window, where until is the time the round started. Each model
+is read in (modified, id) order with a keyset on the (modified, id)
+index, so an incremental round costs queries proportional to the rows
+changed. A round is split in pages of at most limit rows; the cursor
+returned with each page resumes the round, and the cursor of its last
+page (more=False) starts the next round at since=until.
+
+The overlap window re-sends the rows modified shortly before until: a
+transaction that set modified before until but committed after the
+round read its model is picked up by the next round. Clients apply rows
+and tombstones as idempotent upserts/deletes by (model, id).
+
+Cursors are opaque to the client (base64 of a JSON object):
+    s: since (None for a full sync), u: until
+    m: index in the models being read, k: (modified, id) of the last row read
+A cursor with since before the tombstone retention (SYNC_TOMBSTONE_DAYS)
+restarts with a full sync and reset=True: deletions may have been pruned,
+so the client must drop its data before applying the pages.
+"""
+import base64
+from datetime import timedelta
+import json
+import logging
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .models import *
+from .serializers import *
+
+logger = logging.getLogger('gen.sync')
+
+SYNC_OVERLAP = timedelta(minutes=5)
+SYNC_PAGE_SIZE = 1000
+SYNC_MAX_PAGE_SIZE = 5000
+
+# (model, queryset, serializer class), parents before children
+SYNC_MODELS = (
+    (Source, Source.objects.all(), SourceSerializer),
+    (Institution, Institution.objects.all(), InstitutionSerializer),
+    (Account, Account.objects.all(), AccountSerializer),
+    (Paytype, Paytype.objects.all(), PaytypeSerializer),
+    (Category, Category.objects.all(), CategorySerializer),
+    (Tag, Tag.objects.all(), TagSerializer),
+    (Seller, Seller.objects.withRelated(), ReadSellerSerializer),
+    (Location, Location.objects.all(), LocationSerializer),
+    (LocationAlias, LocationAlias.objects.all(), LocationAliasSerializer),
+    (Order, Order.objects.defer(*SEARCH_FIELDS), OrderSerializer),
+    (Expense, Expense.objects.withRelated(), ReadExpenseSerializer),
+    (Income, Income.objects.all(), IncomeSerializer),
+)
+SYNC_MODEL_NAMES = frozenset(m._meta.model_name for m, q, s in SYNC_MODELS)
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encodeCursor(d):
+    return base64.urlsafe_b64encode(json.dumps(d, separators=(',', ':')).encode('utf-8')).decode('ascii')
+
+
+def _parseTime(value):
+    if value is None:
+        return None
+    dt = parse_datetime(value)
+    if dt is None:
+        raise InvalidCursor('Invalid cursor time')
+    return dt
+
+
+def decodeCursor(cursor):
+    """Returns dict with keys s, u, m, k (datetimes parsed).
+    Raises InvalidCursor.
+    """
+    try:
+        d = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        key = d.get('k')
+        return {
+            's': _parseTime(d.get('s')),
+            'u': _parseTime(d.get('u')),
+            'm': int(d.get('m', 0)),
+            'k': (_parseTime(key[0]), int(key[1])) if key else None,
+        }
+    except InvalidCursor:
+        raise
+    except (ValueError, TypeError, KeyError, IndexError, AttributeError, UnicodeError):
+        raise InvalidCursor('Invalid cursor')
+
+
+def tombstoneHorizon():
+    """Returns the oldest since for which all tombstones are kept"""
+    return timezone.now() - timedelta(days=settings.SYNC_TOMBSTONE_DAYS)
+
+
+def _readers(incremental):
+    """Returns list of (name, queryset, time field, serializer class or None)
+    read in a round. A full sync reads no tombstones.
+    """
+    readers = [(m._meta.model_name, qset, 'modified', srl) for m, qset, srl in SYNC_MODELS]
+    if incremental:
+        readers.append(('tombstone', Tombstone.objects.all(), 'deleted', None))
+    return readers
+
+
+def syncPage(cursor=None, limit=SYNC_PAGE_SIZE):
+    """Returns dict with the changes of a page of a sync round:
+        changes: {model_name: [representation]}
+        deleted: {model_name: [id]}
+        cursor: str cursor of the next page/round
+        more: True if the round has more pages
+        reset: True if the client must drop its data (full sync)
+    Args:
+        cursor: str cursor from a previous page, or None for a full sync
+        limit: max number of rows and tombstones in the page
+    Raises InvalidCursor.
+    """
+    state = decodeCursor(cursor) if cursor else {'s': None, 'u': None, 'm': 0, 'k': None}
+    reset = False
+    if state['s'] is not None and state['u'] is None and state['s'] < tombstoneHorizon():
+        # start of a round older than the tombstones kept
+        state['s'] = None
+        reset = True
+    if state['u'] is None:
+        state['u'] = timezone.now()
+    since, until = state['s'], state['u']
+    changes = {}
+    deleted = {}
+    remaining = limit
+    readers = _readers(since is not None)
+    m = state['m']
+    key = state['k']
+    while m < len(readers) and remaining > 0:
+        name, qset, time_field, serializer_class = readers[m]
+        qset = qset.filter(**{time_field + '__lt': until})
+        if since is not None:
+            qset = qset.filter(**{time_field + '__gte': since - SYNC_OVERLAP})
+        if key is not None:
+            qset = qset.filter(Q(**{time_field + '__gt': key[0]}) | Q(**{time_field: key[0], 'id__gt': key[1]}))
+        rows = list(qset.order_by(time_field, 'id')[:remaining])
+        if rows:
+            if serializer_class is None:
+                for t in rows:
+                    if t.model in SYNC_MODEL_NAMES:
+                        deleted.setdefault(t.model, []).append(t.object_id)
+            else:
+                changes[name] = serializer_class(rows, many=True).data
+            remaining -= len(rows)
+            last = rows[-1]
+            key = (getattr(last, time_field), last.pk)
+        if remaining > 0:
+            # model done
+            m += 1
+            key = None
+    more = m < len(readers)
+    if more:
+        next_state = {'s': since, 'u': until, 'm': m, 'k': key}
+    else:
+        next_state = {'s': until, 'u': None, 'm': 0, 'k': None}
+    next_cursor = encodeCursor({
+        's': next_state['s'].isoformat() if next_state['s'] else None,
+        'u': next_state['u'].isoformat() if next_state['u'] else None,
+        'm': next_state['m'],
+        'k': [next_state['k'][0].isoformat(), next_state['k'][1]] if next_state['k'] else None,
+    })
+    logger.debug('syncPage since={0} until={1}: {2} rows, more={3}'.format(since, until, limit - remaining, more))
+    return {
+        'changes': changes,
+        'deleted': deleted,
+        'cursor': next_cursor,
+        'more': more,
+        'reset': reset,
+    }
+
+
+def recordDeletion(instance):
+    """Create the Tombstone of a deleted row of a synced model"""
+    Tombstone.objects.create(model=instance._meta.model_name, object_id=instance.pk)
+
+
+def pruneTombstones(days=None):
+    """Delete the tombstones older than days (default SYNC_TOMBSTONE_DAYS).
+    Returns: int number deleted
+    """
+    if days is None:
+        days = settings.SYNC_TOMBSTONE_DAYS
+    num, per_model = Tombstone.objects.filter(deleted__lt=timezone.now() - timedelta(days=days)).delete()
+    return num
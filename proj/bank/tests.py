@@ -1,3 +1,868 @@
-from django.test import TestCase
+import csv
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+import io
+from django.contrib.auth.models import User
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Sum
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from oauth2_provider.models import AccessToken, Application
+from rest_framework.test import APIClient
+import json
+from rest_framework.renderers import JSONRenderer
+from rest_framework.serializers import Serializer
+from .middleware import QueryBudgetExceeded
+from .models import *
+from .oauth import tokenCache
+from . import defaults, export, reconcile, refcache, reports, rollups, statements
+from .serializers import (AccountSerializer, ExpenseCompleteShipmentSerializer, IncomeSerializer,
+    LocationSerializer, OrderSerializer, ReadExpenseCatgSerializer, ReadExpenseSerializer, ReadSellerSerializer)
+from .views import ExpenseList
 
-# Create your tests here.
+
+class BankTestCase(TestCase):
+    """Fixtures shared by the API tests: a user, account, paytype, location,
+    categories and tags. Has no tests of its own.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('tester', password='tester')
+        inst = Institution.objects.create(name='Test Bank', abbrev='TB')
+        cls.account = Account.objects.create(inst=inst, acct_name='Checking', acct_number='0001234')
+        cls.paytype = Paytype.objects.create(paytype='Debit')
+        seller = Seller.objects.create(seller_name='Corner Store')
+        cls.location = Location.objects.create(seller=seller, loc_name='Main St')
+        cls.catgs = [Category.objects.create(catg='Food'), Category.objects.create(catg='Home')]
+        cls.tags = [Tag.objects.create(tag='weekly'), Tag.objects.create(tag='cash')]
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def makeExpenses(self, num):
+        now = timezone.now()
+        for i in range(num):
+            expense = Expense.objects.create(
+                location=self.location,
+                account=self.account,
+                paytype=self.paytype,
+                date_paid=now - timedelta(days=i),
+                amount=Decimal('10.00'),
+                created_by=self.user.username
+            )
+            expense.tags.set(self.tags)
+            ExpenseCategory.objects.enterForExpense(expense, [
+                {'category': self.catgs[0], 'weight': Decimal('0.60')},
+                {'category': self.catgs[1], 'weight': Decimal('0.40')},
+            ])
+
+    def countQueries(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx)
+
+
+class ExpenseListQueryTest(BankTestCase):
+    """The number of queries for the expense list must not depend on the number of rows."""
+
+    def test_expense_list_query_count(self):
+        self.makeExpenses(2)
+        small = self.countQueries('/api/v1/expense/')
+        self.makeExpenses(20)
+        large = self.countQueries('/api/v1/expense/')
+        self.assertEqual(small, large)
+
+    def test_expense_detail_categories(self):
+        self.makeExpenses(1)
+        expense = Expense.objects.get()
+        response = self.client.get('/api/v1/expense/{0}/'.format(expense.pk))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([d['weight'] for d in response.data['categories']], [Decimal('0.60'), Decimal('0.40')])
+        self.assertEqual(sorted(response.data['tags']), sorted([t.pk for t in self.tags]))
+
+
+class ConditionalGetTest(BankTestCase):
+    """The list ETag is derived from the rows of the page (see bank.mixins.ConditionalGetMixin)."""
+
+    def test_list_etag(self):
+        self.makeExpenses(3)
+        response = self.client.get('/api/v1/expense/')
+        etag = response['ETag']
+        self.assertNotIn('Last-Modified', response)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/api/v1/expense/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse([q for q in ctx.captured_queries if 'COUNT(' in q['sql']])
+        # the categories and tags are prefetched only for a 200
+        self.assertFalse([q for q in ctx.captured_queries
+            if '"bank_expensecategory"' in q['sql'] or '"bank_expense_tags"' in q['sql']])
+        # a deletion changes the page, and If-Modified-Since alone is not answered with 304
+        Expense.objects.order_by('id').first().delete()
+        response = self.client.get('/api/v1/expense/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        response = self.client.get('/api/v1/expense/', HTTP_IF_MODIFIED_SINCE='Fri, 01 Jan 2100 00:00:00 GMT')
+        self.assertEqual(response.status_code, 200)
+
+    def test_related_modified_field(self):
+        seller = Seller.objects.get(pk=self.location.seller_id)
+        PreferredAccount.objects.create(seller=seller, account=self.account, paytype=self.paytype, user=self.user)
+        etag = self.client.get('/api/v1/pref-account/')['ETag']
+        self.assertEqual(self.client.get('/api/v1/pref-account/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        seller.save()
+        self.assertEqual(self.client.get('/api/v1/pref-account/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class CursorPaginationTest(BankTestCase):
+    """Paging a list through its next links returns every row once and in
+    order, also across rows with the same value of the ordering column,
+    without a COUNT query (see bank.pagination)."""
+
+    def pageIds(self, url):
+        ids = []
+        with CaptureQueriesContext(connection) as ctx:
+            while url:
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                ids.extend(d['id'] for d in response.data['results'])
+                url = response.data['next']
+        self.assertFalse([q for q in ctx.captured_queries if 'COUNT(' in q['sql']])
+        return ids
+
+    def tie(self, qset, field):
+        """Sets field of the first 4 rows (by id) of qset to one value and
+        of the others to an earlier one.
+        Returns: list of the ids in the order of the list (-field, -id)
+        """
+        ids = list(qset.order_by('id').values_list('id', flat=True))
+        now = timezone.now()
+        qset.filter(pk__in=ids[:4]).update(**{field: now})
+        qset.filter(pk__in=ids[4:]).update(**{field: now - timedelta(days=1)})
+        return ids[:4][::-1] + ids[4:][::-1]
+
+    def test_expense(self):
+        self.makeExpenses(7)
+        expected = self.tie(Expense.objects.all(), 'created')
+        self.assertEqual(self.pageIds('/api/v1/expense/?page_size=2'), expected)
+
+    def test_order(self):
+        for i in range(7):
+            Order.objects.create(location=self.location, account=self.account, paytype=self.paytype,
+                order_number='A-{0}'.format(i), order_date=timezone.now(), amount=Decimal('10.00'))
+        expected = self.tie(Order.objects.all(), 'modified')
+        self.assertEqual(self.pageIds('/api/v1/order/?page_size=2'), expected)
+
+    def test_income(self):
+        for i in range(7):
+            source = Source.objects.create(name='Source {0}'.format(i), abbrev='S{0}'.format(i))
+            Income.objects.create(user=self.user, source=source, date_paid=timezone.now(),
+                amount=Decimal('100.00'), created_by=self.user.username)
+        expected = self.tie(Income.objects.all(), 'date_paid')
+        self.assertEqual(self.pageIds('/api/v1/income/?page_size=2'), expected)
+
+
+@override_settings(API_QUERY_BUDGET_STRICT=True)
+class ExpenseListBudgetTest(BankTestCase):
+    """The expense list stays within ExpenseList.query_budget (see bank.middleware)."""
+
+    def test_expense_list_budget(self):
+        self.makeExpenses(20)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/api/v1/expense/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('db;dur=', response['Server-Timing'])
+        self.assertIn('desc="{0} queries"'.format(len(ctx)), response['Server-Timing'])
+
+    def test_expense_list_over_budget(self):
+        self.makeExpenses(2)
+        budget = ExpenseList.query_budget
+        ExpenseList.query_budget = 1
+        try:
+            with self.assertRaises(QueryBudgetExceeded):
+                self.client.get('/api/v1/expense/')
+        finally:
+            ExpenseList.query_budget = budget
+
+
+class CompiledSerializerTest(BankTestCase):
+    """The compiled serializers render the same bytes as Serializer.to_representation."""
+
+    def assertSameOutput(self, serializer_class, qset):
+        objs = list(qset)
+        self.assertTrue(objs)
+        compiled = serializer_class(objs, many=True).data
+        plain = []
+        for obj in objs:
+            s = serializer_class(obj)
+            data = Serializer.to_representation(s, obj)
+            if 'categories' in data:
+                # as built before by a ReadExpenseCatgSerializer per row
+                data['categories'] = [Serializer.to_representation(ReadExpenseCatgSerializer(m), m)
+                    for m in sorted(obj.expensecategory_set.all(), key=lambda m: m.pk)]
+            plain.append(data)
+        self.assertEqual(JSONRenderer().render(compiled), JSONRenderer().render(plain))
+
+    def test_compiled_output(self):
+        self.makeExpenses(3)
+        seller = Seller.objects.get(pk=self.location.seller_id)
+        seller.auto_tags.set(self.tags)
+        PreferredAccount.objects.create(seller=seller, account=self.account, paytype=self.paytype, user=self.user)
+        Order.objects.create(location=self.location, account=self.account, paytype=self.paytype,
+            order_number='A-1', order_date=timezone.now(), amount=Decimal('25.10'), num_shipments=2)
+        Income.objects.create(user=self.user, source=Source.objects.create(name='Employer', abbrev='EMP'),
+            date_paid=timezone.now(), amount=Decimal('100.00'), created_by=self.user.username)
+        self.assertSameOutput(ReadExpenseSerializer, Expense.objects.withRelated())
+        self.assertSameOutput(ReadSellerSerializer, Seller.objects.withRelated())
+        self.assertSameOutput(OrderSerializer, Order.objects.all())
+        self.assertSameOutput(IncomeSerializer, Income.objects.all())
+        self.assertSameOutput(AccountSerializer, Account.objects.all())
+        self.assertSameOutput(LocationSerializer, Location.objects.all())
+
+
+class SparseFieldsTest(BankTestCase):
+    """?fields=/?omit= prune the output, the columns and the prefetches."""
+
+    def test_fields(self):
+        self.makeExpenses(3)
+        full = self.countQueries('/api/v1/expense/')
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/api/v1/expense/?fields=id,date_paid,amount,location')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.data['results'][0].keys()), ['id', 'location', 'date_paid', 'amount'])
+        self.assertEqual(len(ctx), full - 2) # no categories and tags prefetch
+        self.assertFalse([q for q in ctx.captured_queries if '"bank_expense"."memo"' in q['sql']])
+
+    def test_omit(self):
+        self.makeExpenses(1)
+        expense = Expense.objects.get()
+        response = self.client.get('/api/v1/expense/{0}/?omit=categories,memo'.format(expense.pk))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('categories', response.data)
+        self.assertNotIn('memo', response.data)
+        self.assertEqual(sorted(response.data['tags']), sorted([t.pk for t in self.tags]))
+
+    def test_unknown_field(self):
+        response = self.client.get('/api/v1/expense/?fields=id,nope')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('fields', response.data)
+
+
+class ExpandTest(BankTestCase):
+    """?expand= embeds related objects with a constant number of queries."""
+    url = '/api/v1/expense/?expand=location.seller,account.inst,tags'
+
+    def test_expand(self):
+        self.makeExpenses(2)
+        small = self.countQueries(self.url)
+        self.makeExpenses(20)
+        self.assertEqual(self.countQueries(self.url), small)
+        response = self.client.get(self.url)
+        row = response.data['results'][0]
+        self.assertEqual(row['location']['loc_name'], 'Main St')
+        self.assertEqual(row['location']['seller']['seller_name'], 'Corner Store')
+        self.assertEqual(row['account']['inst']['abbrev'], 'TB')
+        self.assertEqual(sorted(m['tag'] for m in row['tags']), ['cash', 'weekly'])
+        self.assertNotIn('ETag', response)
+
+    def test_invalid_expand(self):
+        for path in ('memo', 'location.seller.auto_catg', 'location.nope'):
+            response = self.client.get('/api/v1/expense/?expand={0}'.format(path))
+            self.assertEqual(response.status_code, 400, path)
+        response = self.client.get('/api/v1/expense/?fields=id,amount&expand=location')
+        self.assertEqual(response.status_code, 400)
+
+
+class SyncTest(BankTestCase):
+    """/sync returns the rows changed and deleted since the cursor."""
+
+    def syncAll(self, since=None, page_size=1000):
+        """Returns (changed ids by model, deleted ids by model, last cursor)"""
+        changes = {}
+        deleted = {}
+        more = True
+        while more:
+            params = {'page_size': page_size}
+            if since:
+                params['since'] = since
+            response = self.client.get('/api/v1/sync/', params)
+            self.assertEqual(response.status_code, 200)
+            for model, rows in response.data['changes'].items():
+                changes.setdefault(model, []).extend(d['id'] for d in rows)
+            for model, ids in response.data['deleted'].items():
+                deleted.setdefault(model, []).extend(ids)
+            since = response.data['cursor']
+            more = response.data['more']
+        return changes, deleted, since
+
+    def test_sync(self):
+        self.makeExpenses(2)
+        changes, deleted, cursor = self.syncAll(page_size=2)
+        expense_ids = sorted(Expense.objects.values_list('id', flat=True))
+        self.assertEqual(sorted(changes['expense']), expense_ids)
+        self.assertEqual(changes['account'], [self.account.pk])
+        self.assertEqual(deleted, {})
+        # incremental: the overlap window re-sends the recent rows
+        # so move them before it
+        Expense.objects.update(modified=timezone.now() - timedelta(hours=1))
+        Tombstone.objects.all().delete()
+        kept, removed = expense_ids
+        Expense.objects.get(pk=kept).save()
+        Expense.objects.get(pk=removed).delete()
+        changes, deleted, cursor = self.syncAll(cursor)
+        self.assertEqual(changes.get('expense'), [kept])
+        self.assertEqual(deleted, {'expense': [removed]})
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/v1/sync/', {'since': 'nope'})
+        self.assertEqual(response.status_code, 400)
+
+
+class BootstrapTest(BankTestCase):
+    """/bootstrap returns all reference data with an ETag that changes with it."""
+
+    def test_bootstrap(self):
+        response = self.client.get('/api/v1/bootstrap/')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual([d['id'] for d in data['account']], [self.account.pk])
+        self.assertEqual(data['seller'][0]['seller_name'], 'Corner Store')
+        self.assertEqual(sorted(d['tag'] for d in data['tag']), ['cash', 'weekly'])
+        etag = response['ETag']
+        response = self.client.get('/api/v1/bootstrap/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        PreferredAccount.objects.create(seller=self.location.seller, account=self.account, paytype=self.paytype, user=self.user)
+        response = self.client.get('/api/v1/bootstrap/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(len(data['pref_account']), 1)
+        self.assertEqual(len(data['seller'][0]['pref_accounts']), 1)
+
+
+class BulkCreateExpenseTest(BankTestCase):
+    """expense-bulk writes the valid items with a number of queries that
+    does not depend on the number of items."""
+
+    def items(self, num):
+        # one month, so that the rollup rows written are the same
+        now = timezone.now().isoformat()
+        return [{
+            'location': self.location.pk,
+            'account': self.account.pk,
+            'paytype': self.paytype.pk,
+            'date_paid': now,
+            'amount': '10.00',
+            'tags': [t.pk for t in self.tags],
+            'categories': [{'category': self.catgs[0].pk, 'weight': '0.60'},
+                {'category': self.catgs[1].pk, 'weight': '0.40'}],
+        } for i in range(num)]
+
+    def post(self, items, **params):
+        url = '/api/v1/expense-bulk/'
+        if params:
+            url += '?' + '&'.join('{0}={1}'.format(k, v) for k, v in params.items())
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post(url, items, format='json')
+        return response, len(ctx)
+
+    def test_query_count(self):
+        # creates the rollup rows of the month
+        self.post(self.items(1))
+        response, small = self.post(self.items(2))
+        self.assertEqual(response.status_code, 201)
+        response, large = self.post(self.items(40))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.data['created']), 40)
+        self.assertEqual(small, large)
+        self.assertEqual(Expense.objects.count(), 43)
+        self.assertEqual(ExpenseCategory.objects.count(), 86)
+        self.assertEqual(Expense.tags.through.objects.count(), 86)
+        self.assertEqual(rollups.verifyRollups(), [])
+
+    def test_errors(self):
+        items = self.items(3)
+        items[1]['account'] = 0
+        response, num = self.post(items)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.data['created']), 2)
+        self.assertEqual([e['index'] for e in response.data['errors']], [1])
+        response, num = self.post(items, atomic='true')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Expense.objects.count(), 2)
+
+
+class CategorySpendReportTest(BankTestCase):
+    """report/category-spend totals match aggregates of the raw rows, with
+    and without filters."""
+
+    def test_totals(self):
+        self.makeExpenses(3)
+        Expense.objects.create(location=self.location, account=self.account, paytype=self.paytype,
+            date_paid=timezone.now(), amount=Decimal('5.25'), created_by=self.user.username)
+        total = Expense.objects.aggregate(total=Sum('amount'))['total']
+        weighted = {}
+        for ec in ExpenseCategory.objects.select_related('expense'):
+            weighted[ec.category_id] = weighted.get(ec.category_id, Decimal('0')) + ec.weight*ec.expense.amount
+        for params in ({'period': 'year'}, {'period': 'year', 'account': self.account.pk}):
+            response = self.client.get('/api/v1/report/category-spend/', params)
+            self.assertEqual(response.status_code, 200)
+            results = response.data['results']
+            self.assertEqual(sum(d['total'] for d in results), total)
+            amounts = {}
+            for d in results:
+                for c in d['categories']:
+                    amounts[c['category']] = amounts.get(c['category'], Decimal('0')) + c['amount']
+            self.assertEqual(amounts, weighted)
+            self.assertEqual(sum(d['unallocated'] for d in results), total - sum(weighted.values()))
+
+    def test_invalid_period(self):
+        response = self.client.get('/api/v1/report/category-spend/', {'period': 'week'})
+        self.assertEqual(response.status_code, 400)
+
+
+class IncomeSummaryTest(BankTestCase):
+    """The summary of a closed year is cached and dropped when an income of
+    that year changes."""
+
+    def test_closed_year(self):
+        source = Source.objects.create(name='Employer', abbrev='EMP')
+        year = timezone.localtime(timezone.now()).year - 1
+        date_paid = timezone.make_aware(datetime(year, 6, 15))
+        reports.invalidateIncomeSummary([year])
+        Income.objects.create(user=self.user, source=source, date_paid=date_paid, amount=Decimal('100.00'),
+            is_pre_tax=True, created_by=self.user.username)
+        params = {'period': 'year', 'year_from': year, 'year_to': year}
+        response = self.client.get('/api/v1/report/income-summary/', params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([(d['gross'], d['adjusted']) for d in response.data['results']],
+            [(Decimal('100.00'), Decimal('70.00'))])
+        with self.assertNumQueries(1):
+            # the cache read only
+            reports.incomeSummary('year', year, year)
+        Income.objects.create(user=self.user, source=source, date_paid=date_paid, amount=Decimal('20.00'),
+            created_by=self.user.username)
+        response = self.client.get('/api/v1/report/income-summary/', params)
+        self.assertEqual([(d['gross'], d['adjusted']) for d in response.data['results']],
+            [(Decimal('120.00'), Decimal('90.00'))])
+
+
+class ExpenseExportTest(BankTestCase):
+    """expense-export streams the filtered expenses with their related
+    names, reading categories and tags per chunk."""
+
+    def content(self, response):
+        return b''.join(response.streaming_content).decode('utf-8')
+
+    def test_csv(self):
+        self.makeExpenses(3)
+        response = self.client.get('/api/v1/expense-export/', {'filetype': 'csv', 'account': self.account.pk})
+        self.assertEqual(response.status_code, 200)
+        rows = list(csv.DictReader(io.StringIO(self.content(response))))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[0]['seller'], 'Corner Store')
+        self.assertEqual(rows[0]['account'], 'Checking')
+        self.assertEqual(rows[0]['categories'], 'Food:0.60;Home:0.40')
+        self.assertEqual(sorted(rows[0]['tags'].split(';')), ['cash', 'weekly'])
+
+    def countExport(self, chunk_size):
+        qset = Expense.objects.order_by('date_paid', 'id')
+        with CaptureQueriesContext(connection) as ctx:
+            lines = list(export.streamExpenses(qset, export.FILETYPE_NDJSON, chunk_size=chunk_size))
+        return [json.loads(line) for line in lines], len(ctx)
+
+    def test_ndjson_chunks(self):
+        self.makeExpenses(2)
+        num_small = self.countExport(100)[1]
+        self.makeExpenses(8)
+        records, num_large = self.countExport(100)
+        self.assertEqual(num_small, num_large)
+        # two more queries (categories and tags) per chunk
+        chunked, num_chunked = self.countExport(2)
+        self.assertEqual(num_chunked, num_large + 2*4)
+        self.assertEqual(chunked, records)
+        self.assertEqual(len(records), 10)
+        self.assertEqual(records[0]['categories'], [{'category': 'Food', 'weight': '0.60'},
+            {'category': 'Home', 'weight': '0.40'}])
+
+
+class DescriptorMatchTest(BankTestCase):
+    """Descriptors are matched to locations by name and by learned alias,
+    and the index follows changes of the sellers/locations."""
+
+    def match(self, descriptors):
+        response = self.client.post('/api/v1/match/', {'descriptors': descriptors}, format='json')
+        self.assertEqual(response.status_code, 200)
+        return [d['location'] for d in response.data]
+
+    def test_match(self):
+        self.assertEqual(self.match(['SQ *CORNER STORE 1234', 'CORNER STORE #12', 'ZZQX']),
+            [self.location.pk, self.location.pk, None])
+
+    def test_alias(self):
+        self.assertEqual(self.match(['AMZN MKTP US*2K4AB1']), [None])
+        LocationAlias.objects.create(location=self.location, alias='AMZN MKTP')
+        self.assertEqual(self.match(['AMZN MKTP US*2K4AB1']), [self.location.pk])
+
+    def test_renamed(self):
+        seller = Seller.objects.get(pk=self.location.seller_id)
+        seller.seller_name = 'Blue Bottle'
+        seller.save()
+        self.assertEqual(self.match(['SQ *BLUE BOTTLE 12']), [self.location.pk])
+
+
+class OrderShipmentTest(BankTestCase):
+    """Shipments are counted once per order, and a shipment entered twice
+    (e.g. by concurrent requests) is rejected."""
+
+    def makeOrder(self, num_shipments):
+        return Order.objects.create(location=self.location, account=self.account, paytype=self.paytype,
+            order_number='A-1', order_date=timezone.now(), amount=Decimal('30.00'), num_shipments=num_shipments)
+
+    def test_complete_shipments(self):
+        order = self.makeOrder(2)
+        stale = Order.objects.get(pk=order.pk)
+        Expense.objects.completeShipment(order, timezone.now(), 'tester', Decimal('10.00'), 'first', 1)
+        self.assertEqual(order.shipments_received, 1)
+        with self.assertRaises(ValueError):
+            Expense.objects.completeShipment(stale, timezone.now(), 'tester', Decimal('10.00'), 'again', 1)
+        Expense.objects.completeShipment(stale, timezone.now(), 'tester', Decimal('20.00'), 'second', 2)
+        order.refresh_from_db()
+        self.assertEqual(order.shipments_received, 2)
+        self.assertTrue(order.is_complete)
+        self.assertEqual(Expense.objects.filter(order=order).count(), 2)
+
+    def test_complete_order_twice(self):
+        order = self.makeOrder(1)
+        stale = Order.objects.get(pk=order.pk)
+        Expense.objects.completeOrder(order, timezone.now(), 'tester')
+        with self.assertRaises(ValueError):
+            Expense.objects.completeOrder(stale, timezone.now(), 'tester')
+        self.assertEqual(Expense.objects.filter(order=order).count(), 1)
+
+    def test_batch(self):
+        order = self.makeOrder(3)
+        item = {'order': order.pk, 'date_paid': timezone.now().isoformat(), 'amount': '10.00', 'shipment_no': 1}
+        response = self.client.post('/api/v1/expense-from-order-batch/', [item, item], format='json')
+        self.assertEqual(response.status_code, 201)
+        data = response.data
+        self.assertEqual(len(data['created']), 1)
+        self.assertEqual([e['index'] for e in data['errors']], [1])
+        order.refresh_from_db()
+        self.assertEqual(order.shipments_received, 1)
+
+    def test_update_shipment_no(self):
+        order = self.makeOrder(2)
+        expense = Expense.objects.completeShipment(order, timezone.now(), 'tester', Decimal('10.00'), 'first', 1)
+        response = self.client.patch('/api/v1/expense-from-order/{0}/'.format(expense.pk),
+            {'order': order.pk, 'shipment_no': 0}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('shipment_no', response.data)
+
+    def test_invalid_shipment_no(self):
+        order = self.makeOrder(2)
+        data = {'order': order.pk, 'date_paid': timezone.now().isoformat(), 'amount': '10.00'}
+        for shipment_no in (None, 0):
+            if shipment_no is not None:
+                data['shipment_no'] = shipment_no
+            serializer = ExpenseCompleteShipmentSerializer(data=data)
+            self.assertFalse(serializer.is_valid())
+            self.assertIn('shipment_no', serializer.errors)
+            with self.assertRaisesMessage(ValueError, 'Shipment_no must be 1 or more.'):
+                Expense.objects.completeShipment(order, timezone.now(), 'tester', Decimal('10.00'), '', shipment_no)
+        order.refresh_from_db()
+        self.assertEqual(order.shipments_received, 0)
+
+    def test_shipment_conflict(self):
+        order = self.makeOrder(2)
+        fields = dict(location=self.location, account=self.account, paytype=self.paytype, order=order,
+            date_paid=timezone.now(), amount=Decimal('10.00'), created_by='tester')
+        Expense.objects.create(shipment_no=1, **fields)
+        for shipment_no, conflict in ((1, True), (0, False)):
+            with self.assertRaises(IntegrityError) as ctx:
+                with transaction.atomic():
+                    Expense.objects.create(shipment_no=shipment_no, **fields)
+            self.assertEqual(isShipmentConflict(ctx.exception), conflict)
+
+
+class SearchTest(BankTestCase):
+    """/search finds sellers by name and validates its params."""
+
+    def test_search(self):
+        response = self.client.get('/api/v1/search/', {'q': 'corner', 'types': 'seller'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([d['id'] for d in response.data['results']], [self.location.seller_id])
+
+    def test_invalid_limit(self):
+        for limit in ('0', '-5', 'x'):
+            response = self.client.get('/api/v1/search/', {'q': 'corner', 'limit': limit})
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('limit', response.data)
+
+
+class RollupTest(BankTestCase):
+    """The rollups kept by the signals match the raw tables, and the reports
+    read from them match aggregates of the raw tables."""
+
+    def test_delta(self):
+        delta = rollups.RollupDelta()
+        month = timezone.localtime(timezone.now()).date().replace(day=1)
+        delta.add(ExpenseMonth, {'month': month}, amount=Decimal('5.00'), unallocated=Decimal('5.00'), num=1)
+        delta.add(ExpenseMonth, {'month': month}, amount=Decimal('2.50'), unallocated=Decimal('2.50'), num=1)
+        # a decrement of a missing row is dropped
+        delta.add(ExpenseMonth, {'month': month.replace(year=month.year - 1)}, amount=Decimal('-1.00'), num=-1)
+        delta.apply()
+        self.assertEqual(list(ExpenseMonth.objects.values_list('month', 'amount', 'num')),
+            [(month, Decimal('7.50'), 2)])
+        self.assertEqual(delta.rows, {})
+
+    def test_signals(self):
+        self.makeExpenses(3)
+        expense = Expense.objects.order_by('id').first()
+        expense.amount = Decimal('12.00')
+        expense.date_paid -= timedelta(days=40)
+        expense.save()
+        Expense.objects.order_by('id').last().delete()
+        ExpenseCategory.objects.filter(expense=expense, category=self.catgs[1]).delete()
+        self.assertEqual(rollups.verifyRollups(), [])
+        spend = reports.categorySpendFromRollups(reports.PERIOD_YEAR)
+        self.assertEqual(spend, reports.categorySpend(Expense.objects.all(), reports.PERIOD_YEAR))
+
+    def test_account_location(self):
+        self.makeExpenses(3)
+        other = Location.objects.create(seller=self.location.seller, loc_name='Elm St')
+        account = Account.objects.create(inst=self.account.inst, acct_name='Savings', acct_number='0005678')
+        expense = Expense.objects.create(location=other, account=account, paytype=self.paytype,
+            date_paid=timezone.now(), amount=Decimal('7.00'), created_by=self.user.username)
+        ExpenseCategory.objects.create(expense=expense, category=self.catgs[1], weight=Decimal('0.50'))
+        # moving an expense moves its rollups
+        moved = Expense.objects.order_by('id').first()
+        moved.location = other
+        moved.save()
+        self.assertEqual(rollups.verifyRollups(), [])
+        for kwargs, qset in (
+                ({'account': self.account.pk}, Expense.objects.filter(account=self.account)),
+                ({'account': account.pk}, Expense.objects.filter(account=account)),
+                ({'location': self.location.pk}, Expense.objects.filter(location=self.location)),
+                ({'location': other.pk}, Expense.objects.filter(location=other))):
+            for period in reports.PERIODS:
+                self.assertEqual(reports.categorySpendFromRollups(period, **kwargs), reports.categorySpend(qset, period))
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/api/v1/report/category-spend/', {'account': self.account.pk})
+        self.assertEqual(response.status_code, 200)
+        # no scan of the expenses: the totals come from the rollups
+        self.assertFalse([q['sql'] for q in ctx.captured_queries if 'FROM "bank_expense" ' in q['sql']])
+        self.assertTrue([q['sql'] for q in ctx.captured_queries if 'FROM "bank_expenseaccountmonth"' in q['sql']])
+
+    def test_income_summary(self):
+        source = Source.objects.create(name='Employer', abbrev='EMP')
+        now = timezone.now()
+        Income.objects.create(user=self.user, source=source, date_paid=now, amount=Decimal('100.00'),
+            is_pre_tax=True, created_by=self.user.username)
+        income = Income.objects.create(user=self.user, source=source, date_paid=now, amount=Decimal('50.00'),
+            created_by=self.user.username)
+        income.amount = Decimal('40.00')
+        income.save()
+        self.assertEqual(rollups.verifyRollups(), [])
+        results = reports.incomeSummary(reports.PERIOD_YEAR)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['gross'], Income.objects.aggregate(total=Sum('amount'))['total'])
+        self.assertEqual(results[0]['pre_tax'], Decimal('100.00'))
+        self.assertEqual(results[0]['adjusted'], Decimal('110.00'))
+
+
+class TokenCacheTest(BankTestCase):
+    """A change of a token or of the is_active/password of its user drops
+    only the cached tokens affected."""
+
+    def setUp(self):
+        super(TokenCacheTest, self).setUp()
+        tokenCache.clear()
+        app = Application.objects.create(name='test', user=self.user, client_type=Application.CLIENT_CONFIDENTIAL,
+            authorization_grant_type=Application.GRANT_PASSWORD)
+        expires = timezone.now() + timedelta(hours=1)
+        self.other = User.objects.create_user('other', password='other')
+        self.token = AccessToken.objects.create(user=self.user, application=app, token='token-1',
+            expires=expires, scope='read write')
+        self.other_token = AccessToken.objects.create(user=self.other, application=app, token='token-2',
+            expires=expires, scope='read write')
+        for t in (self.token, self.other_token):
+            tokenCache.set(t.token, t)
+
+    def test_token_changed(self):
+        self.token.scope = 'read'
+        self.token.save()
+        self.assertIsNone(tokenCache.get('token-1'))
+        self.assertEqual(tokenCache.get('token-2'), self.other_token)
+
+    def test_user_changed(self):
+        self.other.last_login = timezone.now()
+        self.other.save(update_fields=['last_login'])
+        self.assertEqual(tokenCache.get('token-2'), self.other_token)
+        self.other.is_active = False
+        self.other.save()
+        self.assertIsNone(tokenCache.get('token-2'))
+        self.assertEqual(tokenCache.get('token-1'), self.token)
+
+
+class RefcacheTest(TransactionTestCase):
+    """Reference rows are cached outside of transactions, reloaded after a
+    write, and handed out as copies."""
+
+    def setUp(self):
+        for model in refcache.CACHED_MODELS:
+            refcache.bumpGeneration(model)
+        self.catg = Category.objects.create(catg='Food')
+        self.location = Location.objects.create(seller=Seller.objects.create(seller_name='Corner Store'), loc_name='Main St')
+
+    def test_cached(self):
+        refcache.objects(Category)
+        with self.assertNumQueries(1):
+            # the generations only
+            self.assertEqual(refcache.get(Category, self.catg.pk).catg, 'Food')
+        self.catg.catg = 'Groceries'
+        self.catg.save()
+        self.assertEqual(refcache.get(Category, self.catg.pk).catg, 'Groceries')
+
+    def test_copies(self):
+        catg = refcache.get(Category, self.catg.pk)
+        catg.catg = 'changed'
+        self.assertEqual(refcache.get(Category, self.catg.pk).catg, 'Food')
+        location = refcache.get(Location, self.location.pk)
+        self.assertEqual(location.seller.seller_name, 'Corner Store')
+        Seller.objects.filter(pk=self.location.seller_id).update(seller_name='Corner Shop')
+        self.assertEqual(refcache.get(Location, self.location.pk).seller.seller_name, 'Corner Shop')
+
+
+class SellerDefaultsTest(BankTestCase):
+    """The auto_catg/auto_tags of the seller are applied to new expenses
+    without categories/tags, and backfilled in batches."""
+
+    def setUp(self):
+        super(SellerDefaultsTest, self).setUp()
+        seller = Seller.objects.get(pk=self.location.seller_id)
+        seller.auto_catg = self.catgs[0]
+        seller.save()
+        seller.auto_tags.set([self.tags[0]])
+
+    def test_create(self):
+        body = {
+            'location': self.location.pk,
+            'account': self.account.pk,
+            'paytype': self.paytype.pk,
+            'date_paid': timezone.now().isoformat(),
+            'amount': '12.00',
+        }
+        response = self.client.post('/api/v1/expense/', body, format='json')
+        self.assertEqual(response.status_code, 201)
+        expense = Expense.objects.get(pk=response.data['id'])
+        self.assertEqual(list(expense.expensecategory_set.values_list('category_id', 'weight')),
+            [(self.catgs[0].pk, Decimal('1.00'))])
+        self.assertEqual(list(expense.tags.values_list('id', flat=True)), [self.tags[0].pk])
+        # given categories/tags are kept
+        body['categories'] = [{'category': self.catgs[1].pk, 'weight': '1.00'}]
+        body['tags'] = []
+        response = self.client.post('/api/v1/expense/', body, format='json')
+        expense = Expense.objects.get(pk=response.data['id'])
+        self.assertEqual(list(expense.expensecategory_set.values_list('category_id', flat=True)), [self.catgs[1].pk])
+        self.assertEqual(expense.tags.count(), 0)
+
+    def test_backfill(self):
+        now = timezone.now()
+        for i in range(5):
+            Expense.objects.create(location=self.location, account=self.account, paytype=self.paytype,
+                date_paid=now - timedelta(days=i), amount=Decimal('10.00'), created_by=self.user.username)
+        self.makeExpenses(1)
+        counts = defaults.backfillSellerDefaults(batch_size=2)
+        self.assertEqual(counts, {'categories': 5, 'tags': 5, 'expenses': 10})
+        self.assertEqual(ExpenseCategory.objects.filter(category=self.catgs[0], weight=Decimal('1.00')).count(), 5)
+        self.assertEqual(rollups.verifyRollups(), [])
+        self.assertEqual(defaults.backfillSellerDefaults(batch_size=2), {'categories': 0, 'tags': 0, 'expenses': 0})
+
+
+class ReconcileMergeTest(SimpleTestCase):
+    """The merges of reconcile match lines to expenses and open orders."""
+    day = timedelta(days=1)
+
+    def line(self, d, amount):
+        return statements.StatementLine(date(2017, 8, d), 'charge', Decimal(amount))
+
+    def order(self, pk, d, amount, num_shipments=1, shipments_received=0, received_amount=None):
+        order = Order(id=pk, order_date=statements.statementDatetime(date(2017, 8, d)),
+            amount=Decimal(amount), num_shipments=num_shipments, shipments_received=shipments_received)
+        order.received_amount = received_amount
+        return order
+
+    def test_merge_expenses(self):
+        lines = [self.line(1, '10.00'), self.line(2, '10.00'), self.line(10, '5.00')]
+        expenses = [(date(2017, 8, 1), Decimal('10.00'), 1), (date(2017, 8, 3), Decimal('10.00'), 2),
+            (date(2017, 8, 4), Decimal('7.00'), 3)]
+        matched, missing, unmatched = reconcile._mergeExpenses(lines, expenses, 2 * self.day, Decimal('0.00'))
+        self.assertEqual([(line.date.day, pk) for line, pk in matched], [(1, 1), (2, 2)])
+        self.assertEqual(missing, [lines[2]])
+        self.assertEqual(unmatched, [(date(2017, 8, 4), 3)])
+
+    def test_merge_orders(self):
+        single = self.order(1, 1, '20.00')
+        multi = self.order(2, 1, '90.00', num_shipments=3)
+        lines = [self.line(2, '20.00'), self.line(3, '30.00'), self.line(4, '55.00'), self.line(5, '60.00')]
+        matches, missing = reconcile._mergeOrders(lines, [single, multi], self.day, Decimal('0.00'))
+        self.assertEqual([(line.amount, order.pk, no) for line, order, no in matches],
+            [(Decimal('20.00'), 1, None), (Decimal('30.00'), 2, 1), (Decimal('60.00'), 2, 2)])
+        # 55.00 is neither a share nor the amount left of the multi-shipment order
+        self.assertEqual(missing, [lines[2]])
+
+    def test_merge_orders_share_rounding(self):
+        multi = self.order(1, 1, '100.00', num_shipments=3, shipments_received=1, received_amount=Decimal('33.33'))
+        lines = [self.line(2, '33.33'), self.line(3, '33.34')]
+        matches, missing = reconcile._mergeOrders(lines, [multi], self.day, Decimal('0.00'))
+        self.assertEqual([no for line, order, no in matches], [2, 3])
+        self.assertEqual(missing, [])
+
+
+class StatementImportTest(BankTestCase):
+    """Statement amounts are validated, and a run of an import already
+    processed by another run creates nothing."""
+    CSV = b'Date,Description,Amount\n2017-08-01,CORNER STORE 1,12.50\n2017-08-02,CORNER STORE 2,7.25\n'
+
+    class Resolver(object):
+        def __init__(self, location_id):
+            self.location_id = location_id
+
+        def resolve(self, description):
+            return self.location_id
+
+    def test_parse_amount(self):
+        self.assertEqual(statements.parseAmount('$1,234.50'), Decimal('1234.50'))
+        self.assertEqual(statements.parseAmount('(10.00)'), Decimal('-10.00'))
+        for value in ('NaN', 'Infinity', '-inf', '100000.00', '1.005', 'abc'):
+            with self.assertRaises(statements.StatementError):
+                statements.parseAmount(value)
+
+    def test_concurrent_run(self):
+        resolver = self.Resolver(self.location.pk)
+        imp = statements.startImport(self.account, self.paytype, self.CSV, 'aug.csv',
+            StatementImport.FILETYPE_CSV, 'tester')
+        # a second upload of the same file gets the same import before it runs
+        stale = statements.startImport(self.account, self.paytype, self.CSV, 'aug.csv',
+            StatementImport.FILETYPE_CSV, 'tester')
+        self.assertEqual(stale.pk, imp.pk)
+        imp = statements.runImport(imp, self.CSV, resolver=resolver)
+        self.assertEqual(imp.num_created, 2)
+        # the other run has processed the lines but not finished yet
+        StatementImport.objects.filter(pk=imp.pk).update(status=StatementImport.STATUS_RUNNING)
+        result = statements.runImport(stale, self.CSV, resolver=resolver)
+        self.assertEqual(result.num_created, 2)
+        self.assertEqual(Expense.objects.filter(account=self.account).count(), 2)
+
+    def test_invalid_amount(self):
+        content = b'Date,Description,Amount\n2017-08-01,CORNER STORE,NaN\n'
+        imp = statements.startImport(self.account, self.paytype, content, 'bad.csv',
+            StatementImport.FILETYPE_CSV, 'tester')
+        with self.assertRaises(statements.StatementError):
+            statements.runImport(imp, content)
+        imp.refresh_from_db()
+        self.assertEqual(imp.status, StatementImport.STATUS_FAILED)
@@ -3,10 +3,13 @@ import logging
 import pytz
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.db import transaction, DataError, IntegrityError
+from django.http import HttpResponse, StreamingHttpResponse
 from django.utils import timezone
 
 from rest_framework import generics, exceptions, permissions, status, serializers
 from rest_framework.pagination import PageNumberPagination
+from rest_framework.parsers import FormParser, MultiPartParser
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from django_filters import rest_framework as filters
@@ -14,6 +17,11 @@ import django_filters
 from oauth2_provider.contrib.rest_framework import TokenHasReadWriteScope, TokenHasScope
 # app
 from .models import *
+from .mixins import CachedListMixin, ConditionalGetMixin, ExpandMixin, SparseFieldsMixin
+from .pagination import ExpenseCursorPagination, IncomeCursorPagination, OrderCursorPagination
+from . import bootstrap, export, matching, reconcile, reports, statements, sync
+from .defaults import backfillSellerDefaults
+from .search import searchQueryset
 from .serializers import *
 
 logger = logging.getLogger('api.views')
@@ -26,68 +34,83 @@ class PingTest(APIView):
         context = {'success': True}
         return Response(context, status=status.HTTP_200_OK)
 
+class Bootstrap(ConditionalGetMixin, APIView):
+    """All reference data (sources, institutions, accounts, paytypes,
+    categories, tags, sellers, locations, preferred accounts) in one
+    pre-rendered JSON payload (see bank.bootstrap). The ETag is the version
+    of the data.
+    """
+    query_budget = 5
+
+    def get(self, request, format=None):
+        version = bootstrap.bootstrapVersion()
+        def build():
+            blob = bootstrap.bootstrapBlob()[1]
+            return HttpResponse(blob, content_type='application/json')
+        return self.conditionalResponse(version, None, build)
+
 # Source
-class SourceList(generics.ListCreateAPIView):
+class SourceList(SparseFieldsMixin, CachedListMixin, generics.ListCreateAPIView):
     queryset = Source.objects.all().order_by('id')
     serializer_class = SourceSerializer
     #permission_classes = (permissions.IsAuthenticated, TokenHasReadWriteScope)
 
-class SourceDetail(generics.RetrieveUpdateDestroyAPIView):
+class SourceDetail(SparseFieldsMixin, ConditionalGetMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = Source.objects.all()
     serializer_class = SourceSerializer
     #permission_classes = (permissions.IsAuthenticated, TokenHasReadWriteScope)
 
 # Institution
-class InstitutionList(generics.ListCreateAPIView):
+class InstitutionList(SparseFieldsMixin, CachedListMixin, generics.ListCreateAPIView):
     queryset = Institution.objects.all().order_by('id')
     serializer_class = InstitutionSerializer
     #permission_classes = (permissions.IsAuthenticated, TokenHasReadWriteScope)
 
-class InstitutionDetail(generics.RetrieveUpdateDestroyAPIView):
+class InstitutionDetail(SparseFieldsMixin, ConditionalGetMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = Institution.objects.all()
     serializer_class = InstitutionSerializer
     #permission_classes = (permissions.IsAuthenticated, TokenHasReadWriteScope)
 
 # Paytype
-class PaytypeList(generics.ListCreateAPIView):
+class PaytypeList(SparseFieldsMixin, CachedListMixin, generics.ListCreateAPIView):
     queryset = Paytype.objects.all().order_by('id')
     serializer_class = PaytypeSerializer
     #permission_classes = (permissions.IsAuthenticated, TokenHasReadWriteScope)
 
-class PaytypeDetail(generics.RetrieveUpdateDestroyAPIView):
+class PaytypeDetail(SparseFieldsMixin, ConditionalGetMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = Paytype.objects.all()
     serializer_class = PaytypeSerializer
     #permission_classes = (permissions.IsAuthenticated, TokenHasReadWriteScope)
 
 # Category
-class CategoryList(generics.ListCreateAPIView):
+class CategoryList(SparseFieldsMixin, CachedListMixin, generics.ListCreateAPIView):
     queryset = Category.objects.all().order_by('id')
     serializer_class = CategorySerializer
     #permission_classes = (permissions.IsAuthenticated, TokenHasReadWriteScope)
 
-class CategoryDetail(generics.RetrieveUpdateDestroyAPIView):
+class CategoryDetail(SparseFieldsMixin, ConditionalGetMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
     #permission_classes = (permissions.IsAuthenticated, TokenHasReadWriteScope)
 
 # Tag
-class TagList(generics.ListCreateAPIView):
+class TagList(SparseFieldsMixin, CachedListMixin, generics.ListCreateAPIView):
     queryset = Tag.objects.all().order_by('id')
     serializer_class = TagSerializer
     #permission_classes = (permissions.IsAuthenticated, TokenHasReadWriteScope)
 
-class TagDetail(generics.RetrieveUpdateDestroyAPIView):
+class TagDetail(SparseFieldsMixin, ConditionalGetMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
     #permission_classes = (permissions.IsAuthenticated, TokenHasReadWriteScope)
 
 # Account
-class AccountList(generics.ListCreateAPIView):
+class AccountList(ExpandMixin, SparseFieldsMixin, CachedListMixin, generics.ListCreateAPIView):
     queryset = Account.objects.all().order_by('id')
     serializer_class = AccountSerializer
     #permission_classes = (permissions.IsAuthenticated, TokenHasReadWriteScope)
 
-class AccountDetail(generics.RetrieveUpdateDestroyAPIView):
+class AccountDetail(ExpandMixin, SparseFieldsMixin, ConditionalGetMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = Account.objects.all()
     serializer_class = AccountSerializer
     #permission_classes = (permissions.IsAuthenticated, TokenHasReadWriteScope)
@@ -101,18 +124,20 @@ class IncomeFilter(filters.FilterSet):
         fields = ('user','source', 'date_paid_from', 'date_paid_to',)
         strict = django_filters.STRICTNESS.RETURN_NO_RESULTS
 
-class IncomeList(generics.ListCreateAPIView):
+class IncomeList(ExpandMixin, SparseFieldsMixin, ConditionalGetMixin, generics.ListCreateAPIView):
     queryset = Income.objects.all().order_by('-date_paid')
+    query_budget = 6
     serializer_class = IncomeSerializer
     #permission_classes = (permissions.IsAuthenticated, TokenHasReadWriteScope)
     filter_class = IncomeFilter
+    pagination_class = IncomeCursorPagination
 
     def perform_create(self, serializer, format=None):
         user = self.request.user
         instance = serializer.save(created_by=user.username)
         return instance
 
-class IncomeDetail(generics.RetrieveUpdateDestroyAPIView):
+class IncomeDetail(ExpandMixin, SparseFieldsMixin, ConditionalGetMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = Income.objects.all()
     serializer_class = IncomeSerializer
     #permission_classes = (permissions.IsAuthenticated, TokenHasReadWriteScope)
@@ -132,8 +157,9 @@ class SellerFilter(filters.FilterSet):
         fields = ('seller_name','is_active', 'auto_catg', 'name__iexact', 'name__icontains', 'uncategorized', 'auto_tags')
         strict = django_filters.STRICTNESS.RETURN_NO_RESULTS
 
-class SellerList(generics.ListCreateAPIView):
-    queryset = Seller.objects.all().order_by('id')
+class SellerList(ExpandMixin, SparseFieldsMixin, ConditionalGetMixin, generics.ListCreateAPIView):
+    queryset = Seller.objects.withRelated().order_by('id')
+    query_budget = 8
     filter_class = SellerFilter
 
     def get_serializer_class(self):
@@ -144,15 +170,16 @@ class SellerList(generics.ListCreateAPIView):
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        instance = self.perform_create(serializer)
-        out_serializer = ReadSellerSerializer(instance)
+        self.perform_create(serializer)
+        seller = self.get_queryset().get(pk=serializer.instance.pk)
+        out_serializer = ReadSellerSerializer(seller)
         return Response(out_serializer.data, status=status.HTTP_201_CREATED)
 
-class SellerDetail(generics.RetrieveUpdateDestroyAPIView):
-    queryset = Seller.objects.all()
+class SellerDetail(ExpandMixin, SparseFieldsMixin, ConditionalGetMixin, generics.RetrieveUpdateDestroyAPIView):
+    queryset = Seller.objects.withRelated()
 
     def get_serializer_class(self):
-        if hasattr(self, 'request') and request.method not in permissions.SAFE_METHODS:
+        if hasattr(self, 'request') and self.request.method not in permissions.SAFE_METHODS:
             return UpdateSellerSerializer
         return ReadSellerSerializer
 
@@ -163,12 +190,13 @@ class PrefAccountFilter(filters.FilterSet):
         fields = ('account','seller','user')
         strict = django_filters.STRICTNESS.RETURN_NO_RESULTS
 
-class PrefAccountList(generics.ListCreateAPIView):
+class PrefAccountList(ExpandMixin, SparseFieldsMixin, ConditionalGetMixin, generics.ListCreateAPIView):
     queryset = PreferredAccount.objects.all().order_by('seller','id')
+    modified_field = 'seller__modified'
     serializer_class = PrefAccountSerializer
     filter_class = PrefAccountFilter
 
-class PrefAccountDetail(generics.RetrieveUpdateDestroyAPIView):
+class PrefAccountDetail(ExpandMixin, SparseFieldsMixin, ConditionalGetMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = PreferredAccount.objects.all()
     serializer_class = PrefAccountSerializer
 
@@ -179,15 +207,48 @@ class LocationFilter(filters.FilterSet):
         fields = ('seller','loc_name','rank')
         strict = django_filters.STRICTNESS.RETURN_NO_RESULTS
 
-class LocationList(generics.ListCreateAPIView):
+class LocationList(ExpandMixin, SparseFieldsMixin, ConditionalGetMixin, generics.ListCreateAPIView):
     queryset = Location.objects.all().order_by('id')
     serializer_class = LocationSerializer
     filter_class = LocationFilter
 
-class LocationDetail(generics.RetrieveUpdateDestroyAPIView):
+class LocationDetail(ExpandMixin, SparseFieldsMixin, ConditionalGetMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = Location.objects.all()
     serializer_class = LocationSerializer
 
+class LocationAliasList(ExpandMixin, SparseFieldsMixin, generics.ListCreateAPIView):
+    queryset = LocationAlias.objects.all().order_by('id')
+    serializer_class = LocationAliasSerializer
+    filter_fields = ('location',)
+
+    def perform_create(self, serializer):
+        serializer.save(created_by=self.request.user.username)
+
+class LocationAliasDetail(ExpandMixin, SparseFieldsMixin, generics.RetrieveUpdateDestroyAPIView):
+    queryset = LocationAlias.objects.all()
+    serializer_class = LocationAliasSerializer
+
+class DescriptorMatch(APIView):
+    """Match statement descriptors to locations (see bank.matching).
+    POST {"descriptors": ["SQ *BLUE BOTTLE 12", ...]} (at most 10000)
+    Returns a list in the same order: {descriptor, location, seller, score}
+    with location/seller null if there is no match.
+    """
+    def post(self, request, format=None):
+        serializer = DescriptorMatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        descriptors = serializer.validated_data['descriptors']
+        matches = matching.getIndex().matchMany(descriptors)
+        results = []
+        for descriptor, m in zip(descriptors, matches):
+            results.append({
+                'descriptor': descriptor,
+                'location': m.location_id if m else None,
+                'seller': m.seller_id if m else None,
+                'score': m.score if m else None,
+            })
+        return Response(results, status=status.HTTP_200_OK)
+
 class OrderFilter(filters.FilterSet):
     order_date_from = django_filters.IsoDateTimeFilter(name='order_date', lookup_expr='gte')
     order_date_to = django_filters.IsoDateTimeFilter(name='order_date', lookup_expr='lte')
@@ -203,13 +264,15 @@ class OrderFilter(filters.FilterSet):
         )
         strict = django_filters.STRICTNESS.RETURN_NO_RESULTS
 
-class OrderList(generics.ListCreateAPIView):
-    queryset = Order.objects.all().order_by('-modified')
+class OrderList(ExpandMixin, SparseFieldsMixin, ConditionalGetMixin, generics.ListCreateAPIView):
+    queryset = Order.objects.defer(*SEARCH_FIELDS).order_by('-modified')
+    query_budget = 6
     serializer_class = OrderSerializer
     filter_class = OrderFilter
+    pagination_class = OrderCursorPagination
 
-class OrderDetail(generics.RetrieveUpdateDestroyAPIView):
-    queryset = Order.objects.all()
+class OrderDetail(ExpandMixin, SparseFieldsMixin, ConditionalGetMixin, generics.RetrieveUpdateDestroyAPIView):
+    queryset = Order.objects.defer(*SEARCH_FIELDS)
     serializer_class = OrderSerializer
 
 #
@@ -240,9 +303,11 @@ class ExpenseFilter(filters.FilterSet):
         )
         strict = django_filters.STRICTNESS.RETURN_NO_RESULTS
 
-class ExpenseList(generics.ListCreateAPIView):
-    queryset = Expense.objects.all().order_by('-created')
+class ExpenseList(ExpandMixin, SparseFieldsMixin, ConditionalGetMixin, generics.ListCreateAPIView):
+    queryset = Expense.objects.withRelated().order_by('-created')
+    query_budget = 8
     filter_class = ExpenseFilter
+    pagination_class = ExpenseCursorPagination
 
     def get_serializer_class(self):
         if hasattr(self, 'request') and self.request.method not in permissions.SAFE_METHODS:
@@ -268,8 +333,68 @@ class ExpenseList(generics.ListCreateAPIView):
         out_serializer = ReadExpenseSerializer(instance)
         return Response(out_serializer.data, status=status.HTTP_201_CREATED)
 
-class ExpenseDetail(generics.RetrieveUpdateDestroyAPIView):
-    queryset = Expense.objects.all()
+class BulkCreateExpense(generics.GenericAPIView):
+    """Create many regular (non-order) expenses in one request.
+    The body is a list of expenses in the format of ExpenseList POST. The
+    referenced objects are loaded together, and the valid items are written
+    with batched inserts in one transaction. Invalid items are reported by
+    their index in the list. With ?atomic=true nothing is created if any
+    item is invalid.
+    """
+    queryset = Expense.objects.withRelated()
+    serializer_class = CreateRegularExpenseSerializer
+    max_items = 5000
+
+    def post(self, request, *args, **kwargs):
+        items = request.data
+        if not isinstance(items, list):
+            raise serializers.ValidationError('Expected a list of expenses.')
+        if len(items) > self.max_items:
+            error_msg = 'At most {0} expenses can be created per request.'.format(self.max_items)
+            raise serializers.ValidationError(error_msg)
+        atomic = request.query_params.get('atomic', '').lower() in ('1', 'true')
+        context = self.get_serializer_context()
+        context['related_objects'] = preloadRelatedObjects(self.get_serializer(), items)
+        serializer_class = self.get_serializer_class()
+        valid = []
+        errors = []
+        for index, data in enumerate(items):
+            if isinstance(data, dict) and data.get('order') is not None:
+                error_msg = 'Use different endpoint to create expense from order'
+                errors.append({'index': index, 'errors': {'order': [error_msg]}})
+                continue
+            serializer = serializer_class(data=data, context=context)
+            if serializer.is_valid():
+                valid.append(serializer.validated_data)
+            else:
+                errors.append({'index': index, 'errors': serializer.errors})
+        if errors and (atomic or not valid):
+            context = {'created': [], 'errors': errors}
+            return Response(context, status=status.HTTP_400_BAD_REQUEST)
+        expenses = Expense.objects.createBatch(valid, created_by=request.user.username)
+        qset = self.get_queryset().filter(pk__in=[m.pk for m in expenses]).order_by('id')
+        context = {
+            'created': ReadExpenseSerializer(qset, many=True).data,
+            'errors': errors
+        }
+        return Response(context, status=status.HTTP_201_CREATED)
+
+class ApplySellerDefaults(APIView):
+    """Apply the seller auto_catg to all expenses without categories and the
+    seller auto_tags to all expenses without tags (see bank.defaults).
+    Optional body: {"categories": true, "tags": true}
+    Returns the number of rows added and of expenses changed.
+    """
+    def post(self, request, format=None):
+        data = request.data if isinstance(request.data, dict) else {}
+        counts = backfillSellerDefaults(
+            categories=bool(data.get('categories', True)),
+            tags=bool(data.get('tags', True))
+        )
+        return Response(counts, status=status.HTTP_200_OK)
+
+class ExpenseDetail(ExpandMixin, SparseFieldsMixin, ConditionalGetMixin, generics.RetrieveUpdateDestroyAPIView):
+    queryset = Expense.objects.withRelated()
 
     def get_serializer_class(self):
         if hasattr(self, 'request') and self.request.method not in permissions.SAFE_METHODS:
@@ -293,15 +418,94 @@ class ExpenseDetail(generics.RetrieveUpdateDestroyAPIView):
         serializer = self.get_serializer(instance, data=request.data, partial=partial)
         serializer.is_valid(raise_exception=True)
         self.perform_update(serializer)
-        expense = Expense.objects.get(pk=instance.pk)
-        out_serializer = ReadExpenseSerializer(instance)
+        # re-fetch so that the prefetched categories/tags reflect the update
+        expense = self.get_queryset().get(pk=instance.pk)
+        out_serializer = ReadExpenseSerializer(expense)
         return Response(out_serializer.data)
 
 
+class ExpenseExport(generics.GenericAPIView):
+    """Stream the expenses matching the ExpenseFilter parameters as CSV
+    (?filetype=csv, default) or NDJSON (?filetype=ndjson), ordered by
+    date_paid. See bank.export.
+    """
+    queryset = Expense.objects.order_by('date_paid', 'id')
+    filter_class = ExpenseFilter
+
+    def get(self, request, *args, **kwargs):
+        filetype = request.query_params.get('filetype', export.FILETYPE_CSV)
+        if filetype not in export.FILETYPES:
+            error_msg = 'filetype must be one of: {0}'.format(', '.join(sorted(export.FILETYPES)))
+            raise serializers.ValidationError({'filetype': [error_msg]})
+        expenses = self.filter_queryset(self.get_queryset())
+        if 'categories' in request.query_params or 'tags' in request.query_params:
+            # m2m filters can repeat an expense
+            expenses = expenses.distinct()
+        response = StreamingHttpResponse(export.streamExpenses(expenses, filetype),
+            content_type=export.FILETYPES[filetype])
+        response['Content-Disposition'] = 'attachment; filename="expenses.{0}"'.format(filetype)
+        return response
+
+class StatementImportList(ExpandMixin, SparseFieldsMixin, generics.ListAPIView):
+    """GET: list the statement imports.
+    POST (multipart): import a CSV/OFX statement file as expenses of an
+    account (see bank.statements). Uploading the same file for the same
+    account again resumes an interrupted import and otherwise returns the
+    existing import.
+    """
+    queryset = StatementImport.objects.all()
+    serializer_class = StatementImportSerializer
+    parser_classes = (MultiPartParser, FormParser)
+
+    def post(self, request, *args, **kwargs):
+        upload = StatementUploadSerializer(data=request.data)
+        upload.is_valid(raise_exception=True)
+        data = upload.validated_data
+        content = data['file'].read()
+        imp = statements.startImport(
+            account=data['account'],
+            paytype=data['paytype'],
+            content=content,
+            filename=data['file'].name,
+            filetype=data['filetype'],
+            created_by=request.user.username,
+            default_location=data.get('default_location')
+        )
+        try:
+            imp = statements.runImport(imp, content, charges_negative=data['charges_negative'])
+        except statements.StatementError as e:
+            raise serializers.ValidationError({'file': [str(e)]})
+        return Response(StatementImportSerializer(imp).data, status=status.HTTP_201_CREATED)
+
+class ReconcileStatement(APIView):
+    """POST (multipart): reconcile a CSV/OFX statement file of an account
+    against its expenses and open orders (see bank.reconcile). With
+    complete_orders=true the expenses of the matched orders are entered.
+    """
+    parser_classes = (MultiPartParser, FormParser)
+
+    def post(self, request, format=None):
+        serializer = ReconcileSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        try:
+            lines = statements.parseStatement(data['file'].read().decode('utf-8-sig'),
+                data['filetype'], data['charges_negative'])
+        except (statements.StatementError, UnicodeDecodeError) as e:
+            raise serializers.ValidationError({'file': [str(e)]})
+        result = reconcile.reconcile(data['account'], lines,
+            date_tolerance=data['date_tolerance'], amount_tolerance=data['amount_tolerance'])
+        context = reconcile.reconciliationData(result)
+        if data['complete_orders']:
+            created, errors = reconcile.completeMatchedOrders(result, request.user.username)
+            context['created'] = [m.pk for m in created]
+            context['errors'] = [dict(reconcile.lineData(line), order=pk, error=msg) for line, pk, msg in errors]
+        return Response(context, status=status.HTTP_200_OK)
+
 class CreateExpenseFromOrder(generics.CreateAPIView):
     """This action will complete the order and create an expense.
     """
-    queryset = Expense.objects.all()
+    queryset = Expense.objects.withRelated()
     serializer_class = ExpenseCompleteOrderSerializer
 
     def perform_create(self, serializer, format=None):
@@ -335,7 +539,7 @@ class UpdateOrderExpense(generics.UpdateAPIView):
     """This action allows updating the appropriate fields of an
     expense that was created from an order (or partial order shipment).
     """
-    queryset = Expense.objects.all()
+    queryset = Expense.objects.withRelated()
     serializer_class = UpdateOrderExpenseSerializer
 
     def perform_update(self, serializer, format=None):
@@ -346,7 +550,7 @@ class UpdateOrderExpense(generics.UpdateAPIView):
         else:
             try:
                 order = Order.objects.get(pk=data['order'])
-                shipment_no = data.get('shipment_no', 1)
+                shipment_no = serializer.validated_data.get('shipment_no') or 1
                 if shipment_no > order.num_shipments:
                     error_msg = "The shipment_no cannot exceed order.num_shipments."
                     raise serializers.ValidationError(error_msg, code='shipment_no')
@@ -354,8 +558,14 @@ class UpdateOrderExpense(generics.UpdateAPIView):
                 error_msg = 'Invalid order id. Does not exist.'
                 raise serializers.ValidationError(error_msg, code='order')
             else:
-                user = self.request.user
-                instance = serializer.save()
+                try:
+                    with transaction.atomic():
+                        instance = serializer.save()
+                except IntegrityError as e:
+                    if not isShipmentConflict(e):
+                        raise
+                    error_msg = 'The order already has an expense for this shipment_no.'
+                    raise serializers.ValidationError(error_msg, code='shipment_no')
                 return instance
 
     def update(self, request, *args, **kwargs):
@@ -366,15 +576,16 @@ class UpdateOrderExpense(generics.UpdateAPIView):
         serializer = self.get_serializer(instance, data=request.data, partial=partial)
         serializer.is_valid(raise_exception=True)
         self.perform_update(serializer)
-        expense = Expense.objects.get(pk=instance.pk)
-        out_serializer = ReadExpenseSerializer(instance)
+        # re-fetch so that the prefetched categories/tags reflect the update
+        expense = self.get_queryset().get(pk=instance.pk)
+        out_serializer = ReadExpenseSerializer(expense)
         return Response(out_serializer.data)
 
 class CreateExpenseFromOrderShipment(generics.CreateAPIView):
     """This action will create an expense and only complete the
     order if expense.shipment_no == order.num_shipments.
     """
-    queryset = Expense.objects.all()
+    queryset = Expense.objects.withRelated()
     serializer_class = ExpenseCompleteShipmentSerializer
 
     def perform_create(self, serializer, format=None):
@@ -398,6 +609,57 @@ class CreateExpenseFromOrderShipment(generics.CreateAPIView):
         return Response(out_serializer.data, status=status.HTTP_201_CREATED)
 
 
+class CompleteOrderBatch(generics.GenericAPIView):
+    """Complete many orders/order shipments in one request.
+    The body is a list of items in the format of expense-from-order POST,
+    or of expense-from-order-shipment POST if the item has a shipment_no.
+    The referenced objects are loaded together and each item is entered
+    in its own savepoint; items that fail are reported by their index.
+    """
+    queryset = Expense.objects.withRelated()
+    serializer_class = ExpenseCompleteOrderSerializer
+    max_items = 1000
+
+    def post(self, request, *args, **kwargs):
+        items = request.data
+        if not isinstance(items, list):
+            raise serializers.ValidationError('Expected a list of orders/shipments.')
+        if len(items) > self.max_items:
+            error_msg = 'At most {0} items can be entered per request.'.format(self.max_items)
+            raise serializers.ValidationError(error_msg)
+        context = self.get_serializer_context()
+        related = preloadRelatedObjects(ExpenseCompleteOrderSerializer(), items)
+        for model, objs in preloadRelatedObjects(ExpenseCompleteShipmentSerializer(), items).items():
+            related.setdefault(model, {}).update(objs)
+        context['related_objects'] = related
+        created = []
+        errors = []
+        for index, data in enumerate(items):
+            if isinstance(data, dict) and data.get('shipment_no') is not None:
+                serializer = ExpenseCompleteShipmentSerializer(data=data, context=context)
+            else:
+                serializer = ExpenseCompleteOrderSerializer(data=data, context=context)
+            try:
+                serializer.is_valid(raise_exception=True)
+                with transaction.atomic():
+                    created.append(serializer.save(created_by=request.user.username).pk)
+            except serializers.ValidationError as e:
+                errors.append({'index': index, 'errors': e.detail})
+            except IntegrityError as e:
+                if isShipmentConflict(e):
+                    # entered concurrently
+                    errors.append({'index': index, 'errors': ['The order already has an expense for this shipment.']})
+                else:
+                    errors.append({'index': index, 'errors': ['Invalid value for the order/shipment.']})
+            except DataError:
+                errors.append({'index': index, 'errors': ['Invalid value for the order/shipment.']})
+        qset = self.get_queryset().filter(pk__in=created).order_by('id')
+        context = {
+            'created': ReadExpenseSerializer(qset, many=True).data if created else [],
+            'errors': errors
+        }
+        return Response(context, status=status.HTTP_201_CREATED if created else status.HTTP_400_BAD_REQUEST)
+
 class ExpenseCatgFilter(filters.FilterSet):
     class Meta:
         model = ExpenseCategory
@@ -407,11 +669,156 @@ class ExpenseCatgFilter(filters.FilterSet):
         )
         strict = django_filters.STRICTNESS.RETURN_NO_RESULTS
 
-class ExpenseCatgList(generics.ListCreateAPIView):
+class ExpenseCatgList(ExpandMixin, SparseFieldsMixin, ConditionalGetMixin, generics.ListCreateAPIView):
     queryset = ExpenseCategory.objects.all().order_by('id')
+    modified_field = 'expense__modified'
     serializer_class = ExpenseCatgSerializer
     filter_class = ExpenseCatgFilter
 
-class ExpenseCatgDetail(generics.RetrieveUpdateDestroyAPIView):
+class ExpenseCatgDetail(ExpandMixin, SparseFieldsMixin, ConditionalGetMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = ExpenseCategory.objects.all()
     serializer_class = ExpenseCatgSerializer
+
+
+#
+# Reports
+#
+
+class CategorySpendReport(APIView):
+    """Expense amount per category and period (?period=month|quarter|year,
+    default month) with the category weights applied, and the unallocated
+    remainder per period. Accepts the ExpenseFilter parameters. Without
+    filters, or with only account or only location, the report is read
+    from the monthly rollup tables.
+    """
+    def get(self, request, format=None):
+        period = request.query_params.get('period', reports.PERIOD_MONTH)
+        if period not in reports.PERIODS:
+            error_msg = 'period must be one of: {0}'.format(', '.join(reports.PERIODS))
+            raise serializers.ValidationError({'period': [error_msg]})
+        filterset = ExpenseFilter(request.query_params, queryset=Expense.objects.all())
+        given = [name for name in filterset.filters if name in request.query_params]
+        rollup_kwargs = None
+        if not given:
+            # unfiltered: read the monthly rollups
+            rollup_kwargs = {}
+        elif given in (['account'], ['location']):
+            # one account or location: read its monthly rollups
+            try:
+                rollup_kwargs = {given[0]: int(request.query_params[given[0]])}
+            except ValueError:
+                pass
+        if rollup_kwargs is not None:
+            results = reports.categorySpendFromRollups(period, **rollup_kwargs)
+        else:
+            expenses = filterset.qs
+            if 'categories' in request.query_params or 'tags' in request.query_params:
+                # m2m filters can repeat an expense
+                expenses = Expense.objects.filter(pk__in=expenses.values('pk'))
+            results = reports.categorySpend(expenses, period)
+        context = {
+            'period': period,
+            'results': results
+        }
+        return Response(context, status=status.HTTP_200_OK)
+
+
+class IncomeSummaryReport(APIView):
+    """Gross, pre-tax and tax-adjusted income per user, source and period
+    (?period=month|quarter|year, default year). Optional filters: user,
+    source, year_from, year_to.
+    """
+    def get(self, request, format=None):
+        params = request.query_params
+        period = params.get('period', reports.PERIOD_YEAR)
+        if period not in reports.PERIODS:
+            error_msg = 'period must be one of: {0}'.format(', '.join(reports.PERIODS))
+            raise serializers.ValidationError({'period': [error_msg]})
+        kwargs = {}
+        for name in ('user', 'source', 'year_from', 'year_to'):
+            if params.get(name):
+                try:
+                    kwargs[name] = int(params[name])
+                except ValueError:
+                    raise serializers.ValidationError({name: ['A valid integer is required.']})
+        context = {
+            'period': period,
+            'results': reports.incomeSummary(period, **kwargs)
+        }
+        return Response(context, status=status.HTTP_200_OK)
+
+
+#
+# Search
+#
+
+class Search(APIView):
+    """Ranked search of expenses, orders and sellers by memo, seller name,
+    location name/address, invoice id and order number.
+    Params:
+        q: search string (required)
+        types: comma-separated subset of expense,order,seller (default all)
+        limit: max results per type (default 20, max 100)
+    """
+    search_types = ('expense', 'order', 'seller')
+    max_limit = 100
+
+    def getSearchSources(self):
+        return {
+            'expense': (Expense.objects.withRelated(), ReadExpenseSerializer),
+            'order': (Order.objects.all(), OrderSerializer),
+            'seller': (Seller.objects.withRelated(), ReadSellerSerializer),
+        }
+
+    def get(self, request, format=None):
+        params = request.query_params
+        q = params.get('q', '').strip()
+        if not q:
+            raise serializers.ValidationError({'q': ['This parameter is required.']})
+        types = params.get('types')
+        types = types.split(',') if types else self.search_types
+        invalid = [t for t in types if t not in self.search_types]
+        if invalid:
+            error_msg = 'Invalid types: {0}'.format(', '.join(invalid))
+            raise serializers.ValidationError({'types': [error_msg]})
+        try:
+            limit = min(int(params.get('limit', 20)), self.max_limit)
+        except ValueError:
+            raise serializers.ValidationError({'limit': ['A valid integer is required.']})
+        if limit < 1:
+            raise serializers.ValidationError({'limit': ['Ensure this value is greater than or equal to 1.']})
+        sources = self.getSearchSources()
+        results = []
+        for t in types:
+            qset, serializer_class = sources[t]
+            objs = list(searchQueryset(qset, q)[:limit])
+            data = serializer_class(objs, many=True).data
+            for obj, d in zip(objs, data):
+                results.append({'type': t, 'id': obj.pk, 'rank': obj.rank, 'data': d})
+        results.sort(key=lambda d: d['rank'], reverse=True)
+        context = {'q': q, 'results': results}
+        return Response(context, status=status.HTTP_200_OK)
+
+
+class Sync(APIView):
+    """Delta sync for offline clients (see bank.sync).
+    Params:
+        since: cursor of the previous page, or none for a full sync
+        page_size: max rows and tombstones in the page (default 1000, max 5000)
+    Returns: {changes: {model: [rows]}, deleted: {model: [ids]}, cursor, more, reset}
+    """
+    query_budget = 25
+
+    def get(self, request, format=None):
+        params = request.query_params
+        try:
+            limit = min(int(params.get('page_size', sync.SYNC_PAGE_SIZE)), sync.SYNC_MAX_PAGE_SIZE)
+        except ValueError:
+            raise serializers.ValidationError({'page_size': ['A valid integer is required.']})
+        if limit < 1:
+            raise serializers.ValidationError({'page_size': ['Must be at least 1.']})
+        try:
+            context = sync.syncPage(params.get('since') or None, limit)
+        except sync.InvalidCursor as e:
+            raise serializers.ValidationError({'since': [str(e)]})
+        return Response(context, status=status.HTTP_200_OK)
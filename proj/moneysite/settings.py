@@ -66,6 +66,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'oauth2_provider',
     'rest_framework',
     'django_filters',
@@ -86,19 +87,35 @@ REST_FRAMEWORK = {
         'oauth2_provider.contrib.rest_framework.OAuth2Authentication',
         'rest_framework.authentication.SessionAuthentication', # for browsable api
     ),
-    'DEFAULT_FILTER_BACKENDS': ('django_filters.rest_framework.DjangoFilterBackend',)
+    'DEFAULT_FILTER_BACKENDS': ('django_filters.rest_framework.DjangoFilterBackend',),
+    'DEFAULT_RENDERER_CLASSES': (
+        'bank.renderers.TimedJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
 }
 
+# Per-request instrumentation (see bank.middleware.ServerTimingMiddleware)
+API_PATH_PREFIX = '/api/'
+API_QUERY_BUDGET = 30 # default, overridden by the query_budget of a view class
+API_LATENCY_BUDGET_MS = 1000
+API_QUERY_BUDGET_STRICT = False # tests set True to fail on exceeding a budget
+SYNC_TOMBSTONE_DAYS = 90 # tombstones of deleted rows are kept this long (see bank.sync)
+
 # OAuth
 OAUTH2_PROVIDER = {
     'ACCESS_TOKEN_EXPIRE_SECONDS': APP_EXPIRE_SECONDS,
     # this is the list of available scopes
-    'SCOPES': {'read': 'Read scope', 'write': 'Write scope', 'groups': 'Access to your groups'}
+    'SCOPES': {'read': 'Read scope', 'write': 'Write scope', 'groups': 'Access to your groups'},
+    'OAUTH2_VALIDATOR_CLASS': 'bank.oauth.CachedOAuth2Validator',
 }
+# Process-local cache of validated access tokens (see bank.oauth)
+TOKEN_CACHE_MAX_SIZE = 1000
+TOKEN_CACHE_SECONDS = 300
 
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'bank.middleware.ServerTimingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -142,6 +159,18 @@ DATABASES = {
 }
 
 
+# Cache
+# Shared by all server processes, so that invalidation is seen everywhere.
+# Create the table with: manage.py createcachetable
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'bank_cache',
+        'TIMEOUT': APP_EXPIRE_SECONDS,
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
 
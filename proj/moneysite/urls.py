@@ -23,6 +23,7 @@ from bank import views
 api_patterns = [
     # ping test
     url(r'^ping/?$', views.PingTest.as_view(), name='ping-pong'),
+    url(r'^bootstrap/?$', views.Bootstrap.as_view()),
     url(r'^source/?$', views.SourceList.as_view()),
     url(r'^source/(?P<pk>[0-9]+)/?$', views.SourceDetail.as_view()),
     url(r'^income/?$', views.IncomeList.as_view()),
@@ -43,15 +44,28 @@ api_patterns = [
     url(r'^pref-account/(?P<pk>[0-9]+)/?$', views.PrefAccountDetail.as_view()),
     url(r'^location/?$', views.LocationList.as_view()),
     url(r'^location/(?P<pk>[0-9]+)/?$', views.LocationDetail.as_view()),
+    url(r'^location-alias/?$', views.LocationAliasList.as_view()),
+    url(r'^location-alias/(?P<pk>[0-9]+)/?$', views.LocationAliasDetail.as_view()),
+    url(r'^match/?$', views.DescriptorMatch.as_view()),
     url(r'^order/?$', views.OrderList.as_view()),
     url(r'^order/(?P<pk>[0-9]+)/?$', views.OrderDetail.as_view()),
     url(r'^expense/?$', views.ExpenseList.as_view()),
     url(r'^expense/(?P<pk>[0-9]+)/?$', views.ExpenseDetail.as_view()),
+    url(r'^expense-bulk/?$', views.BulkCreateExpense.as_view()),
+    url(r'^expense-export/?$', views.ExpenseExport.as_view()),
+    url(r'^expense-apply-defaults/?$', views.ApplySellerDefaults.as_view()),
+    url(r'^statement-import/?$', views.StatementImportList.as_view()),
+    url(r'^reconcile/?$', views.ReconcileStatement.as_view()),
     url(r'^expense-from-order/?$', views.CreateExpenseFromOrder.as_view()),
     url(r'^expense-from-order/(?P<pk>[0-9]+)/?$', views.UpdateOrderExpense.as_view()),
     url(r'^expense-from-order-shipment/?$', views.CreateExpenseFromOrderShipment.as_view()),
+    url(r'^expense-from-order-batch/?$', views.CompleteOrderBatch.as_view()),
     url(r'^expense-catg/?$', views.ExpenseCatgList.as_view()),
     url(r'^expense-catg/(?P<pk>[0-9]+)/?$', views.ExpenseCatgDetail.as_view()),
+    url(r'^report/category-spend/?$', views.CategorySpendReport.as_view()),
+    url(r'^report/income-summary/?$', views.IncomeSummaryReport.as_view()),
+    url(r'^search/?$', views.Search.as_view()),
+    url(r'^sync/?$', views.Sync.as_view()),
 ]
 
 api_patterns = format_suffix_patterns(api_patterns)